@@ -2,4 +2,5 @@ from base.model import HKModel, HKModelParams
 from base.agent import HKAgent
 from base.recsys import HKModelRecommendationSystem
 from base.event import EventLogger
-from base.scenario import EnvironmentProvider, Scenario, StatsType, SimulationParams
\ No newline at end of file
+from base.scenario import EnvironmentProvider, Scenario, StatsType, SimulationParams
+from base.replica import ScenarioBatch
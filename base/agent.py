@@ -21,7 +21,7 @@ class HKAgent(Agent):
     super().__init__(unique_id, model)
 
     # current state
-    self.cur_opinion = opinion if opinion is not None else np.random.uniform(
+    self.cur_opinion = opinion if opinion is not None else model.rng.uniform(
         -1, 1)
 
     # future state
@@ -95,9 +95,10 @@ class HKAgent(Agent):
       ]
 
     # handle rewiring
-    if gamma > 0 and discordant_neighbor and concordant_recommended and np.random.uniform() < gamma:
-      follow = np.random.choice(concordant_recommended)
-      unfollow = np.random.choice(discordant_neighbor)
+    rng = self.model.rng
+    if gamma > 0 and discordant_neighbor and concordant_recommended and rng.uniform() < gamma:
+      follow = concordant_recommended[rng.integers(len(concordant_recommended))]
+      unfollow = discordant_neighbor[rng.integers(len(discordant_neighbor))]
       self.next_follow = (unfollow, follow)
 
     if 'follow_event' in self.model.collect:
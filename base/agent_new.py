@@ -1,11 +1,14 @@
 from __future__ import annotations
 
 from typing import TYPE_CHECKING, List, Optional, Tuple, TypeAlias, Callable, Any
+from numpy.typing import NDArray
 
 import numba
 import numpy as np
 from mesa import Agent
 
+from base.tweet import TweetRecordDType
+
 if TYPE_CHECKING:
   from base.model import HKModel
   from base.tweet import TweetRecord
@@ -78,6 +81,8 @@ def hk_agent_step(
     report_view_tweets: bool,
     report_retweet: bool,
     report_rewiring: bool,
+
+    rng: np.random.Generator,
 ):
 
   # collect vars
@@ -125,8 +130,9 @@ def hk_agent_step(
   if collect_op_sum_agents:
     op_sum_agents = (sum_n, sum_r, sum_nd, sum_rd)
 
-  # generate random numbers
-  rnd_retweet, rnd_rewiring = np.random.uniform(low=0, high=1, size=(2,))
+  # generate random numbers, drawn as in `hk_agents_step_batch`
+  rnd_retweet, rnd_rewiring, rnd_follow, rnd_unfollow = rng.uniform(
+      low=0, high=1, size=(4,))
 
   # @@ tweet or retweet
   if n_neighbor > 0 and rnd_retweet < r_retweet:  # randomly retweet one
@@ -146,8 +152,8 @@ def hk_agent_step(
   if gamma > 0 \
       and discordant_neighbor and concordant_recommended \
           and rnd_rewiring < gamma:
-    idx1 = np.random.randint(low=0, high=len(concordant_recommended))
-    idx2 = np.random.randint(low=0, high=len(discordant_neighbor))
+    idx1 = int(rnd_follow * len(concordant_recommended))
+    idx2 = int(rnd_unfollow * len(discordant_neighbor))
     follow, __, _ = concordant_recommended[idx1]
     unfollow, __, _ = discordant_neighbor[idx2]
     next_follow = (unfollow, follow)
@@ -167,6 +173,174 @@ def hk_agent_step(
 
 # r = hk_agent_step(0, 0, 0, 1, 1, 1, 1, [(1, 1, 1), (-1, -1, -1)], None, True, True, True, True, True, )
 
+
+@numba.njit
+def _nth_tweet(
+    opinion: float,
+    tolerance: float,
+    concordant: bool,
+    tweets: NDArray,
+    sources: NDArray,
+    n: int,
+):
+  # source index of the n-th (non-empty) tweet of the given concordance
+  for k in range(sources.size):
+    j = sources[k]
+    if j < 0 or tweets[j].uid < 0:
+      continue
+    if (abs(opinion - tweets[j].opinion) <= tolerance) == concordant:
+      if n == 0:
+        return j
+      n -= 1
+  return -1
+
+
+@numba.njit
+def _hk_agents_step_batch(
+    opinion: NDArray,
+    cur_step: int,
+
+    decay: float,
+    gamma: float,
+    tolerance: float,
+    r_retweet: float,
+
+    tweets: NDArray,
+    indptr: NDArray,
+    indices: NDArray,
+    recommended: NDArray,
+    rnd: NDArray,
+
+    next_opinion: NDArray,
+    next_tweet: NDArray,
+    next_follow: NDArray,
+    nr_agents: NDArray,
+    op_sum_agents: NDArray,
+):
+  for i in range(opinion.size):
+    o = opinion[i]
+    neighbors = indices[indptr[i]: indptr[i + 1]]
+    rec = recommended[i]
+
+    # calculate tweet sets
+    n_neighbor = n_recommended = n_neighbor_d = n_recommended_d = 0
+    sum_n = sum_r = sum_nd = sum_rd = 0.
+    for j in neighbors:
+      t = tweets[j]
+      if t.uid < 0:
+        continue
+      d = t.opinion - o
+      if abs(d) <= tolerance:
+        n_neighbor += 1
+        sum_n += d
+      else:
+        n_neighbor_d += 1
+        sum_nd += d
+    for j in rec:
+      if j < 0 or tweets[j].uid < 0:
+        continue
+      d = tweets[j].opinion - o
+      if abs(d) <= tolerance:
+        n_recommended += 1
+        sum_r += d
+      else:
+        n_recommended_d += 1
+        sum_rd += d
+    n_concordant = n_neighbor + n_recommended
+
+    nr_agents[i, 0] = n_neighbor
+    nr_agents[i, 1] = n_recommended
+    nr_agents[i, 2] = n_neighbor_d
+    nr_agents[i, 3] = n_recommended_d
+    op_sum_agents[i, 0] = sum_n
+    op_sum_agents[i, 1] = sum_r
+    op_sum_agents[i, 2] = sum_nd
+    op_sum_agents[i, 3] = sum_rd
+
+    # @@ influence
+    x = o
+    if n_concordant > 0:
+      x += ((sum_r + sum_n) / n_concordant) * decay
+    next_opinion[i] = x
+
+    # @@ tweet or retweet
+    rnd_retweet = rnd[i, 0]
+    if n_neighbor > 0 and rnd_retweet < r_retweet:
+      retweet_index = int(n_concordant * rnd_retweet / r_retweet) % n_concordant
+      if retweet_index < n_neighbor:
+        j = _nth_tweet(o, tolerance, True, tweets, neighbors, retweet_index)
+      else:
+        j = _nth_tweet(o, tolerance, True, tweets, rec,
+                       retweet_index - n_neighbor)
+      next_tweet[i] = tweets[j]
+    else:
+      t = next_tweet[i]
+      t.uid = i
+      t.step = cur_step
+      t.opinion = x
+
+    # @@ rewiring
+    next_follow[i, 0] = next_follow[i, 1] = -1
+    if gamma > 0 and n_neighbor_d > 0 and n_recommended > 0 \
+            and rnd[i, 1] < gamma:
+      idx1 = int(rnd[i, 2] * n_recommended)
+      idx2 = int(rnd[i, 3] * n_neighbor_d)
+      # follow the authors of the tweets, as `hk_agent_step` does
+      next_follow[i, 0] = tweets[
+          _nth_tweet(o, tolerance, False, tweets, neighbors, idx2)].uid
+      next_follow[i, 1] = tweets[
+          _nth_tweet(o, tolerance, True, tweets, rec, idx1)].uid
+
+
+def hk_agents_step_batch(
+    opinion: NDArray,
+    cur_step: int,
+
+    decay: float,
+    gamma: float,
+    tolerance: float,
+    r_retweet: float,
+
+    tweets: NDArray,
+    indptr: NDArray,
+    indices: NDArray,
+    recommended: NDArray,
+    rng: np.random.Generator,
+    rnd: Optional[NDArray] = None,
+):
+  """Compiled tweet-based step of all agents.
+
+  `tweets` holds the current tweet of every agent as `TweetRecordDType`,
+  the follow graph is given in CSR form and `recommended` is an
+  (n, count) array of agent ids padded with -1.
+
+  Every agent draws four uniforms in the order `hk_agent_step` does, so
+  both give the same results for the same generator state.
+
+  Returns the next opinions, the next tweets, the (unfollow, follow) tweet
+  authors (-1 if no rewiring) and the `nr_agents` / `op_sum_agents` counters.
+  """
+  n = opinion.size
+  if rnd is None:
+    rnd = rng.uniform(low=0, high=1, size=(n, 4))
+
+  next_opinion = np.empty((n, ), dtype=np.float64)
+  next_tweet = np.empty((n, ), dtype=TweetRecordDType)
+  next_follow = np.empty((n, 2), dtype=np.int64)
+  nr_agents = np.empty((n, 4), dtype=np.int64)
+  op_sum_agents = np.empty((n, 4), dtype=np.float64)
+
+  _hk_agents_step_batch(
+      np.ascontiguousarray(opinion, dtype=np.float64), cur_step,
+      decay, gamma, tolerance, r_retweet,
+      tweets, np.asarray(indptr, dtype=np.int64),
+      np.asarray(indices, dtype=np.int64),
+      np.asarray(recommended, dtype=np.int64).reshape((n, -1)), rnd,
+      next_opinion, next_tweet, next_follow, nr_agents, op_sum_agents,
+  )
+  return next_opinion, next_tweet, next_follow, nr_agents, op_sum_agents
+
+
 _EVENT_NAMES = [
   'view_tweets',
   'retweet',
@@ -186,7 +360,7 @@ class HKAgent(Agent):
     super().__init__(unique_id, model)
 
     # current state
-    self.cur_opinion = opinion if opinion is not None else np.random.uniform(
+    self.cur_opinion = opinion if opinion is not None else model.rng.uniform(
         -1, 1)
     self.cur_tweet: Optional[TweetRecord] = None
 
@@ -224,6 +398,8 @@ class HKAgent(Agent):
         report_view_tweets=self.report_view_tweets,
         report_retweet=self.report_retweet,
         report_rewiring=self.report_rewiring,
+
+        rng=self.model.rng,
     )
 
   def step(self):
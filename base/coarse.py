@@ -0,0 +1,110 @@
+from typing import List
+from numpy.typing import NDArray
+
+import dataclasses
+
+import numpy as np
+
+
+@dataclasses.dataclass
+class SuperNode:
+  # opinion hull of the cluster
+  low: float
+  high: float
+  # settled members merged into the node
+  members: NDArray
+  # members still stepped on their own, see `ConsensusClusters`
+  free_members: int
+  # follow edges between the merged members
+  internal_edges: int
+
+  @property
+  def multiplicity(self) -> int:
+    return self.members.size
+
+
+class ConsensusClusters:
+  """Isolated consensus clusters merged into super-nodes.
+
+  A cluster is a group of at least two agents whose opinions agree to
+  within `error` and that no other agent is within tolerance of. Opinions
+  of its members cannot change anymore, and members without a discordant
+  neighbor cannot rewire either. These settled members are merged into a
+  super-node of the cluster, which the engine does not recommend for, step
+  or sync; their per-agent state stays valid as is. A super-node is split
+  again as soon as an agent outside the cluster comes within tolerance.
+  """
+
+  def __init__(self, num_nodes: int, tolerance: float, error: float):
+    self.num_nodes = num_nodes
+    self.tolerance = tolerance
+    self.error = error
+    self.merged = np.zeros((num_nodes, ), dtype=bool)
+    self.nodes: List[SuperNode] = []
+
+  def clear(self):
+    self.merged[:] = False
+    self.nodes = []
+
+  @property
+  def reduced_size(self) -> int:
+    # number of super-nodes and agents stepped on their own
+    return len(self.nodes) + int(np.sum(~self.merged))
+
+  def detect(self, opinion: NDArray, indptr: NDArray, indices: NDArray):
+    n, tol = self.num_nodes, self.tolerance
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    discordant = np.abs(opinion[indices] - opinion[rows]) > tol
+    settled = np.bincount(rows[discordant], minlength=n) == 0
+
+    order = np.argsort(opinion)
+    o = opinion[order]
+    starts = np.concatenate(([0], np.nonzero(np.diff(o) > self.error)[0] + 1))
+    ends = np.concatenate((starts[1:], [n]))
+    gap_low = o[starts] - np.concatenate(([-np.inf], o[ends[:-1] - 1]))
+    gap_high = np.concatenate((o[starts[1:]], [np.inf])) - o[ends - 1]
+    isolated = (ends - starts >= 2) & (o[ends - 1] - o[starts] <= self.error) \
+        & (gap_low > tol) & (gap_high > tol)
+
+    self.merged[:] = False
+    self.nodes = []
+    label = np.full((n, ), -1, dtype=np.int64)
+    for s, e in zip(starts[isolated], ends[isolated]):
+      cluster = order[s: e]
+      members = cluster[settled[cluster]]
+      if members.size == 0:
+        continue
+      label[members] = len(self.nodes)
+      self.merged[members] = True
+      self.nodes.append(SuperNode(
+          low=float(o[s]), high=float(o[e - 1]),
+          members=members,
+          free_members=cluster.size - members.size,
+          internal_edges=0,
+      ))
+
+    # aggregated edge counts
+    internal = (label[rows] >= 0) & (label[rows] == label[indices])
+    counts = np.bincount(label[rows][internal], minlength=len(self.nodes))
+    for node, c in zip(self.nodes, counts.tolist()):
+      node.internal_edges = c
+
+  def split(self, opinion: NDArray) -> NDArray:
+    """Split super-nodes other agents came within tolerance of, returns the
+    ids of the released members."""
+    free = np.sort(opinion[~self.merged])
+    released: List[NDArray] = []
+    kept: List[SuperNode] = []
+    for node in self.nodes:
+      near = np.searchsorted(free, node.high + self.tolerance, 'right') - \
+          np.searchsorted(free, node.low - self.tolerance, 'left')
+      if near > node.free_members:
+        released.append(node.members)
+      else:
+        kept.append(node)
+    self.nodes = kept
+    if not released:
+      return np.zeros((0, ), dtype=np.int64)
+    ret = np.concatenate(released)
+    self.merged[ret] = False
+    return ret
@@ -0,0 +1,167 @@
+from numpy.typing import NDArray
+
+import numpy as np
+import scipy.sparse as sp
+
+from base.graph import FollowGraph
+
+
+class ConcordanceIndex:
+  """Concordance bits of the follow edges with per-agent running sums.
+
+  For each agent the number of concordant neighbors and the opinion sums of
+  its concordant and of all neighbors are kept up to date by deltas, so an
+  HK step does not need to rescan all edges.
+
+  An edge can only change its concordance once the opinions of its endpoints
+  moved by its slack `|tolerance - |x_v - x_u||` in total. Each agent gets a
+  budget of half the slack of its incident edges and accumulates its
+  movement in `drift`; only the incident edges of agents reaching their
+  budget are checked again. Whenever an edge is evaluated, the budget of its
+  other endpoint is tightened to half the fresh slack as well, so the
+  movement of both endpoints never exceeds the slack unnoticed.
+
+  Bits are stored per storage position of the `FollowGraph`, which rewiring
+  keeps; any other change of the layout rebuilds the index. If more than
+  1 / `dense_fraction` of the agents moved, the sums are recomputed as sparse
+  products with matrices over the storage, whose empty slots have zero weight;
+  if as many reached their budget, all edges are checked again.
+  """
+
+  dense_fraction = 4
+
+  def __init__(self, graph: FollowGraph, opinion: NDArray, tolerance: float):
+    self.graph = graph
+    self.tolerance = tolerance
+    self.rebuild(opinion)
+
+  def rebuild(self, opinion: NDArray):
+    g, n = self.graph, self.graph.num_nodes
+    slots = g._slots()
+    src = np.repeat(np.arange(n), g.out_degree)
+    dst = g.storage[slots]
+    self.owner = np.full((g.storage.size, ), -1, dtype=np.int64)
+    self.owner[slots] = src
+    self.layout_version = g._layout_version
+
+    # the matrices own the column and weight arrays updated on rewiring
+    index_dtype = np.int32 if g.storage.size < 2 ** 31 else np.int64
+    indptr = np.append(g.offset, g.storage.size).astype(index_dtype)
+    columns = np.maximum(g.storage, 0).astype(index_dtype)
+    self.adjacency = sp.csr_matrix(
+        ((g.storage >= 0).astype(float), columns, indptr), shape=(n, n))
+    self.concordant_adjacency = sp.csr_matrix(
+        (np.zeros((g.storage.size, )), self.adjacency.indices, self.adjacency.indptr),
+        shape=(n, n))
+    self.concordant_adjacency.indices = self.adjacency.indices
+
+    # reverse adjacency: storage positions of the edges into each node
+    order = np.argsort(dst, kind='stable')
+    indptr = np.zeros((n + 1, ), dtype=np.int64)
+    np.cumsum(np.bincount(dst, minlength=n), out=indptr[1:])
+    self.reverse = FollowGraph(n, indptr, slots[order])
+
+    self.opinion = np.array(opinion, dtype=float)
+    self.concordant = np.zeros((g.storage.size, ), dtype=bool)
+    self.refresh()
+
+  def refresh(self):
+    """Check all edges again and recompute the sums and budgets."""
+    g, n = self.graph, self.graph.num_nodes
+    slots = g._slots()
+    src, dst = self.owner[slots], g.storage[slots]
+    diff = self.opinion[dst] - self.opinion[src]
+    conc = np.abs(diff) <= self.tolerance
+    self.concordant[slots] = conc
+    self.concordant_adjacency.data[slots] = conc
+    self.n_concordant = np.bincount(src, weights=conc, minlength=n).astype(np.int64)
+    self.sum_concordant = self.concordant_adjacency @ self.opinion
+    self.sum_all = self.adjacency @ self.opinion
+
+    self.drift = np.zeros((n, ))
+    self.budget = np.full((n, ), np.inf)
+    half = np.abs(self.tolerance - np.abs(diff)) / 2
+    np.minimum.at(self.budget, src, half)
+    np.minimum.at(self.budget, dst, half)
+
+  def _in_edges(self, nodes: NDArray):
+    # storage positions of the edges into `nodes`, with the index of the node
+    pos, rep = self.reverse._row_slots(nodes, self.reverse.out_degree[nodes])
+    return self.reverse.storage[pos], rep
+
+  def update(self, opinion: NDArray):
+    """Follow the opinions to `opinion` on the unchanged graph."""
+    if self.layout_version != self.graph._layout_version:
+      self.rebuild(opinion)
+      return
+    delta = opinion - self.opinion
+    moved = np.nonzero(delta)[0]
+    self.opinion[:] = opinion
+    if moved.size == 0:
+      return
+
+    n = self.graph.num_nodes
+    self.drift[moved] += np.abs(delta[moved])
+    exceeded = moved[self.drift[moved] >= self.budget[moved]]
+    if exceeded.size * self.dense_fraction > n:
+      self.refresh()
+      return
+
+    if moved.size * self.dense_fraction > n:
+      # most in-edges are touched anyway, sum them up in one pass
+      self.sum_all = self.adjacency @ self.opinion
+      self.sum_concordant = self.concordant_adjacency @ self.opinion
+    else:
+      pos, rep = self._in_edges(moved)
+      src, d = self.owner[pos], delta[moved][rep]
+      self.sum_all += np.bincount(src, weights=d, minlength=n)
+      self.sum_concordant += np.bincount(
+          src, weights=d * self.concordant[pos], minlength=n)
+    if exceeded.size:
+      self.recheck(exceeded)
+
+  def recheck(self, nodes: NDArray):
+    g = self.graph
+    out_pos, _ = g._row_slots(nodes, g.out_degree[nodes])
+    in_pos, _ = self._in_edges(nodes)
+    # edges between the nodes are already among the out-edges
+    checked = np.zeros((g.num_nodes, ), dtype=bool)
+    checked[nodes] = True
+    pos = np.concatenate((out_pos, in_pos[~checked[self.owner[in_pos]]]))
+    src, dst = self.owner[pos], g.storage[pos]
+    diff = self.opinion[dst] - self.opinion[src]
+    conc = np.abs(diff) <= self.tolerance
+
+    flipped = conc != self.concordant[pos]
+    sign = np.where(conc[flipped], 1, -1)
+    np.add.at(self.n_concordant, src[flipped], sign)
+    np.add.at(self.sum_concordant, src[flipped], sign * self.opinion[dst[flipped]])
+    self.concordant[pos] = conc
+    self.concordant_adjacency.data[pos] = conc
+
+    self.drift[nodes] = 0
+    self.budget[nodes] = np.inf
+    half = np.abs(self.tolerance - np.abs(diff)) / 2
+    np.minimum.at(self.budget, src, self.drift[src] + half)
+    np.minimum.at(self.budget, dst, self.drift[dst] + half)
+
+  def rewire(self, pos: NDArray, src: NDArray, unfollow: NDArray, follow: NDArray):
+    """Account for edges (src, unfollow) at `pos` swapped for (src, follow)."""
+    if pos.size == 0:
+      return
+    x = self.opinion
+    old = self.concordant[pos]
+    conc = np.abs(x[follow] - x[src]) <= self.tolerance
+    np.add.at(self.n_concordant, src, conc.astype(np.int64) - old)
+    np.add.at(self.sum_concordant, src, x[follow] * conc - x[unfollow] * old)
+    np.add.at(self.sum_all, src, x[follow] - x[unfollow])
+    self.concordant[pos] = conc
+    self.concordant_adjacency.data[pos] = conc
+    self.adjacency.indices[pos] = follow
+
+    self.reverse.remove_edges(unfollow, pos)
+    self.reverse.add_edges(follow, pos)
+
+    half = np.abs(self.tolerance - np.abs(x[follow] - x[src])) / 2
+    np.minimum.at(self.budget, src, self.drift[src] + half)
+    np.minimum.at(self.budget, follow, self.drift[follow] + half)
@@ -0,0 +1,196 @@
+from typing import Optional, Tuple
+from numpy.typing import NDArray
+
+import numpy as np
+import networkx as nx
+
+
+def graph_to_csr(graph: nx.DiGraph, n: int) -> Tuple[NDArray, NDArray]:
+  # rows keep the adjacency order of the graph
+  edges = np.array(list(graph.edges()), dtype=np.int64).reshape((-1, 2))
+  edges = edges[np.argsort(edges[:, 0], kind='stable')]
+  indptr = np.zeros((n + 1, ), dtype=np.int64)
+  np.cumsum(np.bincount(edges[:, 0], minlength=n), out=indptr[1:])
+  return indptr, edges[:, 1].copy()
+
+
+class FollowGraph:
+  """Array-backed mutable directed graph.
+
+  Out-edges of node `u` live in `storage[offset[u]: offset[u] + out_degree[u]]`
+  followed by some free slots, so edges can be swapped, added or removed
+  without touching other rows. `version` is incremented on each mutation and
+  is used to invalidate the cached CSR view and networkx export.
+  """
+
+  def __init__(
+      self,
+      num_nodes: int,
+      indptr: NDArray,
+      indices: NDArray,
+      slack: int = 2,
+  ):
+    self.num_nodes = n = num_nodes
+    self.slack = slack
+    self.version = 0
+
+    self.out_degree = np.diff(indptr).astype(np.int64)
+    self.in_degree = np.bincount(indices, minlength=n).astype(np.int64)
+
+    # caches
+    self._layout_version = 0
+    self._slots_cache: Tuple[int, NDArray] = (-1, np.zeros((0, ), dtype=np.int64))
+    self._csr_cache: Tuple[int, Optional[Tuple[NDArray, NDArray]]] = (-1, None)
+    self._nx_cache: Tuple[int, Optional[nx.DiGraph]] = (-1, None)
+
+    capacity = self.out_degree + slack
+    self.offset = np.zeros((n, ), dtype=np.int64)
+    np.cumsum(capacity[:-1], out=self.offset[1:])
+    self.storage = np.full((int(np.sum(capacity)), ), -1, dtype=np.int64)
+    self.storage[self._slots()] = indices
+
+  @staticmethod
+  def from_networkx(graph: nx.DiGraph, num_nodes: Optional[int] = None, slack: int = 2):
+    n = num_nodes if num_nodes is not None else graph.number_of_nodes()
+    indptr, indices = graph_to_csr(graph, n)
+    return FollowGraph(n, indptr, indices, slack=slack)
+
+  @property
+  def number_of_edges(self) -> int:
+    return int(np.sum(self.out_degree))
+
+  def _row_slots(self, rows: NDArray, lens: NDArray):
+    # storage positions of the valid slots of the given rows, with the index
+    # of the row each position belongs to
+    rep = np.repeat(np.arange(rows.size), lens)
+    local = np.arange(rep.size) - np.repeat(np.cumsum(lens) - lens, lens)
+    return self.offset[rows][rep] + local, rep
+
+  def _slots(self) -> NDArray:
+    version, slots = self._slots_cache
+    if version != self._layout_version:
+      slots, _ = self._row_slots(np.arange(self.num_nodes), self.out_degree)
+      self._slots_cache = (self._layout_version, slots)
+    return slots
+
+  def _mutated(self, layout: bool = False):
+    self.version += 1
+    if layout:
+      self._layout_version += 1
+
+  def successors(self, u: int) -> NDArray:
+    return self.storage[self.offset[u]: self.offset[u] + self.out_degree[u]]
+
+  def has_edge(self, u: int, v: int) -> bool:
+    return bool(np.any(self.successors(u) == v))
+
+  def find_edges(self, src: NDArray, dst: NDArray) -> NDArray:
+    """Storage positions of edges (src, dst), -1 if not present."""
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    pos, rep = self._row_slots(src, self.out_degree[src])
+    hit = self.storage[pos] == dst[rep]
+    ret = np.full((src.size, ), -1, dtype=np.int64)
+    ret[rep[hit]] = pos[hit]
+    return ret
+
+  def rewire(self, src: NDArray, unfollow: NDArray, follow: NDArray) -> NDArray:
+    """Swap edges (src, unfollow) for (src, follow) in a batch, returns the
+    storage positions of the swapped edges."""
+    src = np.asarray(src, dtype=np.int64)
+    if src.size == 0:
+      return np.zeros((0, ), dtype=np.int64)
+    pos = self.find_edges(src, unfollow)
+    if np.any(pos < 0):
+      raise ValueError('Unfollowing a non-existent edge.')
+    self.storage[pos] = follow
+    np.subtract.at(self.in_degree, unfollow, 1)
+    np.add.at(self.in_degree, follow, 1)
+    self._mutated()
+    return pos
+
+  def add_edge(self, u: int, v: int):
+    self.add_edges(np.array([u]), np.array([v]))
+
+  def add_edges(self, src: NDArray, dst: NDArray):
+    """Append edges (src, dst) to their rows in a batch."""
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    if src.size == 0:
+      return
+    count = np.bincount(src, minlength=self.num_nodes)
+    if np.any(self.out_degree + count > self._capacity()):
+      self._grow(count)
+    # rank of each edge among the added edges of its row
+    order = np.argsort(src, kind='stable')
+    start = np.cumsum(count) - count
+    rank = np.empty_like(order)
+    rank[order] = np.arange(src.size) - start[src[order]]
+    self.storage[self.offset[src] + self.out_degree[src] + rank] = dst
+    self.out_degree += count
+    np.add.at(self.in_degree, dst, 1)
+    self._mutated(layout=True)
+
+  def remove_edge(self, u: int, v: int):
+    if self.find_edges(np.array([u]), np.array([v]))[0] < 0:
+      raise ValueError(f'Edge ({u}, {v}) does not exist.')
+    self.remove_edges(np.array([u]), np.array([v]))
+
+  def remove_edges(self, src: NDArray, dst: NDArray):
+    """Remove edges (src, dst) in a batch, the remaining edges of each row
+    keep their order."""
+    src = np.asarray(src, dtype=np.int64)
+    if src.size == 0:
+      return
+    pos = self.find_edges(src, dst)
+    if np.any(pos < 0):
+      raise ValueError('Removing a non-existent edge.')
+    rows = np.unique(src)
+    # offsets increase with the row, so the slots are sorted
+    slots, rep = self._row_slots(rows, self.out_degree[rows])
+    keep = np.ones((slots.size, ), dtype=bool)
+    keep[np.searchsorted(slots, pos)] = False
+    values = self.storage[slots[keep]]
+    self.storage[slots] = -1
+    self.out_degree[rows] = np.bincount(rep[keep], minlength=rows.size)
+    self.storage[self._row_slots(rows, self.out_degree[rows])[0]] = values
+    np.subtract.at(self.in_degree, np.asarray(dst, dtype=np.int64), 1)
+    self._mutated(layout=True)
+
+  def _capacity(self) -> NDArray:
+    return np.append(self.offset[1:], self.storage.size) - self.offset
+
+  def _grow(self, count: NDArray):
+    # re-layout all rows with room for `count` more edges each and half their
+    # degree as free slots, so repeated growth stays amortized
+    indptr, indices = self.csr()
+    need = self.out_degree + count
+    capacity = np.maximum(self._capacity(), need + np.maximum(need // 2, self.slack))
+    self.offset[1:] = np.cumsum(capacity[:-1])
+    self.storage = np.full((int(np.sum(capacity)), ), -1, dtype=np.int64)
+    self._layout_version += 1
+    self.storage[self._slots()] = indices
+
+  def csr(self) -> Tuple[NDArray, NDArray]:
+    """Compact (indptr, indices) view of the out-adjacency."""
+    version, csr = self._csr_cache
+    if version != self.version or csr is None:
+      indptr = np.zeros((self.num_nodes + 1, ), dtype=np.int64)
+      np.cumsum(self.out_degree, out=indptr[1:])
+      csr = (indptr, self.storage[self._slots()])
+      self._csr_cache = (self.version, csr)
+    return csr
+
+  def edges(self) -> NDArray:
+    indptr, indices = self.csr()
+    src = np.repeat(np.arange(self.num_nodes), np.diff(indptr))
+    return np.stack([src, indices], axis=1)
+
+  def to_networkx(self) -> nx.DiGraph:
+    version, graph = self._nx_cache
+    if version != self.version or graph is None:
+      graph = nx.DiGraph()
+      graph.add_nodes_from(range(self.num_nodes))
+      graph.add_edges_from(self.edges().tolist())
+      self._nx_cache = (self.version, graph)
+    return graph
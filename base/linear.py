@@ -0,0 +1,62 @@
+from typing import Optional
+from numpy.typing import NDArray
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+
+def linear_phase_map(
+    opinion: NDArray,
+    edges: NDArray,
+    tolerance: float,
+    decay: float,
+    recommends: bool,
+) -> Optional[sp.csr_matrix]:
+  """Matrix `W` with `x(t + 1) = W x(t)` for all following steps, or None.
+
+  Opinions of a weakly connected component of the concordant graph stay
+  within the hull of the component. If no hull is wider than the tolerance,
+  the hulls of agents followed discordantly are farther apart than it and,
+  when agents get recommendations, no agent but its concordant neighbors
+  may come within tolerance of it, no pair of agents can change its
+  concordance and no rewiring can happen, so the HK update stays linear.
+  """
+  n = opinion.size
+  src, dst = edges.T
+  concordant = np.abs(opinion[dst] - opinion[src]) <= tolerance
+  s_c, d_c = src[concordant], dst[concordant]
+
+  # hulls of the concordant components
+  adj = sp.csr_matrix((np.ones(s_c.size), (s_c, d_c)), shape=(n, n))
+  count, label = connected_components(adj, directed=True, connection='weak')
+  lo = np.full((count, ), np.inf)
+  hi = np.full((count, ), -np.inf)
+  np.minimum.at(lo, label, opinion)
+  np.maximum.at(hi, label, opinion)
+  if np.any(hi - lo > tolerance):
+    return None
+  lo, hi = lo[label], hi[label]
+
+  # discordant edges stay discordant
+  s_d, d_d = src[~concordant], dst[~concordant]
+  gap = np.maximum(lo[d_d] - hi[s_d], lo[s_d] - hi[d_d])
+  if np.any(gap <= tolerance):
+    return None
+
+  # recommendations stay discordant
+  if recommends:
+    lo_sorted = np.sort(lo)
+    hi_sorted = np.sort(hi)
+    near = n - np.searchsorted(hi_sorted, lo - tolerance, 'left') - \
+        (n - np.searchsorted(lo_sorted, hi + tolerance, 'right'))
+    distinct = np.unique(s_c * n + d_c) // n
+    if np.any(near > 1 + np.bincount(distinct, minlength=n)):
+      return None
+
+  # x_i + decay * mean(x_j - x_i) over the concordant neighbors
+  n_concordant = np.bincount(s_c, minlength=n)
+  weight = decay / np.maximum(n_concordant, 1)
+  self_weight = 1 - decay * (n_concordant > 0)
+  return (sp.csr_matrix((weight[s_c], (s_c, d_c)), shape=(n, n))
+          + sp.diags(self_weight, dtype=float)).tocsr()
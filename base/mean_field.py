@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+from numpy.typing import NDArray
+
+import numpy as np
+
+if TYPE_CHECKING:
+  from base.model import HKModel
+
+
+def mean_field_step(opinion: NDArray, tolerance: float, decay: float) -> NDArray:
+  """Synchronous HK step on the complete graph in O(N log N).
+
+  The concordant window of each agent is found by binary search in the
+  sorted opinions and its mean is taken from prefix sums. The prefix sums
+  are centered on the mean opinion to limit cancellation.
+  """
+  order = np.argsort(opinion, kind='stable')
+  o = opinion[order]
+  centered = o - np.mean(o)
+  prefix = np.concatenate(([0.], np.cumsum(centered)))
+  lo = np.searchsorted(o, o - tolerance, 'left')
+  hi = np.searchsorted(o, o + tolerance, 'right')
+
+  # the agent itself is in its window and adds nothing to the sum
+  count = hi - lo - 1
+  diff_sum = prefix[hi] - prefix[lo] - (hi - lo) * centered
+  next_sorted = o + np.where(
+      count > 0, diff_sum / np.maximum(count, 1) * decay, 0)
+
+  ret = np.empty_like(next_sorted)
+  ret[order] = next_sorted
+  return ret
+
+
+class MeanFieldEngine:
+  """Classic HK model where every agent follows all others.
+
+  Neither the complete graph nor agent objects are built, so only model
+  stats are available. With every agent followed, nothing is left to
+  recommend and no rewiring can happen.
+  """
+
+  def __init__(self, model: HKModel, opinion: NDArray):
+    self.model = model
+    self.opinion = np.array(opinion, dtype=float)
+    self.num_nodes = self.opinion.size
+
+  def step(self):
+    model = self.model
+    next_opinion = mean_field_step(self.opinion, model.p.tolerance, model.p.decay)
+    changed_opinion_max = float(np.max(
+        np.abs(next_opinion - self.opinion), initial=0))
+    self.opinion[:] = next_opinion
+    model._advance_time()
+    model.cur_step += 1
+    return 0, changed_opinion_max
+
+  def is_absorbing(self, error: float = 0) -> bool:
+    # all agents within tolerance of each other agree
+    o = np.sort(self.opinion)
+    lo = np.searchsorted(o, o - self.model.p.tolerance, 'left')
+    hi = np.searchsorted(o, o + self.model.p.tolerance, 'right')
+    return not np.any(o[hi - 1] - o[lo] > error)
@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, List, Optional, Callable, Union, Iterable, Dict, Any, Set
+from typing import TYPE_CHECKING, List, Optional, Callable, Union, Iterable, Dict, Any, Set, Tuple
 from numpy.typing import NDArray
 
 import numpy as np
@@ -11,6 +11,12 @@ from mesa.space import NetworkGrid
 import dataclasses
 
 from base.agent import HKAgent
+from base.vectorized import VectorizedEngine
+from base.parallel import ParallelEngine
+from base.partition import PartitionedEngine
+from base.mean_field import MeanFieldEngine
+from utils.rng import SeedType, create_rng, derive_seed, spawn_rng
+from utils.noise import NoisePrefetcher
 
 if TYPE_CHECKING:
   from base.recsys import HKModelRecommendationSystem
@@ -20,40 +26,127 @@ class HKModel(Model):
 
   def __init__(
       self,
-      graph: nx.DiGraph,
+      graph: Optional[nx.DiGraph],
       opinion: Union[None, Iterable[float], NDArray, Dict[int, float]],
       params: 'HKModelParams' = None,
       collect: Optional[Set[str]] = None,
       event_logger: Optional[Callable[[Any], None]] = None,
       dump_data: Optional[Any] = None,
+      rng: SeedType = None,
   ):
     super().__init__()
 
+    # all randomness of the model, its agents and recsys comes from `rng`;
+    # mesa's own generator (activation order) is seeded from it as well
+    self.rng = create_rng(rng)
+    self.reset_randomizer(derive_seed(self.rng))
+
     params = params if params is not None else HKModelParams()
+    if graph is None and opinion is None:
+      # the number of agents is only known from one of them
+      raise ValueError('Either the graph or the opinions must be given.')
     opinion = opinion if opinion is not None else \
-        np.random.uniform(-1, 1, (graph.number_of_nodes(), ))
-    self.graph = graph
+        self.rng.uniform(-1, 1, (graph.number_of_nodes(), ))
     self.p = params
+
+    # prefetched noise of the recsys, in the order it was first drawn
+    self.noise_sources: List[NoisePrefetcher] = []
+    self._noise_states: List[Dict[str, Any]] = []
+
+    # the mean-field engine needs neither the graph nor agents
+    if params.engine == 'mean_field':
+      if params.recsys_factory or collect:
+        raise ValueError(
+            'The mean-field engine has no recommendation system or agents.')
+      n = len(opinion) if graph is None else graph.number_of_nodes()
+      self.recsys = None
+      self.collect = set()
+      self.event_logger = event_logger
+      self.cur_step = 0
+      self._graph = graph
+      self.grid = None
+      self.schedule = RandomActivation(self)
+      self.engine = MeanFieldEngine(
+          self, opinion if not isinstance(opinion, dict) else
+          [opinion[i] for i in range(n)])
+      return
+
     self.recsys = params.recsys_factory(
         self) if params.recsys_factory else None
     self.collect = collect or set()
 
     self.event_logger = event_logger
 
+    if params.engine not in ('mesa', 'vectorized', 'parallel', 'partitioned', 'mean_field'):
+      raise ValueError(f'Unknown engine: {params.engine}')
+    use_grid = params.engine == 'mesa'
+
     self.cur_step = 0
-    self.grid = NetworkGrid(self.graph)
+    self._graph = graph if use_grid else None
+    self.grid = NetworkGrid(graph) if use_grid else None
     self.schedule = RandomActivation(self)
-    for node in self.graph.nodes():
+    for node in graph.nodes():
       a = HKAgent(node, self, opinion[node])
-      self.grid.place_agent(a, node)
+      if use_grid:
+        self.grid.place_agent(a, node)
       self.schedule.add(a)
+
+    # the array-backed engine owns the follow graph,
+    # networkx graphs are only exported on demand
+    self.engine: Optional[VectorizedEngine] = None
+    if params.engine == 'vectorized':
+      self.engine = VectorizedEngine(self, graph)
+    elif params.engine == 'parallel':
+      self.engine = ParallelEngine(self, graph, params.workers)
+    elif params.engine == 'partitioned':
+      self.engine = PartitionedEngine(self, graph, params.workers)
+
     if self.recsys:
       self.recsys.post_init(dump_data)
 
+  @property
+  def graph(self) -> nx.DiGraph:
+    if isinstance(self.engine, MeanFieldEngine):
+      # the complete graph is not built, only its nodes
+      if self._graph is None:
+        self._graph = nx.empty_graph(self.engine.num_nodes, nx.DiGraph)
+      return self._graph
+    if self.engine is not None:
+      return self.engine.graph.to_networkx()
+    return self._graph
+
   def dump(self):
-    return self.recsys.dump()
+    return self.recsys.dump() if self.recsys else None
+
+  def noise_source(self, method: str, *args) -> NoisePrefetcher:
+    # each source draws from its own child stream of `rng`
+    state = self._noise_states[len(self.noise_sources)] \
+        if len(self._noise_states) > len(self.noise_sources) else None
+    source = NoisePrefetcher(
+        spawn_rng(self.rng, 1)[0], method, args, state=state)
+    self.noise_sources.append(source)
+    return source
+
+  def get_noise_state(self) -> List[Dict[str, Any]]:
+    return [s.state for s in self.noise_sources]
+
+  def set_noise_state(self, states: List[Dict[str, Any]]):
+    # applied to the sources when they are created on the first step
+    self._noise_states = list(states)
+
+  def set_activation_order(self, order: Iterable[int]):
+    # the scheduler shuffles its agents in place, so the order matters
+    # when resuming a dumped model
+    agents = {a.unique_id: a for a in self.schedule.agents}
+    for a in agents.values():
+      self.schedule.remove(a)
+    for i in order:
+      self.schedule.add(agents[i])
 
   def step(self):
+    if self.engine is not None:
+      return self.engine.step()
+
     agents: List['HKAgent'] = self.schedule.agents
     # let agents execute operations
     if self.recsys:
@@ -86,6 +179,72 @@ class HKModel(Model):
     self.cur_step += 1
     return changed_count, changed_opinion_max
 
+  def get_opinion(self) -> NDArray:
+    # current opinions by agent id
+    if self.engine is not None:
+      return self.engine.opinion.copy()
+    opinion = np.zeros((self.graph.number_of_nodes(), ))
+    for a in self.schedule.agents:
+      opinion[a.unique_id] = a.cur_opinion
+    return opinion
+
+  def get_state(self) -> Tuple[NDArray, NDArray]:
+    # opinions by agent id and follow edges as an (n_edges, 2) array
+    if self.engine is not None:
+      return self.get_opinion(), self.engine.graph.edges()
+    edges = np.array(list(self.graph.edges()), dtype=int).reshape((-1, 2))
+    return self.get_opinion(), edges
+
+  def set_opinion(self, opinion: NDArray):
+    if self.engine is not None:
+      self.engine.opinion[:] = opinion
+    if isinstance(self.engine, VectorizedEngine):
+      self.engine.active[:] = self.engine.hot[:] = True
+      if self.engine.clusters is not None:
+        self.engine.clusters.clear()
+    for a in self.schedule.agents:
+      a.cur_opinion = a.next_opinion = opinion[a.unique_id]
+
+  def close(self):
+    # release the threads and processes of the engine and the noise sources
+    if isinstance(self.engine, VectorizedEngine):
+      self.engine.close()
+    for source in self.noise_sources:
+      source.close()
+
+  def skip_steps(self, count: int):
+    # advance the step counters over steps computed outside of the model
+    for _ in range(count):
+      self._advance_time()
+    self.cur_step += count
+
+  def is_absorbing(self, error: float = 0) -> bool:
+    """Whether no edge can be rewired and no opinion can change by more
+    than `error` anymore, whatever agents get recommended."""
+    if isinstance(self.engine, MeanFieldEngine):
+      return self.engine.is_absorbing(error)
+    opinion, edges = self.get_state()
+    src, dst = edges.T
+    diff = np.abs(opinion[dst] - opinion[src])
+    concordant = diff <= self.p.tolerance
+
+    # concordant neighbors agree
+    if np.any(diff[concordant] > error):
+      return False
+    if not self.recsys or self.p.recsys_count < 1:
+      return True
+
+    # any agent may be recommended, so all agents within tolerance agree,
+    # and no agent with a discordant neighbor has a concordant agent to follow
+    o = np.sort(opinion)
+    lo = np.searchsorted(o, opinion - self.p.tolerance, 'left')
+    hi = np.searchsorted(o, opinion + self.p.tolerance, 'right')
+    if np.any(o[hi - 1] - o[lo] > error):
+      return False
+    has_discordant = np.bincount(
+        src[~concordant], minlength=opinion.size) > 0
+    return not np.any(has_discordant & (hi - lo > 1))
+
   def get_recommendation(self, agent: HKAgent, neighbors: Optional[List[HKAgent]] = None) -> List[HKAgent]:
     if not self.recsys:
       return []
@@ -109,6 +268,27 @@ class HKModelParams:
   
   tweet_retain_count: int = 3
 
+  # 'mesa' steps every agent object, 'vectorized' steps all agents at once,
+  # 'parallel' does so on `workers` threads and 'partitioned' on `workers`
+  # processes, each owning a part of the graph (0 for all cores);
+  # 'mean_field' runs the classic model on the complete graph
+  engine: str = 'mesa'
+  workers: int = 0
+  # the 'vectorized' and 'parallel' engines only step agents whose
+  # neighborhood changed more than this; None steps all agents
+  active_threshold: Optional[float] = None
+  # the same engines merge isolated clusters of agents whose opinions agree
+  # to within this into super-nodes every `coarse_interval` steps; members
+  # stop moving, so keep it below the `opinion_change_error` of a scenario
+  coarse_error: Optional[float] = None
+  coarse_interval: int = 20
+  # the same engines keep the concordance of the follow edges and the
+  # neighbor sums up to date incrementally instead of rescanning all edges
+  incremental: bool = False
+  # recommendation systems draw their noise for the next steps in the
+  # background from separate streams instead of from `rng` in each step
+  prefetch_noise: bool = False
+
   def to_dict(self) -> Dict[str, Any]:
     ret = dataclasses.asdict(self)
     del ret['recsys_factory']
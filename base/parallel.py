@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Optional, Union
+from numpy.typing import NDArray
+
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import numba
+import numpy as np
+import networkx as nx
+
+from base.vectorized import HKStepResult, VectorizedEngine
+
+if TYPE_CHECKING:
+  from base.model import HKModel
+
+
+@numba.njit(nogil=True)
+def _hk_step_rows(
+    lo: int,
+    hi: int,
+    opinion: NDArray,
+    indptr: NDArray,
+    indices: NDArray,
+    recommended: NDArray,
+    tolerance: NDArray,
+    decay: NDArray,
+    rewiring_rate: NDArray,
+    rnd: NDArray,
+    # outputs
+    next_opinion: NDArray,
+    nr_agents: NDArray,
+    op_sum_agents: NDArray,
+    follow: NDArray,
+    follow_edge: NDArray,
+):
+  for i in range(lo, hi):
+    o = opinion[i]
+    tol = tolerance[i]
+    n_cn = 0
+    n_dn = 0
+    sum_n = 0.
+    sum_nd = 0.
+    for e in range(indptr[i], indptr[i + 1]):
+      d = opinion[indices[e]] - o
+      if abs(d) <= tol:
+        n_cn += 1
+        sum_n += d
+      else:
+        n_dn += 1
+        sum_nd += d
+
+    n_cr = 0
+    n_dr = 0
+    sum_r = 0.
+    sum_rd = 0.
+    for j in range(recommended.shape[1]):
+      r = recommended[i, j]
+      if r < 0:
+        continue
+      d = opinion[r] - o
+      if abs(d) <= tol:
+        n_cr += 1
+        sum_r += d
+      else:
+        n_dr += 1
+        sum_rd += d
+
+    n_concordant = n_cn + n_cr
+    next_opinion[i] = o
+    if n_concordant > 0:
+      next_opinion[i] = o + (sum_n + sum_r) / n_concordant * decay[i]
+
+    nr_agents[i, 0] = n_cn
+    nr_agents[i, 1] = n_cr
+    nr_agents[i, 2] = n_dn
+    nr_agents[i, 3] = n_dr
+    op_sum_agents[i, 0] = sum_n
+    op_sum_agents[i, 1] = sum_r
+    op_sum_agents[i, 2] = sum_nd
+    op_sum_agents[i, 3] = sum_rd
+
+    follow[i, 0] = -1
+    follow[i, 1] = -1
+    follow_edge[i] = -1
+    if n_dn == 0 or n_cr == 0 or rnd[i, 0] >= rewiring_rate[i]:
+      continue
+    # same picks as `hk_step_kernel`
+    k_f = int(rnd[i, 1] * n_cr)
+    for j in range(recommended.shape[1]):
+      r = recommended[i, j]
+      if r >= 0 and abs(opinion[r] - o) <= tol:
+        if k_f == 0:
+          follow[i, 1] = r
+          break
+        k_f -= 1
+    k_u = int(rnd[i, 2] * n_dn)
+    for e in range(indptr[i], indptr[i + 1]):
+      if abs(opinion[indices[e]] - o) > tol:
+        if k_u == 0:
+          follow[i, 0] = indices[e]
+          follow_edge[i] = e
+          break
+        k_u -= 1
+
+
+def split_rows(indptr: NDArray, count: int) -> NDArray:
+  """Row boundaries of `count` blocks with about the same number of edges."""
+  n = indptr.size - 1
+  # weigh rows by their edges plus a constant for the per-row work
+  work = indptr + np.arange(n + 1)
+  bounds = np.searchsorted(work, np.linspace(0, work[-1], count + 1))
+  bounds[0], bounds[-1] = 0, n
+  return np.unique(bounds)
+
+
+def _per_node(value: Union[float, NDArray], n: int) -> NDArray:
+  return np.ascontiguousarray(np.broadcast_to(
+      np.asarray(value, dtype=float), (n, )))
+
+
+class ParallelStepKernel:
+  """Multi-threaded drop-in for `hk_step_kernel`.
+
+  Rows are split into blocks that are processed by a compiled kernel
+  releasing the GIL. Each agent only reads the shared state and writes its
+  own output row, and the random samples are drawn up front, so results do
+  not depend on the number of workers.
+  """
+
+  def __init__(self, workers: int = 0):
+    self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+    self.executor: Optional[ThreadPoolExecutor] = None
+    if self.workers > 1:
+      self.executor = ThreadPoolExecutor(self.workers)
+      # stop the threads with the kernel if `shutdown` is never called
+      weakref.finalize(self, self.executor.shutdown, wait=False)
+
+  def __call__(
+      self,
+      opinion: NDArray,
+      indptr: NDArray,
+      indices: NDArray,
+      recommended: NDArray,
+      tolerance: Union[float, NDArray],
+      decay: Union[float, NDArray],
+      rewiring_rate: Union[float, NDArray],
+      rnd: NDArray,
+  ) -> HKStepResult:
+    n = opinion.size
+    args = (
+        np.ascontiguousarray(opinion, dtype=float),
+        np.ascontiguousarray(indptr, dtype=np.int64),
+        np.ascontiguousarray(indices, dtype=np.int64),
+        np.ascontiguousarray(recommended, dtype=np.int64).reshape((n, -1)),
+        _per_node(tolerance, n),
+        _per_node(decay, n),
+        _per_node(rewiring_rate, n),
+        np.ascontiguousarray(rnd, dtype=float),
+    )
+    res = HKStepResult(
+        next_opinion=np.empty((n, ), dtype=float),
+        nr_agents=np.empty((n, 4), dtype=np.int64),
+        op_sum_agents=np.empty((n, 4), dtype=float),
+        follow=np.empty((n, 2), dtype=np.int64),
+        follow_edge=np.empty((n, ), dtype=np.int64),
+    )
+    outputs = (
+        res.next_opinion, res.nr_agents, res.op_sum_agents,
+        res.follow, res.follow_edge,
+    )
+
+    if self.executor is None:
+      _hk_step_rows(0, n, *args, *outputs)
+      return res
+
+    # a few blocks per worker to even out the load
+    bounds = split_rows(args[1], self.workers * 4)
+    futures = [
+        self.executor.submit(_hk_step_rows, lo, hi, *args, *outputs)
+        for lo, hi in zip(bounds[:-1], bounds[1:])
+    ]
+    for f in futures:
+      f.result()
+    return res
+
+  def shutdown(self):
+    if self.executor is not None:
+      self.executor.shutdown()
+      self.executor = None
+
+
+class ParallelEngine(VectorizedEngine):
+  """Vectorized engine stepping agents on several threads.
+
+  Rewirings are committed by the base engine in agent order, so the
+  trajectory is the same for any number of workers.
+  """
+
+  def __init__(self, model: HKModel, graph: nx.DiGraph, workers: int = 0):
+    super().__init__(model, graph)
+    self.kernel = ParallelStepKernel(workers)
+
+  def close(self):
+    self.kernel.shutdown()
@@ -0,0 +1,427 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Protocol, Tuple
+from numpy.typing import NDArray
+
+import dataclasses
+import multiprocessing as mp
+import traceback
+import weakref
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import networkx as nx
+
+from base.parallel import _hk_step_rows, split_rows
+from base.recsys import fill_rows
+from base.vectorized import HKStepResult, VectorizedEngine
+from utils.rng import SeedType, create_rng, spawn_rng
+
+if TYPE_CHECKING:
+  from base.model import HKModel, HKModelParams
+
+
+class PartitionProvider(Protocol):
+
+  def generate_partition(
+      self,
+      lo: int,
+      hi: int,
+      rng: np.random.Generator,
+  ) -> Tuple[NDArray, NDArray, NDArray]:
+    """Out-edges (local indptr, global indices) and opinions of nodes
+    `lo` to `hi`, generated without the rest of the graph."""
+    pass
+
+
+BufferSpec = Tuple[str, Tuple[int, ...], str]
+
+
+def _create_buffer(shape: Tuple[int, ...], dtype) -> Tuple[SharedMemory, NDArray]:
+  dtype = np.dtype(dtype)
+  size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+  shm = SharedMemory(create=True, size=size)
+  return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _attach_buffer(spec: BufferSpec) -> Tuple[SharedMemory, NDArray]:
+  name, shape, dtype = spec
+  shm = SharedMemory(name=name)
+  return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+@dataclasses.dataclass
+class PartitionSpec:
+  lo: int
+  hi: int
+  num_nodes: int
+  buffers: Dict[str, BufferSpec]
+
+  tolerance: float
+  decay: float
+  rewiring_rate: float
+  recsys_count: int
+
+  rng: np.random.Generator
+  # either the piece of the graph or a provider generating it
+  piece: Optional[Tuple[NDArray, NDArray]] = None
+  provider: Optional[PartitionProvider] = None
+
+
+class _Partition:
+  """State of one worker: the out-edges of its own nodes.
+
+  Opinions of all other nodes it reads (neighbors and recommended, the
+  ghosts) are gathered from the shared opinion buffer at each step.
+  """
+
+  def __init__(self, spec: PartitionSpec):
+    self.lo, self.hi = lo, hi = spec.lo, spec.hi
+    self.n = spec.num_nodes
+    self.m = m = hi - lo
+    self.rng = spec.rng
+    self.recsys_count = spec.recsys_count
+
+    self.shm: List[SharedMemory] = []
+    self.buf: Dict[str, NDArray] = {}
+    for k, v in spec.buffers.items():
+      shm, self.buf[k] = _attach_buffer(v)
+      self.shm.append(shm)
+
+    if spec.piece is not None:
+      self.indptr, self.indices = spec.piece
+    else:
+      self.indptr, self.indices, opinion = spec.provider.generate_partition(
+          lo, hi, self.rng)
+      self.buf['opinion'][0, lo:hi] = opinion
+    self.indptr = np.ascontiguousarray(self.indptr, dtype=np.int64)
+    self.indices = np.ascontiguousarray(self.indices, dtype=np.int64)
+
+    self.tolerance = np.full((m, ), spec.tolerance)
+    self.decay = np.full((m, ), spec.decay)
+    self.rewiring_rate = np.full((m, ), spec.rewiring_rate)
+    self.follow_edge = np.full((m, ), -1, dtype=np.int64)
+
+    # dense lookup of local ids, own nodes first and then the ghosts
+    self.local_id = np.full((self.n, ), -1, dtype=np.int64)
+    self.local_id[lo: hi] = np.arange(m)
+    self.is_ghost = np.zeros((self.n, ), dtype=bool)
+
+  def recommend(self) -> NDArray:
+    if 'recommended' in self.buf:
+      return self.buf['recommended'][self.lo: self.hi]
+    # partition-local random recommendation as by `Random`: distinct nodes
+    # neither the node itself nor followed by it
+    m, n = self.m, self.n
+    candidates = np.sort(
+        self.rng.integers(0, n, (m, self.recsys_count)), axis=1).flatten()
+    rows = np.repeat(np.arange(m), self.recsys_count)
+    keys = np.sort(np.repeat(np.arange(m), np.diff(self.indptr)) * n + self.indices)
+    c_keys = rows * n + candidates
+    pos = np.minimum(np.searchsorted(keys, c_keys), max(keys.size - 1, 0))
+    keep = candidates != rows + self.lo
+    if keys.size:
+      keep &= keys[pos] != c_keys
+    keep[1:] &= (candidates[1:] != candidates[:-1]) | (rows[1:] != rows[:-1])
+    return fill_rows(rows[keep], candidates[keep], self.recsys_count, m)
+
+  def count_in_degree(self):
+    # only called by one worker at a time
+    u, c = np.unique(self.indices, return_counts=True)
+    self.buf['in_degree'][u] += c
+
+  def step(self, cur: int) -> Tuple[int, float]:
+    lo, hi, m = self.lo, self.hi, self.m
+    opinion = self.buf['opinion'][cur]
+    recommended = self.recommend()
+    rnd = self.buf['rnd'][lo: hi] if 'rnd' in self.buf else \
+        self.rng.uniform(size=(m, 3))
+
+    # gather ghosts and map node ids into [own nodes, ghosts]
+    def remote(x: NDArray) -> NDArray:
+      return x[(x >= 0) & ((x < lo) | (x >= hi))]
+    self.is_ghost[remote(self.indices)] = True
+    self.is_ghost[remote(recommended.flatten())] = True
+    ghosts = np.flatnonzero(self.is_ghost)
+    self.is_ghost[ghosts] = False
+    self.local_id[ghosts] = m + np.arange(ghosts.size)
+    local_opinion = np.concatenate([opinion[lo: hi], opinion[ghosts]])
+
+    def to_local(x: NDArray) -> NDArray:
+      return np.where(x < 0, -1, self.local_id[x])
+
+    follow = np.empty((m, 2), dtype=np.int64)
+    next_opinion = self.buf['opinion'][1 - cur, lo: hi]
+    _hk_step_rows(
+        0, m, local_opinion,
+        self.indptr, to_local(self.indices), to_local(recommended),
+        self.tolerance, self.decay, self.rewiring_rate, rnd,
+        next_opinion,
+        self.buf['nr_agents'][lo: hi],
+        self.buf['op_sum_agents'][lo: hi],
+        follow, self.follow_edge,
+    )
+
+    # publish the proposed rewirings, nothing is mutated before commit
+    node_ids = np.concatenate([np.arange(lo, hi), ghosts])
+    self.buf['follow'][lo: hi] = np.where(follow >= 0, node_ids[follow], -1)
+    changed_max = float(np.max(
+        np.abs(next_opinion - opinion[lo: hi]), initial=0))
+    return int(np.sum(follow[:, 0] >= 0)), changed_max
+
+  def commit(self):
+    lo, hi = self.lo, self.hi
+    follow = self.buf['follow']
+    # own side: swap the out-edges of own nodes
+    rewired = self.follow_edge >= 0
+    self.indices[self.follow_edge[rewired]] = follow[lo: hi][rewired, 1]
+    # remote side: in-degrees of own nodes rewired by any partition
+    in_degree = self.buf['in_degree']
+    unfollow, f = follow[follow[:, 0] >= 0].T
+    np.subtract.at(in_degree, unfollow[(unfollow >= lo) & (unfollow < hi)], 1)
+    np.add.at(in_degree, f[(f >= lo) & (f < hi)], 1)
+
+  def edges(self) -> Tuple[NDArray, NDArray]:
+    src = np.repeat(np.arange(self.lo, self.hi), np.diff(self.indptr))
+    return src, self.indices.copy()
+
+  def close(self):
+    self.buf.clear()
+    for shm in self.shm:
+      shm.close()
+
+
+def _partition_worker(conn: Connection, spec: PartitionSpec):
+  part: Optional[_Partition] = None
+  try:
+    part = _Partition(spec)
+    conn.send((True, None))
+    while True:
+      cmd, args = conn.recv()
+      if cmd == 'close':
+        break
+      conn.send((True, getattr(part, cmd)(*args)))
+  except Exception:
+    conn.send((False, traceback.format_exc()))
+  finally:
+    if part is not None:
+      part.close()
+    conn.close()
+
+
+def _shutdown(processes: List[mp.Process], conns: List[Connection], shm: List[SharedMemory]):
+  for c in conns:
+    try:
+      c.send(('close', ()))
+    except (BrokenPipeError, OSError):
+      pass
+  for p in processes:
+    p.join(5)
+    if p.is_alive():
+      p.terminate()
+  for s in shm:
+    s.close()
+    s.unlink()
+
+
+class PartitionPool:
+  """Local worker processes, each owning the out-edges of a node range.
+
+  Opinions live in a double buffered shared array; each step, a worker
+  reads the current buffer, including its ghosts, and writes the next
+  opinions of its own nodes. Rewirings are applied with a two phase commit:
+  `step` only publishes the proposals of all partitions, and `commit` lets
+  every partition apply the parts it owns, i.e. the swapped out-edges of
+  its nodes and the in-degrees of its nodes followed or unfollowed from
+  other partitions.
+
+  If `recommended` and `rnd` are not given to `step`, workers recommend
+  uniformly random nodes and draw samples from their own streams, so the
+  main process never holds more than a few arrays of length N.
+  """
+
+  def __init__(
+      self,
+      num_nodes: int,
+      bounds: NDArray,
+      params: HKModelParams,
+      rng: SeedType = None,
+      pieces: Optional[List[Tuple[NDArray, NDArray]]] = None,
+      provider: Optional[PartitionProvider] = None,
+      shared_inputs: bool = False,
+  ):
+    self.num_nodes = n = num_nodes
+    self.bounds = bounds
+    self.num_parts = len(bounds) - 1
+    self.cur = 0
+
+    shapes: Dict[str, Tuple[Tuple[int, ...], Any]] = dict(
+        opinion=((2, n), float),
+        in_degree=((n, ), np.int64),
+        nr_agents=((n, 4), np.int64),
+        op_sum_agents=((n, 4), float),
+        follow=((n, 2), np.int64),
+    )
+    if shared_inputs:
+      shapes['recommended'] = ((n, params.recsys_count), np.int64)
+      shapes['rnd'] = ((n, 3), float)
+
+    self.buf: Dict[str, NDArray] = {}
+    self._shm: List[SharedMemory] = []
+    specs: Dict[str, BufferSpec] = {}
+    for k, (shape, dtype) in shapes.items():
+      shm, self.buf[k] = _create_buffer(shape, dtype)
+      self.buf[k].fill(0)
+      self._shm.append(shm)
+      specs[k] = (shm.name, shape, np.dtype(dtype).str)
+
+    self._conns: List[Connection] = []
+    self._processes: List[mp.Process] = []
+    self._finalizer = weakref.finalize(
+        self, _shutdown, self._processes, self._conns, self._shm)
+
+    rngs = spawn_rng(create_rng(rng), self.num_parts)
+    for i in range(self.num_parts):
+      spec = PartitionSpec(
+          lo=int(bounds[i]), hi=int(bounds[i + 1]), num_nodes=n,
+          buffers=specs,
+          tolerance=params.tolerance,
+          decay=params.decay,
+          rewiring_rate=params.rewiring_rate,
+          recsys_count=params.recsys_count,
+          rng=rngs[i],
+          piece=pieces[i] if pieces is not None else None,
+          provider=provider,
+      )
+      conn, child = mp.Pipe()
+      p = mp.Process(target=_partition_worker, args=(child, spec), daemon=True)
+      p.start()
+      child.close()
+      self._conns.append(conn)
+      self._processes.append(p)
+    self._gather()
+
+    # in-degrees are accumulated by one partition at a time
+    for c in self._conns:
+      self._call([c], 'count_in_degree')
+
+  @staticmethod
+  def from_provider(
+      provider: PartitionProvider,
+      num_nodes: int,
+      num_parts: int,
+      params: HKModelParams,
+      rng: SeedType = None,
+  ):
+    bounds = np.linspace(0, num_nodes, num_parts + 1).astype(np.int64)
+    return PartitionPool(num_nodes, bounds, params, rng=rng, provider=provider)
+
+  def _gather(self, conns: Optional[List[Connection]] = None) -> List[Any]:
+    ret = []
+    for c in conns if conns is not None else self._conns:
+      ok, value = c.recv()
+      if not ok:
+        self.close()
+        raise RuntimeError(f'Partition worker failed:\n{value}')
+      ret.append(value)
+    return ret
+
+  def _call(self, conns: List[Connection], cmd: str, *args) -> List[Any]:
+    for c in conns:
+      c.send((cmd, args))
+    return self._gather(conns)
+
+  @property
+  def opinion(self) -> NDArray:
+    return self.buf['opinion'][self.cur]
+
+  @property
+  def in_degree(self) -> NDArray:
+    return self.buf['in_degree']
+
+  def step(
+      self,
+      recommended: Optional[NDArray] = None,
+      rnd: Optional[NDArray] = None,
+  ) -> Tuple[int, float]:
+    """First phase: compute the next opinions and propose rewirings."""
+    if recommended is not None:
+      rec = self.buf['recommended']
+      rec.fill(-1)
+      rec[:, :recommended.shape[1]] = recommended
+    if rnd is not None:
+      self.buf['rnd'][:] = rnd
+    ret = self._call(self._conns, 'step', self.cur)
+    return sum(x[0] for x in ret), max(x[1] for x in ret)
+
+  def result(self) -> HKStepResult:
+    # views into the shared buffers, valid until the next step
+    return HKStepResult(
+        next_opinion=self.buf['opinion'][1 - self.cur],
+        nr_agents=self.buf['nr_agents'],
+        op_sum_agents=self.buf['op_sum_agents'],
+        follow=self.buf['follow'],
+        follow_edge=np.full((self.num_nodes, ), -1, dtype=np.int64),
+    )
+
+  def commit(self):
+    """Second phase: apply all proposed rewirings and swap buffers."""
+    self._call(self._conns, 'commit')
+    self.cur = 1 - self.cur
+
+  def edges(self) -> NDArray:
+    pieces = self._call(self._conns, 'edges')
+    return np.stack([
+        np.concatenate([x[0] for x in pieces]),
+        np.concatenate([x[1] for x in pieces]),
+    ], axis=1)
+
+  def to_networkx(self) -> nx.DiGraph:
+    graph = nx.DiGraph()
+    graph.add_nodes_from(range(self.num_nodes))
+    graph.add_edges_from(self.edges().tolist())
+    return graph
+
+  def close(self):
+    self._finalizer()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+class PartitionedEngine(VectorizedEngine):
+  """Vectorized engine whose step runs on partition worker processes.
+
+  The main process keeps the agents, the recommendation system and a copy
+  of the follow graph; the workers own the pieces of the graph used in the
+  step. Recommendations and random samples are drawn here and shared with
+  the workers, so results do not depend on the number of partitions.
+  """
+
+  def __init__(self, model: HKModel, graph: nx.DiGraph, workers: int = 0):
+    super().__init__(model, graph)
+    indptr, indices = self.graph.csr()
+    bounds = split_rows(indptr, max(workers, 1) if workers > 0 else mp.cpu_count())
+    pieces = [
+        (indptr[lo: hi + 1] - indptr[lo], indices[indptr[lo]: indptr[hi]])
+        for lo, hi in zip(bounds[:-1], bounds[1:])
+    ]
+    self.pool = PartitionPool(
+        self.num_nodes, bounds, model.p, rng=model.rng,
+        pieces=pieces, shared_inputs=True)
+
+  def step(self):
+    recommended = self.prepare()
+    self.pool.opinion[:] = self.opinion
+    self.pool.step(
+        recommended, self.model.rng.uniform(size=(self.num_nodes, 3)))
+    ret = self.commit(self.pool.result())
+    self.pool.commit()
+    return ret
+
+  def close(self):
+    self.pool.close()
@@ -1,17 +1,155 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, List, Optional, Any
+from typing import TYPE_CHECKING, List, Optional, Any, Callable, Iterator, Tuple
+from numpy.typing import NDArray
 
 import abc
 
+import numpy as np
+
 if TYPE_CHECKING:
   from base.model import HKModel
   from base.agent import HKAgent
 
+
+def follow_keys(indptr: NDArray, indices: NDArray) -> NDArray:
+  # sorted `u * n + v` of all follow edges (u, v)
+  n = indptr.size - 1
+  return np.sort(np.repeat(np.arange(n), np.diff(indptr)) * n + indices)
+
+
+def row_positions(indptr: NDArray, rows: NDArray) -> Tuple[NDArray, NDArray]:
+  # CSR positions of the entries of `rows`, with the index into `rows`
+  lens = indptr[rows + 1] - indptr[rows]
+  rep = np.repeat(np.arange(rows.size), lens)
+  pos = np.repeat(indptr[rows] - np.cumsum(lens) + lens, lens) + np.arange(rep.size)
+  return rep, pos
+
+
+def is_excluded(
+    rows: NDArray,
+    candidates: NDArray,
+    indptr: NDArray,
+    indices: NDArray,
+    keys: Optional[NDArray] = None,
+) -> NDArray:
+  # whether each candidate is its row agent itself or followed by it
+  n = indptr.size - 1
+  keys = follow_keys(indptr, indices) if keys is None else keys
+  c_keys = rows * n + candidates
+  pos = np.minimum(np.searchsorted(keys, c_keys), max(keys.size - 1, 0))
+  followed = keys[pos] == c_keys if keys.size else np.zeros_like(c_keys, dtype=bool)
+  return followed | (candidates == rows)
+
+
+def fill_rows(rows: NDArray, values: NDArray, count: int, num_rows: int) -> NDArray:
+  # (num_rows, count) array of the first `count` values of each row padded
+  # with -1; `rows` must be sorted
+  ret = np.full((num_rows, count), -1, dtype=np.int64)
+  rank = np.arange(rows.size) - np.searchsorted(rows, rows, 'left')
+  keep = rank < count
+  ret[rows[keep], rank[keep]] = values[keep]
+  return ret
+
+
+def top_k(keys: NDArray, count: int, floor: float = 0) -> NDArray:
+  """Columns of the `count` largest keys per row in descending order, padded
+  with -1 once no key above `floor` is left."""
+  num_rows, n = keys.shape
+  ret = np.full((num_rows, count), -1, dtype=np.int64)
+  k = min(count, n)
+  if k < 1:
+    return ret
+  top = np.argpartition(keys, n - k, axis=1)[:, n - k:]
+  top_keys = np.take_along_axis(keys, top, axis=1)
+  order = np.argsort(-top_keys, axis=1, kind='stable')
+  top = np.take_along_axis(top, order, axis=1)
+  top_keys = np.take_along_axis(top_keys, order, axis=1)
+  ret[:, :k] = np.where(top_keys > floor, top, -1)
+  return ret
+
+
+def gumbel_top_k(rng: np.random.Generator, weights: NDArray, count: int) -> NDArray:
+  """`count` distinct columns per row of `weights` drawn in turn with
+  probability proportional to the weights left, padded with -1 once no
+  positive weight is left.
+
+  The columns with the largest `log(weight) + Gumbel noise` are a sample of
+  successive draws without replacement, so all rows are drawn at once. With
+  `-log(E)` for the Gumbel noise this is the order of `weight / E` for
+  standard exponential `E`, which spares the logarithms.
+  """
+  return top_k(weights / rng.standard_exponential(size=weights.shape), count)
+
+
+def masked_blocks(
+    rate_rows: Callable[[NDArray], NDArray],
+    indptr: NDArray,
+    indices: NDArray,
+    rows: NDArray,
+    fill: float,
+    block_size: int = 1 << 20,
+) -> Iterator[Tuple[NDArray, NDArray]]:
+  # blocks (r, rates of rows r) of about `block_size` entries with neighbors
+  # and self set to `fill`; `rate_rows(r)` returns a fresh array of the
+  # rates of rows `r`
+  n = indptr.size - 1
+  step = max(1, block_size // max(n, 1))
+  for s in range(0, rows.size, step):
+    r = rows[s: s + step]
+    weights = rate_rows(r)
+    rep, pos = row_positions(indptr, r)
+    weights[rep, indices[pos]] = fill
+    weights[np.arange(r.size), r] = fill
+    yield r, weights
+
+
+def sample_rows(
+    rng: np.random.Generator,
+    rate_rows: Callable[[NDArray], NDArray],
+    indptr: NDArray,
+    indices: NDArray,
+    count: int,
+    rows: NDArray,
+) -> NDArray:
+  # `count` agents per row drawn without replacement by rate, neighbors
+  # excluded
+  ret = np.full((indptr.size - 1, count), -1, dtype=np.int64)
+  for r, weights in masked_blocks(rate_rows, indptr, indices, rows, 0):
+    ret[r] = gumbel_top_k(rng, weights, count)
+  return ret
+
+
+def top_rows(
+    rate_rows: Callable[[NDArray], NDArray],
+    indptr: NDArray,
+    indices: NDArray,
+    count: int,
+    rows: NDArray,
+) -> NDArray:
+  # `count` agents per row with the highest rates, neighbors excluded
+  ret = np.full((indptr.size - 1, count), -1, dtype=np.int64)
+  for r, weights in masked_blocks(rate_rows, indptr, indices, rows, -np.inf):
+    ret[r] = top_k(weights, count, -np.inf)
+  return ret
+
+
 class HKModelRecommendationSystem(abc.ABC):
 
   def __init__(self, model: HKModel):
     self.model = model
+    self._noise: Any = None
+
+  def draw_noise(self, method: str, *args) -> NDArray:
+    """`model.rng.<method>(*args)`, prefetched if `prefetch_noise` is set.
+
+    The arguments must stay the same in every step.
+    """
+    if not self.model.p.prefetch_noise:
+      return getattr(self.model.rng, method)(*args)
+    if self._noise is None:
+      self._noise = self.model.noise_source(method, *args)
+    return self._noise.next()
 
   def post_init(self, dump_data: Optional[Any] = None):
     pass
@@ -23,6 +161,33 @@ class HKModelRecommendationSystem(abc.ABC):
   def recommend(self, agent: HKAgent, neighbors: List[HKAgent], count: int) -> List[HKAgent]:
     pass
 
+  def recommend_all(
+      self,
+      opinion: NDArray,
+      indptr: NDArray,
+      indices: NDArray,
+      count: int,
+      mask: Optional[NDArray] = None,
+  ) -> NDArray:
+    """Recommendations of all agents at once for the array-backed engines.
+
+    `indptr` and `indices` are the CSR follow graph. Returns an (n, count)
+    array of agent ids padded with -1; only rows in `mask` are filled. Falls
+    back to calling `recommend` per agent.
+    """
+    agents = sorted(self.model.schedule.agents, key=lambda a: a.unique_id)
+    ret = np.full((len(agents), count), -1, dtype=np.int64)
+    if count < 1:
+      return ret
+    for a in agents:
+      i = a.unique_id
+      if mask is not None and not mask[i]:
+        continue
+      neighbors = [agents[j] for j in indices[indptr[i]: indptr[i + 1]]]
+      rec = self.recommend(a, neighbors, count)
+      ret[i, :len(rec)] = [x.unique_id for x in rec]
+    return ret
+
   def pre_commit(self):
     pass
 
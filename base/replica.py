@@ -0,0 +1,127 @@
+from typing import List
+from numpy.typing import NDArray
+
+import numpy as np
+from tqdm import tqdm
+
+from base.scenario import Scenario, short_progress_bar
+from base.vectorized import HKStepResult, VectorizedEngine
+
+
+def split_step_result(res: HKStepResult, n: int, r: int) -> HKStepResult:
+  # rows and node ids of the r-th replica of a stacked result
+  s = slice(r * n, (r + 1) * n)
+  follow = res.follow[s]
+  return HKStepResult(
+      next_opinion=res.next_opinion[s],
+      nr_agents=res.nr_agents[s],
+      op_sum_agents=res.op_sum_agents[s],
+      follow=np.where(follow >= 0, follow - r * n, -1),
+      follow_edge=res.follow_edge[s],
+  )
+
+
+class ScenarioBatch:
+  """Steps several independent replicas of the same network size together.
+
+  All scenarios must use the vectorized engine. Their opinions are stored in
+  one (R, N) array and their follow graphs are stacked into one block
+  diagonal CSR graph, so every step of all running replicas is a single
+  kernel call. Each replica keeps its own parameters, recsys, statistics and
+  halting condition; halted replicas drop out of the batch.
+
+  The batch always steps all agents of a replica, so `active_threshold`,
+  `coarse_error`, `incremental` and `fast_forward` are not supported.
+  """
+
+  def __init__(self, scenarios: List[Scenario]):
+    self.scenarios = scenarios
+    self.opinion = np.zeros((0, 0))
+    self.halted = np.zeros((len(scenarios), ), dtype=bool)
+
+  @property
+  def engines(self) -> List[VectorizedEngine]:
+    return [s.model.engine for s in self.scenarios]
+
+  def init(self, *args, **kwargs):
+    for s in self.scenarios:
+      if s.model is None:
+        s.init(*args, **kwargs)
+    self.bind()
+
+  def bind(self):
+    engines = self.engines
+    if any(s.model.p.engine != 'vectorized' for s in self.scenarios):
+      raise ValueError('All scenarios in a batch need the vectorized engine.')
+    for s in self.scenarios:
+      p = s.model.p
+      unsupported = [k for k, v in (
+          ('active_threshold', p.active_threshold is not None),
+          ('coarse_error', p.coarse_error is not None),
+          ('incremental', p.incremental),
+          ('fast_forward', s.sim_params.fast_forward),
+      ) if v]
+      if unsupported:
+        raise ValueError(
+            f'Scenarios in a batch do not support {", ".join(unsupported)}.')
+    n = set(e.num_nodes for e in engines)
+    if len(n) != 1:
+      raise ValueError(f'Scenarios in a batch need the same size, got {n}.')
+
+    # share one state tensor with the engines
+    self.opinion = np.stack([e.opinion for e in engines])
+    for i, e in enumerate(engines):
+      e.opinion = self.opinion[i]
+    self.halted = np.array([s.check_halt_cond()[0] for s in self.scenarios])
+
+  def iter_one_step(self):
+    active = np.nonzero(~self.halted)[0]
+    if active.size == 0:
+      return
+    engines = [self.engines[i] for i in active]
+    n = engines[0].num_nodes
+    r = active.size
+
+    # stack the active replicas
+    recs = [e.prepare() for e in engines]
+    count = max(x.shape[1] for x in recs)
+    recommended = np.full((r * n, count), -1, dtype=np.int64)
+    indptr_list = [np.zeros((1, ), dtype=np.int64)]
+    indices_list = []
+    for k, (e, rec) in enumerate(zip(engines, recs)):
+      recommended[k * n: (k + 1) * n, :rec.shape[1]] = np.where(
+          rec >= 0, rec + k * n, -1)
+      indptr, indices = e.graph.csr()
+      indptr_list.append(indptr[1:] + indptr_list[-1][-1])
+      indices_list.append(indices + k * n)
+
+    def per_node(name: str) -> NDArray:
+      return np.repeat([getattr(e.model.p, name) for e in engines], n)
+
+    res = engines[0].kernel(
+        self.opinion[active].flatten(),
+        np.concatenate(indptr_list),
+        np.concatenate(indices_list),
+        recommended,
+        per_node('tolerance'),
+        per_node('decay'),
+        per_node('rewiring_rate'),
+        # replicas draw from their own streams, so results do not depend on
+        # the composition of the batch
+        np.concatenate([e.model.rng.uniform(size=(n, 3)) for e in engines]),
+    )
+
+    # commit and update every replica on its own
+    for k, i in enumerate(active):
+      c_edge, c_opinion = engines[k].commit(split_step_result(res, n, k))
+      s = self.scenarios[i]
+      s.post_step(c_edge, c_opinion)
+      self.halted[i], _, __ = s.check_halt_cond()
+
+  def iter(self, count: int = 0):
+    if count < 1:
+      count = max(s.sim_params.max_total_step for s in self.scenarios)
+    for _ in tqdm(range(count), bar_format=short_progress_bar):
+      self.iter_one_step()
+      if np.all(self.halted):
+        break
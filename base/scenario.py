@@ -7,13 +7,15 @@ import networkx as nx
 import numpy as np
 
 from base.model import HKModel, HKModelParams, HKAgent
+from base.linear import linear_phase_map
 from mesa import DataCollector
 
 from tqdm import tqdm
 
 from collections import Counter
 
-from utils.stat import first_more_or_equal_than
+from utils.stat import first_more_or_equal_than, SlidingWindowMax
+from utils.rng import SeedType, create_rng, spawn_rng, get_rng_state, set_rng_state
 
 StatsType = Dict[str, Union[NDArray, int, float]]
 
@@ -34,6 +36,7 @@ class StatCollector(Protocol):
       digraph: nx.DiGraph,
       graph: nx.Graph,
       opinion: NDArray,
+      rng: np.random.Generator,
   ) -> Union[float, NDArray, Dict[str, Union[float, NDArray]]]:
     pass
 
@@ -54,6 +57,10 @@ class SimulationParams:
   max_total_step: int = 1000
   opinion_change_error: float = 1e-10
   halt_monitor_step: int = 60
+  # also halt as soon as the model reaches an absorbing state
+  halt_on_absorbing: bool = True
+  # jump over steps once the update is linear, see `Scenario.fast_forward`
+  fast_forward: bool = False
 
   agent_stat_interval: int = 1
   agent_stat_keys: Optional[List[str]] = None
@@ -88,6 +95,29 @@ class SimulationParams:
     return steps % self.model_stat_interval == 0
 
 
+class HaltMonitor:
+  """Maximal edge and opinion changes of the last `size` steps."""
+
+  def __init__(self, size: int):
+    self.edge = SlidingWindowMax(size, 0xffffff)
+    self.opinion = SlidingWindowMax(size, 0xffffff)
+    self.last_edge = 0xffffff
+    self.absorbing = False
+
+  @staticmethod
+  def from_list(records: List[Tuple[int, float]]):
+    # monitors dumped as a list of the last changes
+    ret = HaltMonitor(len(records))
+    for c_edge, c_opinion in records:
+      ret.push(c_edge, c_opinion)
+    return ret
+
+  def push(self, c_edge: int, c_opinion: float):
+    self.last_edge = c_edge
+    self.edge.push(c_edge)
+    self.opinion.push(c_opinion)
+
+
 class Scenario:
 
   model: HKModel = None
@@ -100,17 +130,38 @@ class Scenario:
       env_provider: EnvironmentProvider,
       model_params: HKModelParams,
       sim_params: SimulationParams,
+      rng: SeedType = None,
   ):
+    # root stream of the scenario; the environment, the model and the stat
+    # collectors draw from separate children of it
+    self.rng = create_rng(rng)
+    self.stat_rng: Optional[np.random.Generator] = None
     self.env_provider = env_provider
     self.sim_params = sim_params
     self.stat_collectors = self.sim_params.model_stat_collectors
     self.agent_keys = self.sim_params.agent_stat_keys or []
     
     self.model_params = model_params
+    if model_params.coarse_error is not None and \
+        model_params.coarse_error >= sim_params.opinion_change_error:
+      # frozen clusters would hide changes the halt condition waits for
+      raise ValueError(
+          f'coarse_error ({model_params.coarse_error}) must be less than '
+          f'opinion_change_error ({sim_params.opinion_change_error}).')
+    if model_params.engine == 'mean_field' and self.stat_collectors:
+      # collectors take the follow graph, which is never built
+      raise ValueError(
+          'The mean-field engine has no follow graph for model stat collectors.')
     self.stats = {}
     self.steps = 0
-    self.halt_monitor = [(0xffffff, 0xffffff)] * \
-        self.sim_params.halt_monitor_step
+    self.halt_monitor = HaltMonitor(self.sim_params.halt_monitor_step)
+    # 'absorbing', 'stable' or 'max_step' once halted
+    self.halt_reason: Optional[str] = None
+    # inclusive ranges of fast-forwarded steps without agent stats
+    self.skipped_steps: List[Tuple[int, int]] = []
+    # step of the next fast-forward check and the backoff after a failed one
+    self.ff_next_check = 0
+    self.ff_backoff = 1
 
   def init_data(self, collect=True):
     self.datacollector = DataCollector(
@@ -123,14 +174,17 @@ class Scenario:
       self.add_agent_stats()
       self.add_model_stats()
     self.model.datacollector = self.datacollector
-    self.halt_monitor = [(0xffffff, 0xffffff)] * \
-        self.sim_params.halt_monitor_step
+    self.halt_monitor = HaltMonitor(self.sim_params.halt_monitor_step)
+    self.skipped_steps = []
+    self.ff_next_check = 0
+    self.ff_backoff = 1
 
   def init(self, *args, **kwargs):
-    graph, opinion = self.env_provider.generate(*args, **kwargs)
+    env_rng, model_rng, self.stat_rng = spawn_rng(self.rng, 3)
+    graph, opinion = self.env_provider.generate(*args, rng=env_rng, **kwargs)
     model = HKModel(
       graph, opinion, self.model_params, 
-      collect=set(self.agent_keys)
+      collect=set(self.agent_keys), rng=model_rng,
     )
     self.model = model
     self.steps = 0
@@ -138,9 +192,11 @@ class Scenario:
 
   def dump(self):
     # graph
-    graph = nx.DiGraph(self.model.graph)
-    for n in graph:
-      del graph.nodes[n]['agent']
+    # edges keep the adjacency order, so a loaded model continues exactly
+    # where this one stopped
+    graph = nx.DiGraph()
+    graph.add_nodes_from(self.model.graph.nodes())
+    graph.add_edges_from(self.model.graph.edges())
 
     # recsys
     model_dump = self.model.dump()
@@ -151,7 +207,16 @@ class Scenario:
     # data
     c = self.datacollector
     data = (c.model_vars, c._agent_records, c.tables, self.halt_monitor)
-    return graph, opinion, model_dump, data, self.stats, self.steps
+
+    # random states
+    rng_state = dict(
+        model=get_rng_state(self.model.rng),
+        mesa=self.model.random.getstate(),
+        order=[a.unique_id for a in self.model.schedule.agents],
+        stats=get_rng_state(self.stat_rng),
+        noise=self.model.get_noise_state(),
+    )
+    return graph, opinion, model_dump, data, self.stats, self.steps, rng_state
 
   def load(
       self,
@@ -161,30 +226,51 @@ class Scenario:
       data: Optional[Tuple[dict, dict, dict, list]] = None,
       stats: Dict[int, StatsType] = None,
       step: int = 0,
+      rng_state: Optional[Dict[str, Any]] = None,
   ):
+    _, model_rng, self.stat_rng = spawn_rng(self.rng, 3)
     self.model = HKModel(
         graph, opinion, self.model_params, 
-        collect=set(self.agent_keys), dump_data=model_dump)
+        collect=set(self.agent_keys), dump_data=model_dump, rng=model_rng)
+    if rng_state is not None:
+      set_rng_state(self.model.rng, rng_state['model'])
+      self.model.random.setstate(rng_state['mesa'])
+      self.model.set_activation_order(rng_state['order'])
+      set_rng_state(self.stat_rng, rng_state['stats'])
+      self.model.set_noise_state(rng_state.get('noise', []))
     if data is not None:
       self.init_data(collect=False)
       v, r, t, m = data
       self.datacollector.model_vars = v
       self.datacollector._agent_records = r
       self.datacollector.tables = t
-      self.halt_monitor = m
+      self.halt_monitor = HaltMonitor.from_list(m) if isinstance(m, list) else m
     else:
       self.init_data()
     if stats is not None:
       self.stats = stats
     self.steps = step or 0
+    # agent records are keyed by the model's step counter
+    self.model.skip_steps(self.steps)
+
+  def close(self):
+    if self.model is not None:
+      self.model.close()
 
   def iter_one_step(self):
     c_edge, c_opinion = self.model.step()
+    self.post_step(c_edge, c_opinion)
+
+  def post_step(self, c_edge: int, c_opinion: float):
     self.steps += 1
 
     # update monitor
-    self.halt_monitor.pop(0)
-    self.halt_monitor.append((c_edge, c_opinion))
+    self.halt_monitor.push(c_edge, c_opinion)
+    # a step leading into an absorbing state may still rewire, so this is
+    # detected at most one step late
+    if self.sim_params.halt_on_absorbing and c_edge == 0:
+      self.halt_monitor.absorbing = self.model.is_absorbing(
+          self.sim_params.opinion_change_error)
 
     # stats
     if self.steps % self.sim_params.agent_stat_interval == 0:
@@ -192,25 +278,96 @@ class Scenario:
     if self.sim_params.needs_stat(self.steps):
       self.add_model_stats()
 
+  def fast_forward(self, count: int = 0) -> bool:
+    """Jump over the steps in which the update stays linear.
+
+    Checks `linear_phase_map` and, if it holds, applies the map until the
+    run halts or for at most `count` steps if given. Model stats are still
+    collected at their steps; agent stats are only collected at the last
+    step of the jump, the others are listed in `skipped_steps`. The last
+    step is a regular model step, so its agent stats are the same as without
+    jumping; recommendation systems are not stepped before it. Returns
+    whether any step was skipped.
+    """
+    model = self.model
+    if model.p.engine == 'mean_field':
+      # concordant windows of the complete graph change with every step
+      return False
+    opinion, edges = model.get_state()
+    w = linear_phase_map(
+        opinion, edges, model.p.tolerance, model.p.decay,
+        bool(model.recsys) and model.p.recsys_count > 0)
+    if w is None:
+      self.ff_next_check = self.steps + self.ff_backoff
+      self.ff_backoff = min(
+          self.ff_backoff * 2, self.sim_params.halt_monitor_step)
+      return False
+    self.ff_backoff = 1
+
+    start = self.steps
+    end = self.sim_params.max_total_step
+    if count > 0:
+      end = min(end, start + count)
+    x_prev = x = opinion
+    while self.steps < end:
+      x_next = w @ x
+      c_opinion = float(np.max(np.abs(x_next - x), initial=0))
+      x_prev, x = x, x_next
+      self.steps += 1
+      self.halt_monitor.push(0, c_opinion)
+      halt, _, __ = self.check_halt_cond()
+      if halt or self.steps >= end:
+        break
+      if self.sim_params.needs_stat(self.steps):
+        model.set_opinion(x)
+        self.add_model_stats()
+
+    # take the last step from the opinions before it
+    model.set_opinion(x_prev)
+    model.skip_steps(self.steps - 1 - start)
+    model.step()
+    self.add_agent_stats()
+    if self.sim_params.needs_stat(self.steps):
+      self.add_model_stats()
+    if self.steps - 1 > start:
+      self.skipped_steps.append((start + 1, self.steps - 1))
+    if self.sim_params.halt_on_absorbing:
+      self.halt_monitor.absorbing = model.is_absorbing(
+          self.sim_params.opinion_change_error)
+    return self.steps > start
+
   def iter(self, count: int = 0):
     if count < 1:
       count = self.sim_params.max_total_step
-    for _ in tqdm(range(count), bar_format=short_progress_bar):
-      self.iter_one_step()
-      halt, _, __ = self.check_halt_cond()
-      if halt:
-        break
+    end = self.steps + count
+    with tqdm(total=count, bar_format=short_progress_bar) as bar:
+      while self.steps < end:
+        prev = self.steps
+        if not (self.sim_params.fast_forward
+                and self.halt_monitor.last_edge == 0
+                and self.steps >= self.ff_next_check
+                and self.fast_forward(end - self.steps)):
+          self.iter_one_step()
+        bar.update(self.steps - prev)
+        halt, _, __ = self.check_halt_cond()
+        if halt:
+          break
 
   def check_halt_cond(self):
-    val1 = max(x[0] for x in self.halt_monitor)
-    val2 = max(x[1] for x in self.halt_monitor)
+    val1 = self.halt_monitor.edge.max
+    val2 = self.halt_monitor.opinion.max
     cond1 = val1 == 0
     cond2 = val2 < self.sim_params.opinion_change_error
     cond0 = self.steps >= self.sim_params.max_total_step
-    ret = (cond1 and cond2) or cond0
+    self.halt_reason = 'absorbing' if self.halt_monitor.absorbing else \
+        'stable' if cond1 and cond2 else \
+        'max_step' if cond0 else None
+    ret = self.halt_reason is not None
     return ret, val1, val2
 
   def get_current_opinion(self):
+    if self.model.engine is not None:
+      return self.model.engine.opinion.copy()
     agents: List[HKAgent] = self.model.schedule.agents
     opinion = np.zeros((self.model.graph.number_of_nodes(), ), dtype=float)
     for a in agents:
@@ -239,7 +396,8 @@ class Scenario:
           step=self.steps,
           digraph=digraph,
           graph=graph,
-          opinion=opinion
+          opinion=opinion,
+          rng=self.stat_rng,
       )
       if isinstance(ret, dict):
         ret_dict.update(ret)
@@ -306,10 +464,16 @@ class Scenario:
     model_stats = self.generate_model_stats()
     agent_stats = self.generate_agent_stats()
     
-    n_edges_ = np.array(
-        sorted(list(self.model.graph.out_degree), key=lambda x: x[0]))
-    node_indices = n_edges_[:, 0]
-    n_edges = n_edges_[:, 1]
+    if self.model.p.engine == 'mean_field':
+      # every agent follows all others
+      n = self.model.engine.num_nodes
+      node_indices = np.arange(n)
+      n_edges = np.full((n, ), n - 1)
+    else:
+      n_edges_ = np.array(
+          sorted(list(self.model.graph.out_degree), key=lambda x: x[0]))
+      node_indices = n_edges_[:, 0]
+      n_edges = n_edges_[:, 1]
     
     metadata = dict(
       total_steps=self.steps,
@@ -1,9 +1,20 @@
-from typing import Tuple, TypeAlias
+from typing import Tuple, TypeAlias, Iterable, Optional
+from numpy.typing import NDArray
 
 import dataclasses
 
+import numpy as np
+
 TweetRecord: TypeAlias = Tuple[int, int, float]
 
+# structured counterpart of `TweetRecord` used by compiled kernels;
+# uid == -1 marks an empty slot
+TweetRecordDType = np.dtype([
+    ('uid', np.int64),
+    ('step', np.int64),
+    ('opinion', np.float64),
+])
+
 @dataclasses.dataclass
 class Tweet:
   uid: int
@@ -12,4 +23,8 @@ class Tweet:
   
   def to_record(self) -> TweetRecord:
     return (self.uid, self.step, self.opinion)
-  
\ No newline at end of file
+  
+
+def to_record_array(records: Iterable[Optional[TweetRecord]]) -> NDArray:
+  records = [r if r is not None else (-1, -1, np.nan) for r in records]
+  return np.array(records, dtype=TweetRecordDType)
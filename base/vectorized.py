@@ -0,0 +1,385 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Callable, List, Optional, Tuple, Union
+from numpy.typing import NDArray
+
+import dataclasses
+
+import numpy as np
+import networkx as nx
+
+from base.graph import FollowGraph
+from base.coarse import ConsensusClusters
+from base.concordance import ConcordanceIndex
+
+if TYPE_CHECKING:
+  from base.model import HKModel
+  from base.agent import HKAgent
+
+
+def rank_in_rows(mask: NDArray, indptr: NDArray, rows: NDArray) -> NDArray:
+  # rank of each True entry among the True entries of its CSR row
+  csum = np.cumsum(mask)
+  before = np.concatenate(([0], csum))[indptr[:-1]]
+  return csum - 1 - before[rows]
+
+
+def mask_rows(
+    mask: NDArray,
+    indptr: NDArray,
+    indices: NDArray,
+    recommended: NDArray,
+) -> Tuple[NDArray, NDArray, NDArray]:
+  # drop the edges and recommendations of rows not in `mask`, so that the
+  # kernel leaves them unchanged
+  keep = np.repeat(mask, np.diff(indptr))
+  indptr_masked = np.zeros_like(indptr)
+  np.cumsum(np.diff(indptr) * mask, out=indptr_masked[1:])
+  return indptr_masked, indices[keep], np.where(
+      mask[:, np.newaxis], recommended, -1)
+
+
+@dataclasses.dataclass
+class HKStepResult:
+  next_opinion: NDArray
+  # (n, 4): concordant neighbor, concordant recommended,
+  # discordant neighbor, discordant recommended
+  nr_agents: NDArray
+  op_sum_agents: NDArray
+  # (n, 2): unfollow, follow; -1 if the agent does not rewire
+  follow: NDArray
+  # position of the unfollowed edge in `indices`, -1 if none
+  follow_edge: NDArray
+
+
+def recommended_terms(
+    opinion: NDArray,
+    recommended: NDArray,
+    tolerance: Union[float, NDArray],
+) -> Tuple[NDArray, NDArray, NDArray, NDArray, NDArray]:
+  # concordance mask, counts and diff sums of the recommended agents
+  valid_r = recommended >= 0
+  diff_r = np.where(valid_r, opinion[recommended] - opinion[:, np.newaxis], 0)
+  conc_r = valid_r & (np.abs(diff_r) <= np.reshape(tolerance, (-1, 1)))
+  disc_r = valid_r & ~conc_r
+  n_cr = np.sum(conc_r, axis=1)
+  n_dr = np.sum(disc_r, axis=1)
+  sum_r = np.sum(diff_r * conc_r, axis=1)
+  sum_rd = np.sum(diff_r * disc_r, axis=1)
+  return conc_r, n_cr, n_dr, sum_r, sum_rd
+
+
+def pick_recommended(conc_r: NDArray, n_cr: NDArray, rnd: NDArray) -> NDArray:
+  # follow: uniform pick among concordant recommended, returns the column
+  k_f = (rnd * n_cr).astype(int)
+  rank_r = np.cumsum(conc_r, axis=1) - 1
+  return np.argmax(conc_r & (rank_r == k_f[:, np.newaxis]), axis=1)
+
+
+def hk_step_kernel(
+    opinion: NDArray,
+    indptr: NDArray,
+    indices: NDArray,
+    recommended: NDArray,
+    tolerance: Union[float, NDArray],
+    decay: Union[float, NDArray],
+    rewiring_rate: Union[float, NDArray],
+    rnd: NDArray,
+) -> HKStepResult:
+  """Synchronous HK step of all agents at once.
+
+  `recommended` is an (n, count) array padded with -1, `rnd` holds 3 uniform
+  samples per agent used for the rewiring decision and the two picks.
+  `tolerance`, `decay` and `rewiring_rate` may be given per agent.
+  """
+  n = opinion.size
+  deg = np.diff(indptr)
+  rows = np.repeat(np.arange(n), deg)
+
+  # neighbors
+  diff_n = opinion[indices] - opinion[rows]
+  conc_n = np.abs(diff_n) <= (
+      tolerance[rows] if np.ndim(tolerance) else tolerance)
+  disc_n = ~conc_n
+  n_cn = np.bincount(rows, weights=conc_n, minlength=n).astype(int)
+  n_dn = deg - n_cn
+  sum_n = np.bincount(rows, weights=diff_n * conc_n, minlength=n)
+  sum_nd = np.bincount(rows, weights=diff_n * disc_n, minlength=n)
+
+  # recommended
+  conc_r, n_cr, n_dr, sum_r, sum_rd = recommended_terms(
+      opinion, recommended, tolerance)
+
+  # update value
+  n_concordant = n_cn + n_cr
+  next_opinion = opinion + np.where(
+      n_concordant > 0,
+      (sum_n + sum_r) / np.maximum(n_concordant, 1) * decay,
+      0)
+
+  # handle rewiring
+  rewire = (n_dn > 0) & (n_cr > 0) & (rnd[:, 0] < rewiring_rate)
+  follow = np.full((n, 2), -1, dtype=np.int64)
+  follow_edge = np.full((n, ), -1, dtype=np.int64)
+  if np.any(rewire):
+    col_f = pick_recommended(conc_r, n_cr, rnd[:, 1])
+    # unfollow: uniform pick among discordant neighbors
+    k_u = (rnd[:, 2] * n_dn).astype(int)
+    rank_n = rank_in_rows(disc_n, indptr, rows)
+    e_u = np.nonzero(disc_n & (rank_n == k_u[rows]) & rewire[rows])[0]
+    a_u = rows[e_u]
+    follow[a_u, 0] = indices[e_u]
+    follow[a_u, 1] = recommended[a_u, col_f[a_u]]
+    follow_edge[a_u] = e_u
+
+  return HKStepResult(
+      next_opinion=next_opinion,
+      nr_agents=np.stack([n_cn, n_cr, n_dn, n_dr], axis=1),
+      op_sum_agents=np.stack([sum_n, sum_r, sum_nd, sum_rd], axis=1),
+      follow=follow,
+      follow_edge=follow_edge,
+  )
+
+
+def hk_step_indexed(
+    opinion: NDArray,
+    index: ConcordanceIndex,
+    recommended: NDArray,
+    tolerance: float,
+    decay: float,
+    rewiring_rate: float,
+    rnd: NDArray,
+    stepped: Optional[NDArray] = None,
+) -> HKStepResult:
+  """`hk_step_kernel` taking the neighbor terms from a `ConcordanceIndex`.
+
+  Only the rows of rewiring agents are scanned. Agents not in `stepped` are
+  left unchanged; `follow_edge` holds positions in the compact CSR view.
+  """
+  graph = index.graph
+  n = opinion.size
+  deg = graph.out_degree
+  if stepped is not None:
+    deg = np.where(stepped, deg, 0)
+    recommended = np.where(stepped[:, np.newaxis], recommended, -1)
+
+  # neighbors
+  n_cn = np.where(deg > 0, index.n_concordant, 0)
+  n_dn = deg - n_cn
+  sum_c = np.where(deg > 0, index.sum_concordant, 0)
+  sum_n = sum_c - n_cn * opinion
+  sum_nd = np.where(deg > 0, index.sum_all, 0) - sum_c - n_dn * opinion
+
+  # recommended
+  conc_r, n_cr, n_dr, sum_r, sum_rd = recommended_terms(
+      opinion, recommended, tolerance)
+
+  # update value
+  n_concordant = n_cn + n_cr
+  next_opinion = opinion + np.where(
+      n_concordant > 0,
+      (sum_n + sum_r) / np.maximum(n_concordant, 1) * decay,
+      0)
+
+  # handle rewiring
+  rewire = (n_dn > 0) & (n_cr > 0) & (rnd[:, 0] < rewiring_rate)
+  follow = np.full((n, 2), -1, dtype=np.int64)
+  follow_edge = np.full((n, ), -1, dtype=np.int64)
+  a_u = np.nonzero(rewire)[0]
+  if a_u.size:
+    col_f = pick_recommended(conc_r[a_u], n_cr[a_u], rnd[a_u, 1])
+    # unfollow: uniform pick among discordant neighbors, in row order
+    pos, rep = graph._row_slots(a_u, deg[a_u])
+    disc = ~index.concordant[pos]
+    seg = np.zeros((a_u.size + 1, ), dtype=np.int64)
+    np.cumsum(deg[a_u], out=seg[1:])
+    rank = rank_in_rows(disc, seg, rep)
+    k_u = (rnd[a_u, 2] * n_dn[a_u]).astype(int)
+    e_u = pos[disc & (rank == k_u[rep])]
+    follow[a_u, 0] = graph.storage[e_u]
+    follow[a_u, 1] = recommended[a_u, col_f]
+    row_start = np.cumsum(graph.out_degree) - graph.out_degree
+    follow_edge[a_u] = e_u - graph.offset[a_u] + row_start[a_u]
+
+  return HKStepResult(
+      next_opinion=next_opinion,
+      nr_agents=np.stack([n_cn, n_cr, n_dn, n_dr], axis=1),
+      op_sum_agents=np.stack([sum_n, sum_r, sum_nd, sum_rd], axis=1),
+      follow=follow,
+      follow_edge=follow_edge,
+  )
+
+
+class VectorizedEngine:
+  """Array-backed replacement of the per-agent mesa step.
+
+  Opinions are kept in one array and the follow graph in a `FollowGraph`;
+  the mesa agents are only kept in sync for recommendation systems and data
+  collection.
+
+  If `active_threshold` of the model parameters is set, only the active
+  agents are stepped. An agent is frozen when its opinion and the opinions
+  of all its neighbors changed less than the threshold in the last step and
+  it has no discordant neighbor to unfollow. It is stepped again once a
+  neighbor or a recommended agent changes, a rewiring touches it, or it is
+  recommended a concordant agent whose opinion differs by more than the
+  threshold.
+
+  If `coarse_error` is set, isolated consensus clusters are merged into
+  super-nodes every `coarse_interval` steps, see `ConsensusClusters`.
+
+  If `incremental` is set, the neighbor terms are taken from a
+  `ConcordanceIndex` instead of the kernel. The index is rebuilt every
+  `rebuild_interval` steps to discard the rounding error of its sums.
+  """
+
+  rebuild_interval = 1000
+
+  def __init__(self, model: HKModel, graph: nx.DiGraph):
+    self.model = model
+    self.agents: List[HKAgent] = sorted(
+        model.schedule.agents, key=lambda a: a.unique_id)
+    self.num_nodes = n = len(self.agents)
+    assert all(a.unique_id == i for i, a in enumerate(self.agents))
+
+    self.opinion = np.array([a.cur_opinion for a in self.agents], dtype=float)
+    self.graph = FollowGraph.from_networkx(graph, n)
+    self.kernel: Callable[..., HKStepResult] = hk_step_kernel
+
+    # active set
+    self.active = np.ones((n, ), dtype=bool)
+    self.hot = np.ones((n, ), dtype=bool)
+
+    # coarse graining
+    p = model.p
+    self.clusters = ConsensusClusters(n, p.tolerance, p.coarse_error) \
+        if p.coarse_error is not None else None
+    self.index = ConcordanceIndex(self.graph, self.opinion, p.tolerance) \
+        if p.incremental else None
+
+  def get_recommendation(self, count: int) -> NDArray:
+    if not self.model.recsys or count < 1:
+      return np.full((self.num_nodes, count), -1, dtype=np.int64)
+    mask = ~self.clusters.merged if self.clusters is not None else None
+    return self.model.recsys.recommend_all(
+        self.opinion, *self.graph.csr(), count, mask=mask)
+
+  def step(self):
+    p = self.model.p
+    recommended = self.prepare()
+    stepped: Optional[NDArray] = None
+    if p.active_threshold is not None:
+      stepped = self.active | self.pulled(recommended)
+    if self.clusters is not None:
+      stepped = ~self.clusters.merged if stepped is None \
+          else stepped & ~self.clusters.merged
+    rnd = self.model.rng.uniform(size=(self.num_nodes, 3))
+    if self.index is not None:
+      self.index.update(self.opinion)
+      res = hk_step_indexed(
+          self.opinion, self.index, recommended,
+          p.tolerance, p.decay, p.rewiring_rate, rnd, stepped)
+      return self.commit(res, stepped)
+    indptr, indices = self.graph.csr()
+    if stepped is not None:
+      indptr, indices, recommended = mask_rows(
+          stepped, indptr, indices, recommended)
+    res = self.kernel(
+        self.opinion, indptr, indices, recommended,
+        p.tolerance, p.decay, p.rewiring_rate, rnd,
+    )
+    return self.commit(res, stepped)
+
+  def prepare(self) -> NDArray:
+    if self.model.recsys:
+      self.model.recsys.pre_step()
+    return self.get_recommendation(self.model.p.recsys_count)
+
+  def commit(self, res: HKStepResult, stepped: Optional[NDArray] = None):
+    model = self.model
+    recsys = model.recsys
+    if recsys:
+      recsys.pre_commit()
+
+    changed_opinion = np.abs(res.next_opinion - self.opinion)
+    changed_opinion_max = float(np.max(changed_opinion, initial=0))
+    self.opinion[:] = res.next_opinion
+
+    rewired = np.nonzero(res.follow[:, 0] >= 0)[0]
+    unfollow, follow = res.follow[rewired].T
+    if self.index is not None:
+      self.index.update(self.opinion)
+    pos = self.graph.rewire(rewired, unfollow, follow)
+    if self.index is not None:
+      if (model.cur_step + 1) % self.rebuild_interval == 0:
+        self.index.rebuild(self.opinion)
+      else:
+        self.index.rewire(pos, rewired, unfollow, follow)
+    changed: List[int] = np.stack(
+        [rewired, unfollow, follow], axis=1).flatten().tolist()
+
+    if model.p.active_threshold is not None:
+      self.update_active(res, changed_opinion, changed)
+    if self.clusters is not None:
+      self.update_clusters()
+    self.sync_agents(res, stepped)
+
+    if recsys:
+      recsys.post_step(changed)
+
+    # the scheduler is not stepped, advance mesa's step counter used by the
+    # data collector manually
+    model._advance_time()
+    model.cur_step += 1
+    return rewired.size, changed_opinion_max
+
+  def update_clusters(self):
+    released = self.clusters.split(self.opinion)
+    self.active[released] = True
+    if (self.model.cur_step + 1) % self.model.p.coarse_interval == 0:
+      self.active[self.clusters.merged] = True
+      self.clusters.detect(self.opinion, *self.graph.csr())
+
+  def pulled(self, recommended: NDArray) -> NDArray:
+    # agents recommended an agent that changed, or a concordant agent whose
+    # opinion differs by more than the threshold, move even if frozen
+    p = self.model.p
+    valid = recommended >= 0
+    rec = np.where(valid, recommended, 0)
+    diff = np.abs(self.opinion[rec] - self.opinion[:, None])
+    pull = (diff <= p.tolerance) & (diff > p.active_threshold)
+    return np.any(valid & (self.hot[rec] | pull), axis=1)
+
+  def update_active(self, res: HKStepResult, changed_opinion: NDArray, changed: List[int]):
+    hot = changed_opinion > self.model.p.active_threshold
+    hot[changed] = True
+    indptr, indices = self.graph.csr()
+    rows = np.repeat(np.arange(self.num_nodes), np.diff(indptr))
+    hot_neighbor = np.bincount(
+        rows, weights=hot[indices], minlength=self.num_nodes) > 0
+    # discordant neighbors can only be unfollowed for a recommended agent
+    can_rewire = res.nr_agents[:, 2] > 0
+    if not self.model.recsys or self.model.p.recsys_count < 1:
+      can_rewire[:] = False
+    self.hot = hot
+    self.active = hot | hot_neighbor | can_rewire
+
+  def sync_agents(self, res: HKStepResult, stepped: Optional[NDArray] = None):
+    collect = self.model.collect
+    # frozen agents keep their opinion and the statistics of their last step
+    ids = np.arange(self.num_nodes) if stepped is None else np.nonzero(stepped)[0]
+    for i, o in zip(ids.tolist(), self.opinion[ids].tolist()):
+      self.agents[i].cur_opinion = self.agents[i].next_opinion = o
+    if 'nr_agents' in collect:
+      for i, v in zip(ids.tolist(), res.nr_agents[ids].tolist()):
+        self.agents[i].nr_agents = v
+    if 'op_sum_agents' in collect:
+      for i, v in zip(ids.tolist(), res.op_sum_agents[ids].tolist()):
+        self.agents[i].op_sum_agents = v
+    if 'follow_event' in collect:
+      for a, (u, f) in zip(self.agents, res.follow.tolist()):
+        a.follow_event = [u >= 0, u, f]
+
+  def close(self):
+    # engines holding threads or processes release them here
+    pass
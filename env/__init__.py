@@ -1,2 +1,3 @@
 from env.random import RandomNetworkProvider
-from env.scale_free import ScaleFreeNetworkProvider
\ No newline at end of file
+from env.scale_free import ScaleFreeNetworkProvider
+from env.complete import CompleteGraphProvider
\ No newline at end of file
@@ -0,0 +1,25 @@
+from typing import Tuple, Optional
+from numpy.typing import NDArray
+
+import dataclasses
+
+import numpy as np
+
+from utils.rng import create_rng
+
+
+@dataclasses.dataclass
+class CompleteGraphProvider:
+  """Opinions for the complete graph of the mean-field engine.
+
+  The graph itself is implicit, so `generate` returns None in its place.
+  """
+
+  agent_count: int = 1000
+
+  opinion_range: Tuple[int, int] = (-1, 1)
+
+  def generate(self, rng: Optional[np.random.Generator] = None) -> Tuple[None, NDArray]:
+    rng = create_rng(rng)
+    opinion = rng.uniform(*self.opinion_range, (self.agent_count, ))
+    return None, opinion
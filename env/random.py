@@ -6,6 +6,17 @@ import dataclasses
 import networkx as nx
 import numpy as np
 
+from utils.rng import create_rng, derive_seed
+
+
+def edges_to_partition(lo: int, hi: int, n: int, src: NDArray, dst: NDArray) -> Tuple[NDArray, NDArray]:
+  # local CSR of the edges of nodes `lo` to `hi`, duplicates are dropped
+  key = np.unique(src.astype(np.int64) * n + dst)
+  src, dst = key // n, key % n
+  indptr = np.zeros((hi - lo + 1, ), dtype=np.int64)
+  np.cumsum(np.bincount(src - lo, minlength=hi - lo), out=indptr[1:])
+  return indptr, dst
+
 
 @dataclasses.dataclass
 class RandomNetworkProvider:
@@ -17,12 +28,25 @@ class RandomNetworkProvider:
 
   opinion_range: Tuple[int, int] = (-1, 1)
 
-  def generate(self) -> Tuple[nx.DiGraph, NDArray]:
+  def generate(self, rng: Optional[np.random.Generator] = None) -> Tuple[nx.DiGraph, NDArray]:
+    rng = create_rng(rng)
     graph: nx.DiGraph = nx.erdos_renyi_graph(
         n=self.agent_count,
         p=self.agent_follow / (self.agent_count - 1),
-        seed=self.seed,
+        seed=self.seed if self.seed is not None else derive_seed(rng),
         directed=True,
     )
-    opinion = np.random.uniform(*self.opinion_range, (self.agent_count, ))
+    opinion = rng.uniform(*self.opinion_range, (self.agent_count, ))
     return graph, opinion
+
+  def generate_partition(self, lo: int, hi: int, rng: np.random.Generator) -> Tuple[NDArray, NDArray, NDArray]:
+    """Out-edges and opinions of nodes `lo` to `hi` of the same random
+    graph model, generated without the rest of the graph."""
+    n = self.agent_count
+    deg = rng.binomial(n - 1, self.agent_follow / (n - 1), (hi - lo, ))
+    src = np.repeat(np.arange(lo, hi), deg)
+    dst = rng.integers(0, n - 1, (src.size, ))
+    dst += dst >= src
+    indptr, indices = edges_to_partition(lo, hi, n, src, dst)
+    opinion = rng.uniform(*self.opinion_range, (hi - lo, ))
+    return indptr, indices, opinion
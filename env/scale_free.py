@@ -6,6 +6,9 @@ import dataclasses
 import networkx as nx
 import numpy as np
 
+from utils.rng import create_rng, derive_seed
+from env.random import edges_to_partition
+
 
 def preferential_attachment(seq, m: int, rng: np.random.RandomState):
   """Return m unique elements from seq.
@@ -95,11 +98,13 @@ class ScaleFreeNetworkProvider:
 
   opinion_range: Tuple[int, int] = (-1, 1)
 
-  def generate(self) -> Tuple[nx.DiGraph, NDArray]:
+  def generate(self, rng: Optional[np.random.Generator] = None) -> Tuple[nx.DiGraph, NDArray]:
+    rng = create_rng(rng)
+    seed = self.seed if self.seed is not None else derive_seed(rng)
     graph: nx.DiGraph = nx.erdos_renyi_graph(
         n=self.init_agent_count,
         p=self.agent_follow / (self.init_agent_count - 1),
-        seed=None if self.seed is None else self.seed + 1,
+        seed=seed + 1,
         directed=True
     )
     barabasi_albert_digraph_inplace(
@@ -107,7 +112,46 @@ class ScaleFreeNetworkProvider:
         m=self.agent_follow,
         p=self.agent_closure,
         G=graph,
-        seed=self.seed,
+        seed=seed,
     )
-    opinion = np.random.uniform(*self.opinion_range, (self.agent_count, ))
+    opinion = rng.uniform(*self.opinion_range, (self.agent_count, ))
     return graph, opinion
+
+  def generate_partition(self, lo: int, hi: int, rng: np.random.Generator) -> Tuple[NDArray, NDArray, NDArray]:
+    """Out-edges and opinions of nodes `lo` to `hi`, generated without the
+    rest of the graph.
+
+    Node `s` of the preferential attachment phase has `agent_follow` targets
+    drawn with probability proportional to `j ** -0.5` (`j < s`), the
+    expected degree profile of the sequential process. Triad closure needs
+    the neighbors of the targets and is not applied.
+    """
+    n, m, n0 = self.agent_count, self.agent_follow, self.init_agent_count
+
+    # initial random graph
+    lo0, hi0 = min(lo, n0), min(hi, n0)
+    deg = rng.binomial(n0 - 1, min(m / (n0 - 1), 1), (hi0 - lo0, ))
+    src0 = np.repeat(np.arange(lo0, hi0), deg)
+    dst0 = rng.integers(0, n0 - 1, (src0.size, ))
+    dst0 += dst0 >= src0
+
+    # attachment, redrawing duplicated targets a few times
+    src1 = np.arange(max(lo, n0), hi)
+    dst1 = np.zeros((src1.size, m), dtype=np.int64)
+    redraw = np.ones(dst1.shape, dtype=bool)
+    for _ in range(8):
+      count = int(np.sum(redraw))
+      if count == 0:
+        break
+      u = rng.uniform(size=(count, ))
+      dst1[redraw] = (np.broadcast_to(src1[:, np.newaxis], dst1.shape)[redraw]
+                      * u * u).astype(np.int64)
+      dst1.sort(axis=1)
+      redraw[:] = False
+      redraw[:, 1:] = dst1[:, 1:] == dst1[:, :-1]
+
+    src = np.concatenate([src0, np.repeat(src1, m)])
+    dst = np.concatenate([dst0, dst1.flatten()])
+    indptr, indices = edges_to_partition(lo, hi, n, src, dst)
+    opinion = rng.uniform(*self.opinion_range, (hi - lo, ))
+    return indptr, indices, opinion
@@ -1,6 +1,8 @@
 from typing import List, Dict, Optional, Any
 import numpy as np
+from numpy.typing import NDArray
 from base import HKAgent, HKModel, HKModelRecommendationSystem
+from base.recsys import fill_rows
 
 
 class Mixed(HKModelRecommendationSystem):
@@ -41,6 +43,20 @@ class Mixed(HKModelRecommendationSystem):
       ans[a.unique_id] = a
     return list(ans.values())
 
+  def recommend_all(self, opinion: NDArray, indptr: NDArray, indices: NDArray, count: int, mask: Optional[NDArray] = None) -> NDArray:
+    # both parts are drawn for all agents in turn, not interleaved per agent
+    count1 = max(int(count * self.r + 0.5), 0)
+    count2 = max(count - count1, 0)
+    rec = np.concatenate((
+        self.model1.recommend_all(opinion, indptr, indices, count1, mask),
+        self.model2.recommend_all(opinion, indptr, indices, count2, mask),
+    ), axis=1)
+    earlier = np.tril(np.ones((rec.shape[1], rec.shape[1]), dtype=bool), -1)
+    dup = np.any((rec[:, :, np.newaxis] == rec[:, np.newaxis, :]) & earlier, axis=2)
+    keep = (rec >= 0) & ~dup
+    rows = np.repeat(np.arange(rec.shape[0]), rec.shape[1]).reshape(rec.shape)
+    return fill_rows(rows[keep], rec[keep], count, rec.shape[0])
+
   def pre_commit(self):
     self.model1.pre_commit()
     self.model2.pre_commit()
@@ -1,6 +1,8 @@
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Callable
 import numpy as np
+from numpy.typing import NDArray
 from base import HKAgent, HKModel, HKModelRecommendationSystem
+from base.recsys import is_excluded, fill_rows, sample_rows, follow_keys, gumbel_top_k
 
 
 class Opinion(HKModelRecommendationSystem):
@@ -10,47 +12,251 @@ class Opinion(HKModelRecommendationSystem):
     self.noise_std = noise_std
     self.num_nodes = 0
     self.epsilon = np.zeros((0, ))
+    # agent ids by opinion, the position of each agent in it and the sorted
+    # opinions of the current step
+    self.order = np.zeros((0, ), dtype=np.int64)
+    self.pos = np.zeros((0, ), dtype=np.int64)
+    self.sorted_opinion = np.zeros((0, ))
 
   def post_init(self, dump_data: Optional[Any] = None):
     self.num_nodes = self.model.graph.number_of_nodes()
-    self.agents: List[HKAgent] = list(self.model.schedule.agents)
-    self.agent_indices: Dict[int, int] = {}
+    self.agents: List[HKAgent] = sorted(
+        self.model.schedule.agents, key=lambda a: a.unique_id)
+    # the sort is stable, so ties keep the order of the scheduler
+    self.order = np.array(
+        [a.unique_id for a in self.model.schedule.agents], dtype=np.int64)
 
   def pre_step(self):
-    self.agents.sort(key=lambda a: a.cur_opinion)
-    for i, a in enumerate(self.agents):
-      self.agent_indices[a.unique_id] = i
-    self.epsilon = np.random.normal(0, self.noise_std, (self.num_nodes, ))
+    # opinions barely move between steps, so the previous order is nearly
+    # sorted already, which the stable sort takes advantage of
+    opinion = self.model.get_opinion()
+    self.order = self.order[np.argsort(opinion[self.order], kind='stable')]
+    self.pos = np.empty_like(self.order)
+    self.pos[self.order] = np.arange(self.num_nodes)
+    self.sorted_opinion = opinion[self.order]
+    # list views for the per-agent walk
+    self._order_list: List[int] = self.order.tolist()
+    self._opinion_list: List[float] = self.sorted_opinion.tolist()
+    self.epsilon = self.draw_noise('normal', 0, self.noise_std, (self.num_nodes, ))
 
   def recommend(self, agent: HKAgent, neighbors: List[HKAgent], count: int) -> List[HKAgent]:
     neighbor_ids = set([x.unique_id for x in neighbors + [agent]])
     o = agent.cur_opinion + self.epsilon[agent.unique_id]
+    x, order = self._opinion_list, self._order_list
 
-    i_pre = self.agent_indices[agent.unique_id] - 1
-    i_post = self.agent_indices[agent.unique_id] + 1
+    i_pre = int(self.pos[agent.unique_id]) - 1
+    i_post = i_pre + 2
     ret: List[HKAgent] = []
 
     while len(ret) < count:
       no_pre = i_pre < 0
-      no_post = i_post >= len(self.agents)
+      no_post = i_post >= self.num_nodes
       if no_pre and no_post:
         break
-      use_pre = no_post or (
-          not no_pre and
-          o - self.agents[i_pre].cur_opinion < self.agents[i_post].cur_opinion - o)
+      use_pre = no_post or (not no_pre and o - x[i_pre] < x[i_post] - o)
+      i = order[i_pre if use_pre else i_post]
+      if i not in neighbor_ids:
+        ret.append(self.agents[i])
       if use_pre:
-        a = self.agents[i_pre]
-        if a.unique_id not in neighbor_ids:
-          ret.append(a)
         i_pre -= 1
       else:
-        a = self.agents[i_post]
-        if a.unique_id not in neighbor_ids:
-          ret.append(a)
         i_post += 1
 
     return ret
 
+  def recommend_all(self, opinion: NDArray, indptr: NDArray, indices: NDArray, count: int, mask: Optional[NDArray] = None) -> NDArray:
+    n = self.num_nodes
+    rows = np.arange(n) if mask is None else np.nonzero(mask)[0]
+    ret = np.full((n, count), -1, dtype=np.int64)
+
+    # the walk in `recommend` takes at most `count` agents and skips the
+    # neighbors, so it ends within `count + degree` agents on either side;
+    # most walks end much earlier, so a narrow window is tried first
+    for narrow in (True, False):
+      deg = np.diff(indptr)[rows]
+      m = count + (np.minimum(deg, count) if narrow else deg)
+      seg, cand, valid, cut = self._walk(rows, m)
+      keep = valid & ~is_excluded(rows[seg], cand, indptr, indices)
+      ret[rows] = fill_rows(seg[keep], cand[keep], count, rows.size)
+      undecided = (np.sum(ret[rows] >= 0, axis=1) < count) & \
+          (np.bincount(seg[cut], minlength=rows.size) > 0)
+      rows = rows[undecided]
+      if rows.size == 0:
+        break
+    return ret
+
+  def _walk(self, rows: NDArray, m: NDArray):
+    # candidates within `m` agents on either side of each row agent in walk
+    # order; the order is exact up to the end of the first window that is
+    # cut short, later candidates are marked invalid and `cut` marks the
+    # window ends
+    n, x, ids, pos = self.num_nodes, self.sorted_opinion, self.order, self.pos
+    seg = np.repeat(np.arange(rows.size), m)
+    j = np.arange(seg.size) - np.repeat(np.cumsum(m) - m, m)
+    agent = rows[seg]
+    o = x[pos[agent]] + self.epsilon[agent]
+    pre = pos[agent] - 1 - j
+    post = pos[agent] + 1 + j
+    v_pre, v_post = pre >= 0, post < n
+    cut = j == m[seg] - 1
+    cut = np.concatenate(((cut & (pre > 0))[v_pre], (cut & (post < n - 1))[v_post]))
+
+    # merge both sides by distance, ties go to the upper side
+    seg = np.concatenate((seg[v_pre], seg[v_post]))
+    dist = np.concatenate((o[v_pre] - x[pre[v_pre]], x[post[v_post]] - o[v_post]))
+    side = np.concatenate((np.ones_like(pre[v_pre]), np.zeros_like(post[v_post])))
+    cand = ids[np.concatenate((pre[v_pre], post[v_post]))]
+    by_dist = np.argsort(dist)
+    rank = np.empty_like(seg)
+    rank[by_dist] = np.cumsum(np.concatenate(
+        ([0], np.diff(dist[by_dist]) != 0)))
+    order = np.argsort((seg * seg.size + rank) * 2 + side, kind='stable')
+    seg, cand, cut = seg[order], cand[order], cut[order]
+
+    cuts_before = np.cumsum(cut) - cut
+    seg_start = np.searchsorted(seg, seg, 'left')
+    valid = cuts_before - cuts_before[seg_start] == 0
+    return seg, cand, valid, cut
+
+
+def expected_rate(r: NDArray, noise_std: float, steepness: float) -> NDArray:
+  """E[max(0, r (1 - 2 e) + e) ** steepness] for e ~ N(0, noise_std)."""
+  r = np.asarray(r, dtype=float)
+  if noise_std <= 0:
+    return r ** steepness
+  z = np.linspace(-8, 8, 2001)
+  y = np.maximum(r[:, np.newaxis] + np.outer(1 - 2 * r, z * noise_std), 0)
+  pdf = np.exp(-z ** 2 / 2) / np.sqrt(2 * np.pi)
+  return np.trapezoid(y ** steepness * pdf, z, axis=1)
+
+
+class WindowSampler:
+  """Sampling from the expected rates of `OpinionRandom` without the dense
+  rate matrix.
+
+  Rates are a function `f` of the opinion distance, constant `f(0)` outside
+  of the tolerance window. With `u = min f`, candidates are proposed from a
+  uniform part of mass `u` over all agents, a uniform part of mass
+  `f(0) - u` over the agents outside of the window and, inside of it, from
+  distance bins bounded by the largest `f - u` of the bin, which is then
+  accepted by its actual rate. The agents of a bin are contiguous in the
+  opinion order, so no pair of agents is ever enumerated.
+  """
+
+  def __init__(self, tolerance: float, noise_std: float, steepness: float, bins: int = 32):
+    self.tolerance = tolerance
+    self.r_grid = np.linspace(0, 1, 1025)
+    self.f_grid = expected_rate(self.r_grid, noise_std, steepness)
+    self.f0 = float(self.f_grid[0])
+    self.u = float(np.min(self.f_grid))
+    self.edges = tolerance * np.arange(bins + 1) / bins
+
+    # largest f - u within each bin, exact for the interpolated rates
+    r_edges = 1 - self.edges / tolerance
+    self.bound = np.zeros((bins, ))
+    for b in range(bins):
+      lo, hi = r_edges[b + 1], r_edges[b]
+      inner = self.f_grid[(self.r_grid > lo) & (self.r_grid < hi)]
+      self.bound[b] = max(np.max(np.interp([lo, hi], self.r_grid, self.f_grid)),
+                          np.max(inner, initial=-np.inf)) - self.u
+
+  def rate(self, distance: NDArray) -> NDArray:
+    r = np.maximum(1 - distance / self.tolerance, 0)
+    return np.interp(r, self.r_grid, self.f_grid)
+
+  def update(self, opinion: NDArray, order: NDArray):
+    self.order = order
+    self.x = opinion
+    xs = self.xs = opinion[order]
+    n = opinion.size
+    left = np.searchsorted(xs, opinion[:, np.newaxis] - self.edges, 'left')
+    right = np.searchsorted(xs, opinion[:, np.newaxis] + self.edges, 'right')
+    within = right - left
+    counts = np.diff(within, axis=1)
+    counts[:, 0] = within[:, 1]
+    self.window = left[:, -1], right[:, -1]
+    self.bin_mass = np.cumsum(counts * self.bound, axis=1)
+    self.mass = np.stack([
+        np.full((n, ), self.u * n),
+        (self.f0 - self.u) * (n - within[:, -1]),
+        self.bin_mass[:, -1],
+    ], axis=1)
+
+  def sample(
+      self,
+      rng: np.random.Generator,
+      rows: NDArray,
+      count: int,
+      random_ratio: float,
+      exclude: Callable[[NDArray, NDArray], NDArray],
+      max_rounds: int = 100,
+  ) -> NDArray:
+    """`count` distinct agents for each of `rows` drawn in turn by rate, the
+    agent itself and agents in `exclude` rejected; -1 where none is left."""
+    n = self.x.size
+    ret = np.full((rows.size, count), -1, dtype=np.int64)
+    filled = np.zeros((rows.size, ), dtype=np.int64)
+    total = np.sum(self.mass[rows], axis=1)
+    p_random = np.where(total > 0, random_ratio, 1)
+    active = np.nonzero(p_random > 0 if random_ratio > 0 else total > 0)[0]
+    if count < 1:
+      active = active[:0]
+    # drawing part of each row: -1 to choose, 0 uniform, 1 by rate; a part is
+    # kept until it yields an agent, so that its rejections do not shift
+    # the mixture
+    drawing = np.full((rows.size, ), -1, dtype=np.int64)
+    for _ in range(max_rounds * count):
+      if active.size == 0:
+        break
+      agent = rows[active]
+      x = self.x[agent]
+      rnd = rng.uniform(size=(active.size, 4))
+      choose = drawing[active] < 0
+      drawing[active[choose]] = rnd[choose, 0] >= p_random[active[choose]]
+      by_rate = drawing[active] == 1
+      cand = rng.integers(0, n, (active.size, ))
+      drawn = np.ones((active.size, ), dtype=bool)
+
+      # parts of the rates: 0 uniform, 1 outside of the window, 2 bins
+      mass = self.mass[agent]
+      part = np.argmax(np.cumsum(mass, axis=1) > rnd[:, [1]] * total[active, np.newaxis], axis=1)
+      part[~by_rate] = 0
+
+      outside = np.nonzero(part == 1)[0]
+      if outside.size:
+        lo, hi = self.window[0][agent[outside]], self.window[1][agent[outside]]
+        idx = (rnd[outside, 2] * (n - (hi - lo))).astype(np.int64)
+        idx += (idx >= lo) * (hi - lo)
+        cand[outside] = self.order[np.minimum(idx, n - 1)]
+
+      inside = np.nonzero(part == 2)[0]
+      if inside.size:
+        a, xi = agent[inside], x[inside]
+        bm = self.bin_mass[a]
+        b = np.argmax(bm > rnd[inside, 2][:, np.newaxis] * bm[:, -1:], axis=1)
+        e_lo, e_hi = self.edges[b], self.edges[b + 1]
+        l_lo = np.searchsorted(self.xs, xi - e_hi, 'left')
+        l_hi = np.searchsorted(self.xs, xi - e_lo, 'left')
+        r_lo = np.where(b == 0, l_hi, np.searchsorted(self.xs, xi + e_lo, 'right'))
+        r_hi = np.searchsorted(self.xs, xi + e_hi, 'right')
+        size = (l_hi - l_lo) + (r_hi - r_lo)
+        j = np.minimum((rnd[inside, 3] * size).astype(np.int64), size - 1)
+        idx = np.where(j < l_hi - l_lo, l_lo + j, r_lo + j - (l_hi - l_lo))
+        cand[inside] = self.order[idx]
+        ratio = (self.rate(np.abs(self.xs[idx] - xi)) - self.u) / self.bound[b]
+        drawn[inside] = rng.uniform(size=(inside.size, )) < ratio
+
+      # the agent itself has no rate, any other rejection restarts the draw
+      drawn &= cand != agent
+      drawing[active[drawn]] = -1
+      accept = drawn & ~np.any(ret[active] == cand[:, np.newaxis], axis=1)
+      accept[drawn] &= ~exclude(agent[drawn], cand[drawn])
+      hit = active[accept]
+      ret[hit, filled[hit]] = cand[accept]
+      filled[hit] += 1
+      active = active[filled[active] < count]
+    return ret
+
 
 class OpinionRandom(HKModelRecommendationSystem):
 
@@ -62,17 +268,27 @@ class OpinionRandom(HKModelRecommendationSystem):
       steepness: float = 1,
       noise_std: float = 0.1,
       random_ratio: float = 0,
+      sparse: bool = False,
+      stream: bool = False,
   ):
     super().__init__(model)
     self.tolerance = tolerance
     self.steepness = steepness
     self.noise_std = noise_std
     self.random_ratio = random_ratio
+    # sample from the expected rates over the noise by `WindowSampler`
+    # instead of building the noisy dense rate matrix
+    self.sparse = sparse
+    self.sampler: Optional[WindowSampler] = None
+    # compute the rates of a block of rows when recommending instead of
+    # building the dense rate matrix
+    self.stream = stream
     
     self.num_nodes = 0
     self.agents: List[HKAgent] = []
     self.all_indices = np.zeros((0, ), dtype=int)
     self.rate_mat = np.zeros((0, ), dtype=float)
+    self.opinion = np.zeros((0, ), dtype=float)
     
   def post_init(self, dump_data: Optional[Any] = None):
     self.num_nodes = self.model.graph.number_of_nodes()
@@ -82,26 +298,44 @@ class OpinionRandom(HKModelRecommendationSystem):
     if self.agents:
       assert self.agents[0].unique_id == 0
       assert self.agents[-1].unique_id == self.num_nodes - 1
+    if self.sparse:
+      self.sampler = WindowSampler(self.tolerance, self.noise_std, self.steepness)
+      self.order = np.arange(self.num_nodes)
     
   def pre_step(self):
+    if self.sampler is not None:
+      opinion = self.model.get_opinion()
+      self.order = self.order[np.argsort(opinion[self.order], kind='stable')]
+      self.sampler.update(opinion, self.order)
+      return
+
+    opinion = np.array([x.cur_opinion for x in self.agents], dtype=float)
+    if self.stream:
+      self.opinion = opinion
+      return
+    
+    noise_mat = self.draw_noise('normal', 0, self.noise_std, (self.num_nodes, self.num_nodes)) \
+        if self.noise_std > 0 else None
+    
+    # expose rate matrix
+    self.rate_mat = self.rates(opinion, self.all_indices, noise_mat)
+    
+  def rates(self, opinion: NDArray, rows: NDArray, noise_mat: Optional[NDArray]) -> NDArray:
     # calculate difference matrix
-    opinion = np.array([x.cur_opinion for x in self.agents], dtype=float).reshape((1, -1))
-    opinion_mat = np.repeat(opinion, self.num_nodes, axis=0)
-    opinion_diff_mat = np.abs(opinion_mat - opinion_mat.T)
+    opinion_diff_mat = np.abs(opinion.reshape((1, -1)) - opinion[rows].reshape((-1, 1)))
     
     # calculate rate matrix based on differences
     
-    _i = np.diag_indices(self.num_nodes)
+    _i = (np.arange(rows.size), rows)
     
     raw_rate_mat = 1 - opinion_diff_mat / self.tolerance
     raw_rate_mat[raw_rate_mat < 0] = 0
     
-    if self.noise_std > 0:
-      noise_mat = np.random.normal(0, self.noise_std, raw_rate_mat.shape)
+    if noise_mat is not None:
       raw_rate_mat = raw_rate_mat * (1 - 2 * noise_mat) + noise_mat
       raw_rate_mat[raw_rate_mat < 0] = 0
       
-    np.fill_diagonal(raw_rate_mat, 0)
+    raw_rate_mat[_i] = 0
     
     if self.steepness != 1:
       raw_rate_mat = raw_rate_mat ** self.steepness
@@ -112,21 +346,37 @@ class OpinionRandom(HKModelRecommendationSystem):
     rate_mat = raw_rate_mat * rate_sum_rev
     if self.random_ratio > 0:
       rate_mat = (1 - self.random_ratio) * rate_mat + self.random_ratio / (self.num_nodes - 1)
-    np.fill_diagonal(rate_mat, 0)
-    
-    # expose rate matrix
-    self.rate_mat = rate_mat
+    rate_mat[_i] = 0
+    return rate_mat
   
+  def rate_rows(self, rows: NDArray) -> NDArray:
+    if not self.stream:
+      return self.rate_mat[rows]
+    noise_mat = self.model.rng.normal(0, self.noise_std, (rows.size, self.num_nodes)) \
+        if self.noise_std > 0 else None
+    return self.rates(self.opinion, rows, noise_mat)
     
   def recommend(self, agent: HKAgent, neighbors: List[HKAgent], count: int) -> List[HKAgent]:
     neighbor_ids = np.array([x.unique_id for x in neighbors + [agent]], dtype=int)
-    raw_rate_vec = self.rate_mat[agent.unique_id]
+    if self.sampler is not None:
+      ret = self.sampler.sample(
+          self.model.rng, np.array([agent.unique_id]), count, self.random_ratio,
+          lambda _, c: np.isin(c, neighbor_ids))[0]
+      return [self.agents[c] for c in ret[ret >= 0]]
     
-    rate_vec = np.copy(raw_rate_vec)
+    rate_vec = self.rate_rows(np.array([agent.unique_id]))[0]
     rate_vec[neighbor_ids] = 0
-    rate_vec /= np.sum(rate_vec)
-    
-    candidates = np.random.choice(self.all_indices, (count,), replace=False, p=rate_vec)
-    ret = [self.agents[c] for c in candidates]
+    candidates = gumbel_top_k(self.model.rng, rate_vec[np.newaxis], count)[0]
+    ret = [self.agents[c] for c in candidates[candidates >= 0]]
     return ret
-    
+
+  def recommend_all(self, opinion: NDArray, indptr: NDArray, indices: NDArray, count: int, mask: Optional[NDArray] = None) -> NDArray:
+    rows = np.arange(self.num_nodes) if mask is None else np.nonzero(mask)[0]
+    if self.sampler is not None:
+      keys = follow_keys(indptr, indices)
+      ret = np.full((self.num_nodes, count), -1, dtype=np.int64)
+      ret[rows] = self.sampler.sample(
+          self.model.rng, rows, count, self.random_ratio,
+          lambda r, c: is_excluded(r, c, indptr, indices, keys))
+      return ret
+    return sample_rows(self.model.rng, self.rate_rows, indptr, indices, count, rows)
@@ -1,6 +1,8 @@
 from typing import List, Dict, Optional, Any
 import numpy as np
+from numpy.typing import NDArray
 from base import HKAgent, HKModelRecommendationSystem, HKModel
+from base.recsys import is_excluded, fill_rows
 
 
 class Random(HKModelRecommendationSystem):
@@ -19,10 +21,22 @@ class Random(HKModelRecommendationSystem):
       self.agent_map[a.unique_id] = a
       
   def pre_step(self):
-    self.candidates = np.random.randint(0, self.num_nodes, (self.num_nodes, self.rec_count))
+    self.candidates = self.draw_noise(
+        'integers', 0, self.num_nodes, (self.num_nodes, self.rec_count))
 
   def recommend(self, agent: HKAgent, neighbors: List[HKAgent], count: int) -> List[HKAgent]:
     exclude_ids = np.array([x.unique_id for x in neighbors + [agent]])
     candidates = self.candidates[agent.unique_id]
     ret = np.setdiff1d(candidates, exclude_ids)
     return [self.agent_map[a] for a in ret[:count]]
+
+  def recommend_all(self, opinion: NDArray, indptr: NDArray, indices: NDArray, count: int, mask: Optional[NDArray] = None) -> NDArray:
+    # sorted distinct candidates without neighbors, as in `recommend`
+    candidates = np.sort(self.candidates, axis=1)
+    rows = np.repeat(np.arange(self.num_nodes), candidates.shape[1])
+    candidates = candidates.flatten()
+    keep = ~is_excluded(rows, candidates, indptr, indices)
+    keep[1:] &= (candidates[1:] != candidates[:-1]) | (rows[1:] != rows[:-1])
+    if mask is not None:
+      keep &= mask[rows]
+    return fill_rows(rows[keep], candidates[keep], count, self.num_nodes)
@@ -1,10 +1,18 @@
-from typing import List, Dict, Optional, Callable, Any
+from typing import List, Dict, Optional, Callable, Any, Iterator, Tuple
+import os
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
-from tqdm import tqdm
 import networkx as nx
+import scipy.sparse as sp
+from scipy.sparse.linalg import eigsh
+from scipy.special import gamma, ndtri
 
+from numpy.typing import NDArray
 from base import HKAgent, HKModel, HKModelRecommendationSystem
+from base.graph import graph_to_csr
+from base.parallel import split_rows
+from base.recsys import sample_rows, top_rows, gumbel_top_k, top_k, is_excluded, fill_rows, row_positions
 
 
 def common_neighbors_count(G: nx.DiGraph, u: int, v: int):
@@ -12,11 +20,345 @@ def common_neighbors_count(G: nx.DiGraph, u: int, v: int):
   i2 = len([w for w in G._succ[u] if w in G._pred[v] or w in G._succ[v]])
   return i1 + i2
 
-short_progress_bar="{l_bar}{bar:10}{r_bar}{bar:-10b}"
+
+def symmetric_adjacency(indptr: NDArray, indices: NDArray, n: int) -> sp.csr_array:
+  # A + A^T of the follow adjacency A
+  adj = sp.csr_array(
+      (np.ones((indices.size, ), dtype=np.int64), indices, indptr), shape=(n, n))
+  return (adj + adj.T).tocsr()
+
+
+def drop_diagonal(mat: sp.csr_array) -> sp.csr_array:
+  mat = (mat - sp.diags_array(mat.diagonal(), dtype=mat.dtype)).tocsr()
+  mat.eliminate_zeros()
+  return mat
+
+
+def common_neighbors_matrix(indptr: NDArray, indices: NDArray, n: int) -> sp.csr_array:
+  """Counts `(A + A^T)^2` of the follow adjacency `A` in CSR form, symmetric
+  and without the diagonal."""
+  adj = symmetric_adjacency(indptr, indices, n)
+  return drop_diagonal(adj @ adj)
+
+
+def legacy_common_neighbors(
+    indptr: NDArray,
+    indices: NDArray,
+    n: int,
+    rows: Optional[NDArray] = None,
+    cols: Optional[NDArray] = None,
+) -> NDArray:
+  """`common_neighbors_count` of the pairs `rows` x `cols`, all agents by
+  default: `S B` with `S = A + A^T` and `B` the pattern of `S`."""
+  adj = symmetric_adjacency(indptr, indices, n)
+  pattern = (adj > 0).astype(np.int64)
+  if rows is not None:
+    adj = adj[rows]
+  if cols is not None:
+    pattern = pattern[:, cols]
+  return (adj @ pattern).toarray()
+
+
+_block_adj: Optional[sp.csr_array] = None
+
+
+def _init_block_worker(adj: sp.csr_array):
+  global _block_adj
+  _block_adj = adj
+
+
+def _count_block(lo: int, hi: int) -> Tuple[int, sp.csr_array]:
+  return lo, (_block_adj[lo: hi] @ _block_adj).tocsr()
+
+
+def common_neighbors_blocks(
+    indptr: NDArray,
+    indices: NDArray,
+    n: int,
+    workers: int = 1,
+) -> Iterator[Tuple[int, sp.csr_array]]:
+  """Row blocks `(lo, rows)` of `(A + A^T)^2` including the diagonal, counted
+  on `workers` processes and yielded as they are done.
+
+  Blocks have about the same number of products, so hubs do not stall a
+  worker.
+  """
+  adj = symmetric_adjacency(indptr, indices, n)
+  work = np.zeros((n + 1, ), dtype=np.int64)
+  np.cumsum(adj @ np.diff(adj.indptr), out=work[1:])
+  bounds = split_rows(work, max(4 * workers, n // 1024 + 1))
+  blocks = list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+  if workers <= 1:
+    _init_block_worker(adj)
+    for lo, hi in blocks:
+      yield _count_block(lo, hi)
+    return
+  with ProcessPoolExecutor(
+      workers, initializer=_init_block_worker, initargs=(adj, )) as executor:
+    futures = [executor.submit(_count_block, lo, hi) for lo, hi in blocks]
+    for f in as_completed(futures):
+      yield f.result()
+
+
+def common_neighbors_delta(indptr: NDArray, indices: NDArray, n: int, rewired: NDArray) -> sp.csr_array:
+  """Change of `common_neighbors_matrix` by the rewirings `rewired`, rows of
+  (agent, unfollowed, followed), given the graph after them.
+
+  With `S = A + A^T` changed by `D`, `S_new^2 - S_old^2 = S_old D + D S_new`,
+  and `S_old D = (D S_new)^T - D^2` as both are symmetric. A changed edge
+  (a, b) touches the pairs (a, w) for the neighbors w of b and vice versa.
+  """
+  agent, unfollow, follow = rewired.T
+  rows = np.concatenate((agent, unfollow, agent, follow))
+  cols = np.concatenate((unfollow, agent, follow, agent))
+  data = np.repeat(np.array([-1, 1], dtype=np.int64), 2 * agent.size)
+  d = sp.csr_array((data, (rows, cols)), shape=(n, n))
+  x = d @ symmetric_adjacency(indptr, indices, n)
+  return drop_diagonal(x + x.T - d @ d)
+
+
+def low_rank_factors(
+    indptr: NDArray,
+    indices: NDArray,
+    n: int,
+    rank: int,
+    rng: Optional[np.random.Generator] = None,
+) -> NDArray:
+  """Factors `F` with `F F^T` the best rank `rank` approximation of
+  `(A + A^T)^2`, from the eigenpairs of `A + A^T` largest in magnitude."""
+  adj = symmetric_adjacency(indptr, indices, n).astype(float)
+  v0 = rng.standard_normal(n) if rng is not None else None
+  vals, vecs = eigsh(adj, k=min(rank, n - 1), which='LM', v0=v0)
+  return vecs * np.abs(vals)
+
+
+def low_rank_error(
+    conn_mat: sp.csr_array,
+    factors: NDArray,
+    count: int = 10,
+    block_size: int = 1 << 20,
+) -> Dict[str, float]:
+  """Relative Frobenius error of `factors` against the exact counts
+  `conn_mat`, and the share of the `count` best candidates per agent (by
+  exact count, ties included) among the best `count` by approximate count."""
+  n = conn_mat.shape[0]
+  err = norm = hits = total = 0
+  step = max(1, block_size // max(n, 1))
+  for s in range(0, n, step):
+    rows = np.arange(s, min(n, s + step))
+    idx = np.arange(rows.size)[:, np.newaxis]
+    exact = conn_mat[rows].toarray().astype(float)
+    approx = factors[rows] @ factors.T
+    approx[idx[:, 0], rows] = 0
+    err += np.sum((approx - exact) ** 2)
+    norm += np.sum(exact ** 2)
+
+    keys = exact * n + (n - 1 - np.arange(n))
+    keys[idx[:, 0], rows] = -1
+    best = top_k(keys, count, n - 1)
+    approx[idx[:, 0], rows] = -np.inf
+    picked = top_k(approx, count, -np.inf)
+    valid = best >= 0
+    threshold = np.where(valid, exact[idx, best], np.inf).min(axis=1, initial=np.inf)
+    hit = (picked >= 0) & (exact[idx, picked] >= threshold[:, np.newaxis])
+    hits += np.minimum(hit.sum(axis=1), valid.sum(axis=1)).sum()
+    total += valid.sum()
+  return {
+      'frobenius': float(np.sqrt(err / norm)) if norm > 0 else 0.,
+      'recall': float(hits / total) if total > 0 else 1.,
+  }
+
+
+def positive_moment(p: float) -> float:
+  # E[max(Z, 0) ** p] of a standard normal Z
+  return 2 ** (p / 2) * gamma((p + 1) / 2) / (2 * np.sqrt(np.pi))
+
+
+class TwoHopSampler:
+  """Recommendations of `Structure` from the sparse counts in the time of
+  the two-hop neighborhoods instead of all agents.
+
+  Outside of its two-hop neighborhood, the counts of an agent are zero, so
+  the noisy rates `max(noise, 0) ** steepness` of these agents, the rest,
+  are independent and identically distributed. Noise is only drawn for the
+  agents with nonzero counts and the followed ones; the sum of the rest
+  enters the normalization by its normal approximation. Picks then alternate
+  between the explicit candidates, in the order of their exponential race,
+  and a uniform agent of the rest, with the probabilities of successive
+  sampling; the mass of the rest drops by the size-biased mean of its rates
+  per pick. Both approximations are of the order of `count` over the size
+  of the rest.
+
+  With infinite steepness the largest noisy rates of the rest are drawn
+  exactly from the order statistics of the noise.
+  """
+
+  def __init__(
+      self,
+      noise_std: float,
+      steepness: Optional[float],
+      random_ratio: float,
+      block_size: int = 1 << 20,
+  ):
+    self.noise_std = noise_std
+    self.steepness = steepness
+    self.random_ratio = random_ratio
+    self.block_size = block_size
+    # moments of the rates of the rest before normalization
+    self.mean = self.var = 0.
+    if steepness is not None and noise_std > 0:
+      self.mean = noise_std ** steepness * positive_moment(steepness)
+      self.var = noise_std ** (2 * steepness) * positive_moment(2 * steepness) - self.mean ** 2
+
+  def explicit(self, conn_mat: sp.csr_array, rows: NDArray, indptr: NDArray, indices: NDArray):
+    # keys `i * n + agent` with the counts of the agents with nonzero counts
+    # or followed by the `i`-th of `rows`, sorted; `indptr` and `indices`
+    # are the follow graph of `rows`
+    n = conn_mat.shape[0]
+    c_rep, c_pos = row_positions(conn_mat.indptr, rows)
+    f_rep = np.repeat(np.arange(rows.size), np.diff(indptr))
+    key = np.concatenate((c_rep * n + conn_mat.indices[c_pos], f_rep * n + indices))
+    count = np.concatenate((conn_mat.data[c_pos], np.zeros((f_rep.size, ), dtype=conn_mat.data.dtype)))
+    followed = np.concatenate((np.zeros((c_pos.size, ), dtype=bool), np.ones((f_rep.size, ), dtype=bool)))
+    if key.size == 0:
+      return key, count, followed
+    order = np.argsort(key, kind='stable')
+    key, count, followed = key[order], count[order], followed[order]
+    first = np.flatnonzero(np.concatenate(([True], key[1:] != key[:-1])))
+    return key[first], np.add.reduceat(count, first), np.logical_or.reduceat(followed, first)
+
+  def noisy(self, rng: np.random.Generator, count: NDArray) -> NDArray:
+    raw = count.astype(float)
+    if self.noise_std > 0:
+      noise = rng.normal(0, self.noise_std, raw.shape)
+      raw = raw * (1 - 2 * noise) + noise
+      raw[raw < 0] = 0
+    return raw
+
+  @staticmethod
+  def pick_rest(rng: np.random.Generator, n: int, rows: NDArray, key: NDArray, ret: NDArray, targets: NDArray, k: int):
+    # uniform agents of the rest, not picked yet, for rows `targets` at `k`
+    pending = targets
+    while pending.size:
+      c = rng.integers(0, n, pending.size)
+      c_keys = pending * n + c
+      pos = np.minimum(np.searchsorted(key, c_keys), max(key.size - 1, 0))
+      known = key[pos] == c_keys if key.size else np.zeros_like(c, dtype=bool)
+      ok = ~known & (c != rows[pending]) & ~np.any(ret[pending, :k] == c[:, np.newaxis], axis=1)
+      ret[pending[ok], k] = c[ok]
+      pending = pending[~ok]
+
+  def blocks(self, conn_mat: sp.csr_array, rows: NDArray, indptr: NDArray):
+    # row ranges with about `block_size` explicit entries
+    work = np.cumsum(conn_mat.indptr[rows + 1] - conn_mat.indptr[rows] + np.diff(indptr) + 1)
+    bounds = np.searchsorted(work, np.arange(1, work[-1] // self.block_size + 1) * self.block_size) \
+        if rows.size else np.zeros((0, ), dtype=np.int64)
+    bounds = np.unique(np.concatenate(([0], bounds, [rows.size])))
+    return zip(bounds[:-1].tolist(), bounds[1:].tolist())
+
+  def sample(
+      self,
+      rng: np.random.Generator,
+      conn_mat: sp.csr_array,
+      rows: NDArray,
+      count: int,
+      indptr: NDArray,
+      indices: NDArray,
+  ) -> NDArray:
+    """`count` recommendations for each of `rows`, padded with -1, given the
+    follow graph `indptr`, `indices` of `rows`."""
+    ret = np.full((rows.size, count), -1, dtype=np.int64)
+    draw = self.sample_block if self.steepness is not None else self.top_block
+    for lo, hi in self.blocks(conn_mat, rows, indptr):
+      f_indptr = indptr[lo: hi + 1] - indptr[lo]
+      f_indices = indices[indptr[lo]: indptr[hi]]
+      ret[lo: hi] = draw(rng, conn_mat, rows[lo: hi], count, f_indptr, f_indices)
+    return ret
+
+  def sample_block(self, rng, conn_mat, rows, count, indptr, indices) -> NDArray:
+    n, b = conn_mat.shape[0], rows.size
+    key, c, followed = self.explicit(conn_mat, rows, indptr, indices)
+    row = key // n
+    rest_size = n - 1 - np.bincount(row, minlength=b)
+    w = self.noisy(rng, c)
+    if self.steepness != 1:
+      w = w ** self.steepness
+    rest = np.zeros((b, ))
+    if self.noise_std > 0:
+      rest = np.maximum(rest_size * self.mean + np.sqrt(rest_size * self.var) * rng.standard_normal(b), 0)
+    total = np.bincount(row, weights=w, minlength=b) + rest
+
+    # rates as in `Structure.rates`; rows without any weight are all NaN
+    # there and get no recommendations
+    live = total > 0
+    scale = np.where(live, (1 - self.random_ratio) / np.where(live, total, 1), 0)
+    uniform = self.random_ratio / (n - 1)
+    rate = np.where(live[row] & ~followed, w * scale[row] + uniform, 0)
+    rest_rate = np.where(live, rest * scale + rest_size * uniform, 0)
+    # size-biased mean rate of the rest, dropped from its mass per pick
+    second = scale ** 2 * (self.var + self.mean ** 2) + 2 * scale * uniform * self.mean + uniform ** 2
+    first = scale * self.mean + uniform
+    drop = np.divide(second, first, out=np.zeros((b, )), where=first > 0)
+
+    # explicit candidates in the order of the exponential race
+    cand = rate > 0
+    e_row, e_agent, e_rate = row[cand], key[cand] % n, rate[cand]
+    order = np.argsort(-e_rate / rng.standard_exponential(e_rate.size))
+    order = order[np.argsort(e_row[order], kind='stable')]
+    e_agent, e_rate = e_agent[order], e_rate[order]
+    end = np.cumsum(np.bincount(e_row, minlength=b))
+    ptr = end - np.bincount(e_row, minlength=b)
+    left = np.bincount(e_row, weights=e_rate, minlength=b)
+
+    ret = np.full((b, count), -1, dtype=np.int64)
+    for k in range(count):
+      u = rng.random(b) * (left + rest_rate)
+      to_rest = (u < rest_rate) & (rest_size > 0)
+      to_explicit = ~to_rest & (ptr < end)
+      i = np.flatnonzero(to_explicit)
+      ret[i, k] = e_agent[ptr[i]]
+      left[i] = np.maximum(left[i] - e_rate[ptr[i]], 0)
+      ptr[i] += 1
+      left[ptr >= end] = 0
+      i = np.flatnonzero(to_rest)
+      self.pick_rest(rng, n, rows, key, ret, i, k)
+      rest_size[i] -= 1
+      rest_rate[i] = np.where(rest_size[i] > 0, np.maximum(rest_rate[i] - drop[i], 0), 0)
+    return ret
+
+  def top_block(self, rng, conn_mat, rows, count, indptr, indices) -> NDArray:
+    n, b = conn_mat.shape[0], rows.size
+    key, c, followed = self.explicit(conn_mat, rows, indptr, indices)
+    row = key // n
+    rest_size = n - 1 - np.bincount(row, minlength=b)
+    raw = self.noisy(rng, c)
+    cand = ~followed
+
+    # the `count` largest noisy rates of the rest from the order statistics
+    # of `rest_size` uniforms, taken from the top
+    j = np.arange(count)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      u = np.exp(np.cumsum(np.log(rng.random((b, count))) / (rest_size[:, np.newaxis] - j), axis=1))
+      rest_raw = np.maximum(self.noise_std * ndtri(u), 0)
+    rest_raw[j >= rest_size[:, np.newaxis]] = -np.inf
+
+    value = np.concatenate((raw[cand], rest_raw.ravel()))
+    owner = np.concatenate((row[cand], np.repeat(np.arange(b), count)))
+    agent = np.concatenate((key[cand] % n, np.full((b * count, ), -2, dtype=np.int64)))
+    keep = value > -np.inf
+    value, owner, agent = value[keep], owner[keep], agent[keep]
+    order = np.lexsort((-value, owner))
+    ret = fill_rows(owner[order], agent[order], count, b)
+    for k in range(count):
+      self.pick_rest(rng, n, rows, key, ret, np.flatnonzero(ret[:, k] == -2), k)
+    return ret
+
 
 class Structure(HKModelRecommendationSystem):
 
   num_nodes = 0
+  # refreshes of the low rank factors log their error up to this many agents
+  error_report_nodes = 2000
 
   def __init__(
       self,
@@ -27,6 +369,26 @@ class Structure(HKModelRecommendationSystem):
       random_ratio: float = 0,
       
       matrix_init: bool = False,
+      # keep the counts in a sparse matrix and compute rates per row
+      sparse: bool = False,
+      # compute rates per row with the dense counts as well
+      stream: bool = False,
+      # processes counting common neighbors without matrix_init, 0 for all cores
+      workers: int = 1,
+      # sample from the sparse counts by `TwoHopSampler`
+      two_hop: bool = False,
+      # approximate the counts by rank `low_rank` factors of A + A^T, refreshed
+      # every `refresh_interval` steps or after `refresh_rewirings` rewirings
+      low_rank: Optional[int] = None,
+      refresh_interval: int = 10,
+      refresh_rewirings: Optional[int] = None,
+      # count by `common_neighbors_count` and only update the pairs of
+      # rewired agents after a step, as older versions did
+      legacy_counts: bool = False,
+      # with infinite steepness, recommend the agents with the highest rates;
+      # older versions recommended the agents with the lowest ids whatever
+      # their rates, which stays the default
+      top_rates: bool = False,
       log: Optional[Callable[[str], None]] = None,
   ):
     super().__init__(model)
@@ -36,15 +398,36 @@ class Structure(HKModelRecommendationSystem):
     self.random_ratio = random_ratio
     
     self.matrix_init = matrix_init
+    if low_rank is not None and two_hop:
+      raise ValueError('Two-hop sampling needs the exact counts.')
+    if legacy_counts and (sparse or two_hop or low_rank is not None):
+      raise ValueError('Legacy counts are only kept in the dense matrix.')
+    self.legacy_counts = legacy_counts
+    # recommendations by id only, the rates are not needed
+    self.by_id = steepness is None and not top_rates
+    self.low_rank = low_rank
+    self.refresh_interval = refresh_interval
+    self.refresh_rewirings = refresh_rewirings
+    self.sparse = sparse or two_hop
+    self.stream = stream or self.sparse or low_rank is not None
+    self.sampler: Optional[TwoHopSampler] = None
+    if two_hop and not self.by_id and (steepness is not None or noise_std > 0):
+      self.sampler = TwoHopSampler(noise_std, steepness, random_ratio)
+    self.workers = workers if workers > 0 else (os.cpu_count() or 1)
     self.log = log
     
     # placeholders
     self.rate_mat = self.conn_mat = self.all_indices = np.zeros((0, 0))
+    # candidates by descending count for steepness None without noise
+    self.top = np.zeros((0, 0), dtype=np.int64)
+    # low rank factors and the steps and rewirings since their refresh
+    self.factors = np.zeros((0, 0))
+    self.steps = self.rewirings = 0
     self.agent_map: Dict[int, HKAgent] = {}
     self.num_nodes = 0
     
   def dump(self) -> Any:
-    return self.conn_mat
+    return self.factors if self.low_rank is not None else self.conn_mat
 
   def post_init(self, dump_data: Optional[Any] = None):
     self.num_nodes = n = self.model.graph.number_of_nodes()
@@ -54,51 +437,107 @@ class Structure(HKModelRecommendationSystem):
     for a in self.model.schedule.agents:
       self.agent_map[a.unique_id] = a
     
+    if self.low_rank is not None:
+      if isinstance(dump_data, np.ndarray) and dump_data.shape == (n, min(self.low_rank, n - 1)):
+        self.factors = dump_data
+      else:
+        self.refresh()
     # load connection matrix if dumped
-    if dump_data is not None:
+    elif dump_data is not None:
+      if self.sparse and not sp.issparse(dump_data):
+        dump_data = sp.csr_array(dump_data + dump_data.T)
+      elif not self.sparse and sp.issparse(dump_data):
+        dump_data = np.triu(dump_data.toarray())
       self.conn_mat = dump_data
       if self.log:
         self.log('Connection matrix loaded from dump data.')
-      return
-    
+    else:
+      self.conn_mat = self.count_matrix()
+      
+    # the best candidates only change with the counts without noise
+    if self.steepness is None and self.noise_std == 0 and not self.by_id:
+      width = self.model.p.recsys_count + int(np.max(np.diff(self.follow_csr()[0]), initial=0))
+      self.top = self.top_candidates(self.all_indices, width)
+
+  def count_matrix(self) -> Any:
     # calculate full connection matrix 
-    # recommend to use matrix calculation if n <= 1500
     
     tstart = time.time()
-    if self.matrix_init:
+    if self.matrix_init and not self.sparse:
       adj_mat = nx.to_numpy_array(self.model.graph, dtype=int)
       adj_mat += adj_mat.T
-      self.conn_mat = np.array(adj_mat @ adj_mat)
+      conn_mat = np.array(adj_mat @ adj_mat)
     
+    elif self.legacy_counts:
+      conn_mat = legacy_common_neighbors(*self.follow_csr(), self.num_nodes)
+
     else:
-      conn_mat = np.zeros((n, n), dtype=int)
-      G = self.model.graph
-      for u in tqdm(range(0, self.num_nodes), bar_format=short_progress_bar):
-        for v in range(u + 1, self.num_nodes):  # v > u
-          conn_mat[u, v] = common_neighbors_count(G, u, v)
-      self.conn_mat = conn_mat
+      conn_mat = self.count_blocks()
       
     # set irrelevant elements to 0
-    self.conn_mat = np.triu(self.conn_mat)
-    np.fill_diagonal(self.conn_mat, 0)
+    if not self.sparse:
+      conn_mat = np.triu(conn_mat)
+      np.fill_diagonal(conn_mat, 0)
     
     
     tend = time.time()
     if self.log:
       self.log(f'Connection matrix generation costs {tend - tstart}s.')
-      
-    
+    return conn_mat
 
-  def pre_step(self):
-    
-    raw_rate_mat = self.conn_mat + self.conn_mat.T
-    
-    if self.noise_std > 0:
-      noise_mat = np.random.normal(0, self.noise_std, raw_rate_mat.shape)
+  def count_blocks(self):
+    # counts from the sparse adjacency, in row blocks
+    n = self.num_nodes
+    conn_mat = None if self.sparse else np.zeros((n, n), dtype=int)
+    pieces: List[Tuple[int, sp.csr_array]] = []
+    done = reported = 0
+    for lo, rows in common_neighbors_blocks(*self.follow_csr(), n, self.workers):
+      if self.sparse:
+        pieces.append((lo, rows))
+      else:
+        conn_mat[lo: lo + rows.shape[0]] = rows.toarray()
+      done += rows.shape[0]
+      if self.log and (done - reported) * 10 >= n:
+        reported = done
+        self.log(f'Connection matrix: {done}/{n} rows counted.')
+    if not self.sparse:
+      return conn_mat
+    pieces.sort(key=lambda x: x[0])
+    return drop_diagonal(sp.vstack([rows for _, rows in pieces], format='csr'))
+
+  def refresh(self):
+    # recompute the low rank factors from the current graph
+    tstart = time.time()
+    indptr, indices = self.follow_csr()
+    self.factors = low_rank_factors(
+        indptr, indices, self.num_nodes, self.low_rank, self.model.rng)
+    self.steps = self.rewirings = 0
+    if self.top.size:
+      self.top = self.top_candidates(self.all_indices, self.top.shape[1])
+    if self.log:
+      self.log(f'Low rank factors refreshed in {time.time() - tstart}s.')
+      if self.num_nodes <= self.error_report_nodes:
+        self.log(f'Low rank approximation error: {self.approximation_error()}')
+
+  def approximation_error(self, count: Optional[int] = None) -> Dict[str, float]:
+    """Error of the low rank factors against the exact counts of the
+    current graph, see `low_rank_error`; quadratic in the number of agents."""
+    exact = common_neighbors_matrix(*self.follow_csr(), self.num_nodes)
+    return low_rank_error(exact, self.factors, count or self.model.p.recsys_count)
+
+  def follow_csr(self):
+    engine = self.model.engine
+    if engine is not None:
+      return engine.graph.csr()
+    return graph_to_csr(self.model.graph, self.num_nodes)
+
+  def rates(self, raw_rate_mat: NDArray, rows: NDArray, noise_mat: Optional[NDArray]) -> NDArray:
+    # rates of agents `rows` from their counts `raw_rate_mat` against all agents
+    if noise_mat is not None:
       raw_rate_mat = raw_rate_mat * (1 - 2 * noise_mat) + noise_mat
       raw_rate_mat[raw_rate_mat < 0] = 0
       
-    np.fill_diagonal(raw_rate_mat, 0)
+    raw_rate_mat[np.arange(rows.size), rows] = 0
     
     if self.steepness is not None and self.steepness != 1:
       raw_rate_mat = raw_rate_mat ** self.steepness
@@ -109,39 +548,145 @@ class Structure(HKModelRecommendationSystem):
       rate_mat = raw_rate_mat * rate_sum_rev
       if self.random_ratio > 0:
         rate_mat = (1 - self.random_ratio) * rate_mat + self.random_ratio / (self.num_nodes - 1)
-      np.fill_diagonal(rate_mat, 0)
+      rate_mat[np.arange(rows.size), rows] = 0
     else:
       rate_mat = raw_rate_mat
+    return rate_mat
+
+  def count_rows(self, rows: NDArray) -> NDArray:
+    if self.low_rank is not None:
+      # counts are integers, so are their approximations
+      return np.rint(np.maximum(self.factors[rows] @ self.factors.T, 0))
+    if self.sparse:
+      return self.conn_mat[rows].toarray()
+    return self.conn_mat[rows] + self.conn_mat[:, rows].T
+
+  def rate_rows(self, rows: NDArray) -> NDArray:
+    if not self.stream:
+      return self.rate_mat[rows]
+    noise_mat = self.model.rng.normal(0, self.noise_std, (rows.size, self.num_nodes)) \
+        if self.noise_std > 0 else None
+    return self.rates(self.count_rows(rows), rows, noise_mat)
+
+  def top_candidates(self, rows: NDArray, width: int, block_size: int = 1 << 20) -> NDArray:
+    # `width` agents per row by descending count, then ascending id
+    n = self.num_nodes
+    ret = np.full((rows.size, width), -1, dtype=np.int64)
+    step = max(1, block_size // max(n, 1))
+    for s in range(0, rows.size, step):
+      r = rows[s: s + step]
+      keys = self.count_rows(r).astype(np.int64) * n + (n - 1 - np.arange(n))
+      keys[np.arange(r.size), r] = -1
+      ret[s: s + step] = top_k(keys, width, -1)
+    return ret
+
+  def pre_step(self):
+    if self.stream or self.top.size or self.by_id:
+      # rates are computed per row when recommending, the cached candidates
+      # do not need them
+      return
+    
+    raw_rate_mat = self.conn_mat + self.conn_mat.T
+    noise_mat = self.draw_noise('normal', 0, self.noise_std, raw_rate_mat.shape) \
+        if self.noise_std > 0 else None
       
     # expose rate matrix
-    self.rate_mat = rate_mat
+    self.rate_mat = self.rates(raw_rate_mat, self.all_indices, noise_mat)
     
 
   def recommend(self, agent: HKAgent, neighbors: List[HKAgent], count: int) -> List[HKAgent]:
     neighbor_ids = np.array([x.unique_id for x in neighbors + [agent]], dtype=int)
-    raw_rate_vec = self.rate_mat[agent.unique_id]
+    rows = np.array([agent.unique_id])
 
     ret: np.ndarray
-    if self.steepness is None:
-      ret = np.setdiff1d(np.argpartition(
-          raw_rate_vec, len(neighbors) + count), neighbor_ids)
+    if self.by_id:
+      ret = np.setdiff1d(np.arange(min(count + len(neighbor_ids), self.num_nodes)), neighbor_ids)
+    elif self.sampler is not None:
+      ret = self.sampler.sample(
+          self.model.rng, self.conn_mat, rows, count,
+          np.array([0, len(neighbors)]), neighbor_ids[:-1])[0]
+      ret = ret[ret >= 0]
+    elif self.steepness is None and self.noise_std == 0:
+      width = count + len(neighbors)
+      ret = self.top[agent.unique_id] if width <= self.top.shape[1] \
+          else self.top_candidates(rows, width)[0]
+      ret = ret[(ret >= 0) & ~np.isin(ret, neighbor_ids)]
+    elif self.steepness is None:
+      rate_vec = self.rate_rows(rows)[0]
+      rate_vec[neighbor_ids] = -np.inf
+      ret = top_k(rate_vec[np.newaxis], count, -np.inf)[0]
+      ret = ret[ret >= 0]
     else:
-      rate_vec = np.copy(raw_rate_vec)
+      rate_vec = self.rate_rows(rows)[0]
       rate_vec[neighbor_ids] = 0
-      rate_vec /= np.sum(rate_vec)
-      ret = np.random.choice(self.all_indices, (count,), replace=False, p=rate_vec)
+      ret = gumbel_top_k(self.model.rng, rate_vec[np.newaxis], count)[0]
+      ret = ret[ret >= 0]
 
     return [self.agent_map[i] for i in ret[:count]]
 
+  def recommend_all(self, opinion: NDArray, indptr: NDArray, indices: NDArray, count: int, mask: Optional[NDArray] = None) -> NDArray:
+    rows = np.arange(self.num_nodes) if mask is None else np.nonzero(mask)[0]
+    if self.by_id:
+      # the agents with the lowest ids that are not excluded
+      width = min(count + 1 + int(np.max(np.diff(indptr), initial=0)), self.num_nodes)
+      rep = np.repeat(rows, width)
+      cand = np.tile(np.arange(width), rows.size)
+      keep = ~is_excluded(rep, cand, indptr, indices)
+      return fill_rows(rep[keep], cand[keep], count, self.num_nodes)
+    if self.sampler is not None:
+      rep, pos = row_positions(indptr, rows)
+      f_indptr = np.zeros((rows.size + 1, ), dtype=np.int64)
+      np.cumsum(np.bincount(rep, minlength=rows.size), out=f_indptr[1:])
+      ret = np.full((self.num_nodes, count), -1, dtype=np.int64)
+      ret[rows] = self.sampler.sample(self.model.rng, self.conn_mat, rows, count, f_indptr, indices[pos])
+      return ret
+    if self.steepness is not None:
+      return sample_rows(self.model.rng, self.rate_rows, indptr, indices, count, rows)
+    if self.noise_std > 0:
+      return top_rows(self.rate_rows, indptr, indices, count, rows)
+    width = count + int(np.max(np.diff(indptr), initial=0))
+    cand = self.top[rows] if width <= self.top.shape[1] \
+        else self.top_candidates(rows, width)
+    rep = np.repeat(rows, cand.shape[1])
+    cand = cand.ravel()
+    keep = cand >= 0
+    keep[keep] = ~is_excluded(rep[keep], cand[keep], indptr, indices)
+    return fill_rows(rep[keep], cand[keep], count, self.num_nodes)
+
   def post_step(self, changed: List[int]):
-    # update connection matrix
-    changed = list(set(changed))
-    changed.sort()
-    G = self.model.graph
-    for i in range(len(changed)):
-      for j in range(i + 1, len(changed)):
-        u = changed[i]
-        v = changed[j]
-        self.conn_mat[u, v] = common_neighbors_count(G, u, v)
-    pass
+    if self.low_rank is not None:
+      self.steps += 1
+      self.rewirings += len(changed) // 3
+      if self.steps >= self.refresh_interval or (
+          self.refresh_rewirings is not None and self.rewirings >= self.refresh_rewirings):
+        self.refresh()
+      return
+    if self.legacy_counts:
+      self.update_legacy(changed)
+      return
+    # update connection matrix by the rewirings
+    if not changed:
+      return
+    rewired = np.array(changed, dtype=np.int64).reshape((-1, 3))
+    delta = common_neighbors_delta(*self.follow_csr(), self.num_nodes, rewired)
+    touched = np.nonzero(np.diff(delta.indptr))[0]
+    if self.sparse:
+      self.conn_mat = (self.conn_mat + delta).tocsr()
+      self.conn_mat.eliminate_zeros()
+    else:
+      delta = sp.triu(delta, k=1).tocoo()
+      self.conn_mat[delta.row, delta.col] += delta.data
+    # only the rows with changed counts can reorder
+    if self.top.size:
+      self.top[touched] = self.top_candidates(touched, self.top.shape[1])
 
+  def update_legacy(self, changed: List[int]):
+    # recount the pairs of agents touched by the rewirings
+    touched = np.unique(np.array(changed, dtype=np.int64))
+    counts = legacy_common_neighbors(
+        *self.follow_csr(), self.num_nodes, touched, touched)
+    upper = np.triu(np.ones(counts.shape, dtype=bool), k=1)
+    rows, cols = np.nonzero(upper)
+    self.conn_mat[touched[rows], touched[cols]] = counts[upper]
+    if self.top.size:
+      self.top[touched] = self.top_candidates(touched, self.top.shape[1])
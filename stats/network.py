@@ -3,6 +3,8 @@ import numpy as np
 import networkx as nx
 from numpy.typing import NDArray
 
+from utils.rng import derive_seed
+
 
 class NetworkLayoutCollector:
 
@@ -17,12 +19,14 @@ class NetworkLayoutCollector:
           prefix: str,
           n: int, step: int,
           digraph: nx.DiGraph, graph: nx.Graph, opinion: NDArray,
+          rng: Optional[np.random.Generator] = None,
           *args, **kwargs) -> float:
 
     if step <= 0:
       self.last = None
 
-    pos = nx.spring_layout(digraph, pos=self.last) \
+    seed = derive_seed(rng) if rng is not None else None
+    pos = nx.spring_layout(digraph, pos=self.last, seed=seed) \
       if self.use_pos else None
     if self.use_last:
       self.last = pos
@@ -30,7 +34,7 @@ class NetworkLayoutCollector:
     # get a clear digraph
     graph = nx.DiGraph(digraph)
     for n in graph:
-      del graph.nodes[n]['agent']
+      graph.nodes[n].pop('agent', None)
 
     if self.return_dict:
       ret = {
@@ -0,0 +1,54 @@
+import numpy as np
+import networkx as nx
+
+from base.agent_new import hk_agent_step, hk_agents_step_batch
+from base.graph import graph_to_csr
+from base.tweet import to_record_array
+from utils.rng import create_rng
+
+
+def test_batch_matches_scalar_step():
+  n, count = 80, 4
+  rng = np.random.default_rng(2)
+  graph = nx.gnp_random_graph(n, 0.1, seed=2, directed=True)
+  indptr, indices = graph_to_csr(graph, n)
+  opinion = rng.uniform(-1, 1, (n, ))
+  # some agents have not tweeted yet, some retweeted others
+  author = np.where(rng.uniform(size=n) < 0.3, rng.integers(0, n, n), np.arange(n))
+  records = [
+      None if rng.uniform() < 0.1 else (int(a), 0, float(opinion[a]))
+      for a in author
+  ]
+  tweets = to_record_array(records)
+  recommended = rng.integers(-1, n, (n, count))
+  params = dict(decay=0.4, gamma=0.5, tolerance=0.4, r_retweet=0.3)
+
+  next_opinion, next_tweet, next_follow, nr_agents, op_sum_agents = \
+      hk_agents_step_batch(opinion, 1, **params, tweets=tweets, indptr=indptr,
+                           indices=indices, recommended=recommended,
+                           rng=create_rng(5))
+
+  scalar_rng = create_rng(5)
+  rewired = retweeted = 0
+  for i in range(n):
+    neighbors = [records[j] for j in indices[indptr[i]: indptr[i + 1]]
+                 if records[j] is not None]
+    rec = [records[j] for j in recommended[i] if j >= 0 and records[j] is not None]
+    (x, tweet, follow), (nr, op_sum), _ = hk_agent_step(
+        i, opinion[i], 1, **params, neighbors=neighbors, recommended=rec,
+        collect_nr_agents=True, collect_op_sum_agents=True,
+        report_view_tweets=False, report_retweet=False, report_rewiring=False,
+        rng=scalar_rng)
+    assert next_opinion[i] == x
+    assert tuple(next_tweet[i].tolist()) == tweet
+    assert tuple(next_follow[i]) == (follow or (-1, -1))
+    assert tuple(nr_agents[i]) == nr
+    assert tuple(op_sum_agents[i]) == op_sum
+    rewired += follow is not None
+    retweeted += tweet[1] == 0
+  assert rewired > 0 and retweeted > 0
+
+
+if __name__ == '__main__':
+  test_batch_matches_scalar_step()
+  print('ok')
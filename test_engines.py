@@ -0,0 +1,176 @@
+import numpy as np
+import networkx as nx
+
+from base import HKModel, HKModelParams
+from base.concordance import ConcordanceIndex
+from base.graph import FollowGraph
+from env import RandomNetworkProvider
+from recsys import Opinion, Random
+
+
+COLLECT = {'nr_agents', 'op_sum_agents'}
+
+
+def make_model(graph, opinion, engine: str = 'vectorized', rng: int = 3, **kwargs) -> HKModel:
+  return HKModel(graph.copy(), opinion, HKModelParams(engine=engine, **kwargs),
+                 collect=COLLECT, rng=rng)
+
+
+def agent_stats(model: HKModel):
+  agents = sorted(model.schedule.agents, key=lambda a: a.unique_id)
+  return (
+      np.array([a.cur_opinion for a in agents]),
+      np.array([a.nr_agents for a in agents]),
+      np.array([a.op_sum_agents for a in agents]),
+  )
+
+
+def assert_same_stats(a: HKModel, b: HKModel, atol: float = 1e-12):
+  for x, y in zip(agent_stats(a), agent_stats(b)):
+    assert np.allclose(x, y, rtol=0, atol=atol)
+
+
+def test_vectorized_matches_mesa():
+  graph, opinion = RandomNetworkProvider(agent_count=150, agent_follow=8).generate(1)
+  # without rewiring both engines draw nothing that affects the result
+  for kwargs in (
+      dict(),
+      dict(rewiring_rate=0, recsys_factory=lambda m: Opinion(m, noise_std=0)),
+  ):
+    mesa = make_model(graph, opinion, 'mesa', **kwargs)
+    vectorized = make_model(graph, opinion, **kwargs)
+    for _ in range(20):
+      mesa.step()
+      vectorized.step()
+      assert_same_stats(mesa, vectorized)
+    assert sorted(mesa.graph.edges) == sorted(vectorized.graph.edges)
+
+
+def test_parallel_matches_vectorized():
+  graph, opinion = RandomNetworkProvider(agent_count=200, agent_follow=8).generate(2)
+  kwargs = dict(tolerance=0.3, rewiring_rate=0.3, recsys_factory=lambda m: Random(m, 10))
+  vectorized = make_model(graph, opinion, **kwargs)
+  parallel = [make_model(graph, opinion, 'parallel', workers=w, **kwargs) for w in (1, 3)]
+  for _ in range(20):
+    vectorized.step()
+    for m in parallel:
+      m.step()
+      assert_same_stats(vectorized, m)
+  for m in parallel:
+    assert sorted(vectorized.graph.edges) == sorted(m.graph.edges)
+    m.close()
+    assert m.engine.kernel.executor is None
+
+
+def test_active_set_matches_full_step():
+  graph, opinion = RandomNetworkProvider(agent_count=200, agent_follow=8).generate(4)
+  kwargs = dict(tolerance=0.3, rewiring_rate=0.3, recsys_factory=lambda m: Random(m, 10))
+  full = make_model(graph, opinion, **kwargs)
+  exact = make_model(graph, opinion, active_threshold=0, **kwargs)
+  loose = make_model(graph, opinion, active_threshold=1e-9, **kwargs)
+  frozen = 0
+  for _ in range(150):
+    for m in (full, exact, loose):
+      m.step()
+    # agents whose neighborhood did not change at all are skipped exactly;
+    # frozen agents keep the stats of their last step
+    assert np.array_equal(full.engine.opinion, exact.engine.opinion)
+    frozen = max(frozen, int(np.sum(~loose.engine.active)))
+  assert frozen > 0
+  assert np.allclose(full.engine.opinion, loose.engine.opinion, rtol=0, atol=1e-8)
+  assert sorted(full.graph.edges) == sorted(exact.graph.edges) == sorted(loose.graph.edges)
+
+
+def test_active_set_follows_new_recommendations():
+  # isolated agents only move towards agents recommended to them, which do
+  # not change themselves
+  graph = nx.empty_graph(3, nx.DiGraph)
+  opinion = np.array([0., 0.2, 1.])
+  kwargs = dict(tolerance=0.25, decay=0.5, rewiring_rate=0, recsys_count=1,
+                recsys_factory=lambda m: Random(m, 1))
+  for rng in range(5):
+    full = make_model(graph, opinion, rng=rng, **kwargs)
+    active = make_model(graph, opinion, rng=rng, active_threshold=1e-9, **kwargs)
+    for _ in range(30):
+      _, a = full.step()
+      _, b = active.step()
+      assert abs(a - b) <= 1e-8, rng
+      assert np.allclose(full.engine.opinion, active.engine.opinion,
+                         rtol=0, atol=1e-8), rng
+
+
+def test_coarse_matches_full_step():
+  graph, opinion = RandomNetworkProvider(agent_count=200, agent_follow=8).generate(4)
+  kwargs = dict(tolerance=0.3, rewiring_rate=0.3, recsys_factory=lambda m: Random(m, 10))
+  full = make_model(graph, opinion, **kwargs)
+  coarse = make_model(graph, opinion, coarse_error=1e-12, coarse_interval=5, **kwargs)
+  merged = 0
+  for _ in range(200):
+    full.step()
+    coarse.step()
+    assert np.allclose(full.engine.opinion, coarse.engine.opinion, rtol=0, atol=1e-10)
+    merged = max(merged, int(np.sum(coarse.engine.clusters.merged)))
+  assert merged > 0
+  assert sorted(full.graph.edges) == sorted(coarse.graph.edges)
+
+
+def test_incremental_matches_full_step():
+  graph, opinion = RandomNetworkProvider(agent_count=200, agent_follow=8).generate(4)
+  kwargs = dict(tolerance=0.3, rewiring_rate=0.3, recsys_factory=lambda m: Random(m, 10))
+  full = make_model(graph, opinion, **kwargs)
+  incremental = make_model(graph, opinion, incremental=True, **kwargs)
+  for _ in range(100):
+    full.step()
+    incremental.step()
+    assert_same_stats(full, incremental)
+  assert sorted(full.graph.edges) == sorted(incremental.graph.edges)
+
+
+def test_concordance_boundary_is_rechecked():
+  # both endpoints use up their budget and meet exactly at the tolerance
+  graph = FollowGraph(2, np.array([0, 1, 2]), np.array([1, 0]))
+  index = ConcordanceIndex(graph, np.array([0., 0.5]), 0.25)
+  assert np.array_equal(index.n_concordant, [0, 0])
+  index.update(np.array([0.125, 0.375]))
+  assert np.array_equal(index.n_concordant, [1, 1])
+
+
+def test_mean_field_matches_complete_graph():
+  n = 120
+  opinion = np.random.default_rng(6).uniform(-1, 1, (n, ))
+  graph = nx.complete_graph(n, nx.DiGraph)
+  for tolerance in (0.1, 0.3):
+    vectorized = make_model(graph, opinion, tolerance=tolerance)
+    mean_field = HKModel(None, opinion, HKModelParams(
+        tolerance=tolerance, engine='mean_field'), rng=3)
+    for _ in range(30):
+      _, a = vectorized.step()
+      _, b = mean_field.step()
+      assert abs(a - b) <= 1e-12
+      assert np.allclose(vectorized.engine.opinion, mean_field.engine.opinion,
+                         rtol=0, atol=1e-12)
+    assert vectorized.is_absorbing(1e-9) == mean_field.is_absorbing(1e-9)
+
+
+def test_mean_field_needs_graph_or_opinion():
+  params = HKModelParams(engine='mean_field')
+  assert HKModel(nx.complete_graph(5, nx.DiGraph), None, params).engine.num_nodes == 5
+  assert HKModel(None, np.zeros(4), params).engine.num_nodes == 4
+  try:
+    HKModel(None, None, params)
+  except ValueError:
+    return
+  assert False
+
+
+if __name__ == '__main__':
+  test_vectorized_matches_mesa()
+  test_parallel_matches_vectorized()
+  test_active_set_matches_full_step()
+  test_active_set_follows_new_recommendations()
+  test_coarse_matches_full_step()
+  test_incremental_matches_full_step()
+  test_concordance_boundary_is_rechecked()
+  test_mean_field_matches_complete_graph()
+  test_mean_field_needs_graph_or_opinion()
+  print('ok')
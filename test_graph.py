@@ -0,0 +1,89 @@
+import numpy as np
+import networkx as nx
+
+from base.graph import FollowGraph
+
+
+def assert_same_graph(g: FollowGraph, ref: nx.DiGraph):
+  n = g.num_nodes
+  assert sorted(map(tuple, g.edges().tolist())) == sorted(ref.edges)
+  assert g.number_of_edges == ref.number_of_edges()
+  assert np.array_equal(g.out_degree, [ref.out_degree(u) for u in range(n)])
+  assert np.array_equal(g.in_degree, [ref.in_degree(u) for u in range(n)])
+  indptr, indices = g.csr()
+  for u in range(n):
+    assert sorted(indices[indptr[u]: indptr[u + 1]].tolist()) == sorted(ref.successors(u))
+  assert sorted(g.to_networkx().edges) == sorted(ref.edges)
+
+
+def test_follow_graph_matches_networkx():
+  rng = np.random.default_rng(8)
+  n = 40
+  ref = nx.gnp_random_graph(n, 0.1, seed=8, directed=True)
+  g = FollowGraph.from_networkx(ref, n, slack=1)
+  assert_same_graph(g, ref)
+
+  for _ in range(300):
+    op = rng.integers(3)
+    u = int(rng.integers(n))
+    succ = list(ref.successors(u))
+    free = [v for v in range(n) if v != u and not ref.has_edge(u, v)]
+    if op == 0 and succ and free:
+      # batch rewiring of distinct agents
+      src = rng.permutation(n)[:5]
+      rewired = []
+      for a in src.tolist():
+        out = list(ref.successors(a))
+        cand = [v for v in range(n) if v != a and not ref.has_edge(a, v)]
+        if out and cand:
+          rewired.append((a, out[rng.integers(len(out))], cand[rng.integers(len(cand))]))
+      if rewired:
+        s, uf, f = np.array(rewired).T
+        pos = g.rewire(s, uf, f)
+        assert np.array_equal(g.storage[pos], f)
+        ref.remove_edges_from(zip(s.tolist(), uf.tolist()))
+        ref.add_edges_from(zip(s.tolist(), f.tolist()))
+    elif op == 1 and free:
+      # rows outgrow their slack
+      v = free[rng.integers(len(free))]
+      g.add_edge(u, v)
+      ref.add_edge(u, v)
+    elif op == 2 and succ:
+      v = succ[rng.integers(len(succ))]
+      g.remove_edge(u, v)
+      ref.remove_edge(u, v)
+    assert_same_graph(g, ref)
+  assert all(g.has_edge(u, v) for u, v in ref.edges)
+
+
+def test_batch_edges_keep_row_order():
+  rng = np.random.default_rng(5)
+  n = 30
+  ref = nx.gnp_random_graph(n, 0.2, seed=5, directed=True)
+  g = FollowGraph.from_networkx(ref, n, slack=1)
+  rows = [list(g.successors(u)) for u in range(n)]
+  for _ in range(100):
+    # several edges per row, added past the slack or removed together
+    src = rng.integers(n, size=12)
+    if rng.integers(2):
+      edges = {(u, v) for u, v in zip(src.tolist(), rng.integers(n, size=12).tolist())
+               if u != v and not ref.has_edge(u, v)}
+      edges = sorted(edges, key=lambda e: rng.random())
+      g.add_edges([u for u, _ in edges], [v for _, v in edges])
+      ref.add_edges_from(edges)
+      for u, v in edges:
+        rows[u].append(v)
+    else:
+      edges = {(u, rows[u][rng.integers(len(rows[u]))]) for u in src.tolist() if rows[u]}
+      g.remove_edges([u for u, _ in edges], [v for _, v in edges])
+      ref.remove_edges_from(edges)
+      for u, v in edges:
+        rows[u].remove(v)
+    assert_same_graph(g, ref)
+    assert all(g.successors(u).tolist() == rows[u] for u in range(n))
+
+
+if __name__ == '__main__':
+  test_follow_graph_matches_networkx()
+  test_batch_edges_keep_row_order()
+  print('ok')
@@ -0,0 +1,76 @@
+import numpy as np
+import networkx as nx
+
+from base import HKModel, HKModelParams
+from base.scenario import Scenario, SimulationParams
+from recsys import Random
+from utils.stat import SlidingWindowMax
+
+
+def test_window_max_matches_list():
+  rng = np.random.default_rng(3)
+  for size in (1, 2, 5, 60):
+    # small integers give many ties
+    values = rng.integers(0, 8, 500)
+    window = SlidingWindowMax(size, 0xffffff)
+    monitor = [0xffffff] * size
+    for v in values.tolist():
+      window.push(v)
+      monitor.pop(0)
+      monitor.append(v)
+      assert window.max == max(monitor), size
+
+
+def make_model(edges, opinion, recsys: bool = True) -> HKModel:
+  graph = nx.empty_graph(len(opinion), nx.DiGraph)
+  graph.add_edges_from(edges)
+  return HKModel(graph, np.array(opinion), HKModelParams(
+      tolerance=0.25, recsys_factory=(lambda m: Random(m, 10)) if recsys else None,
+  ), rng=1)
+
+
+def test_absorbing_needs_no_concordant_followee():
+  # agent 0 can unfollow 2 for the concordant agent 1
+  assert not make_model([(0, 2)], [0., 0.1, 1.]).is_absorbing()
+  assert make_model([(0, 2)], [0., 0.1, 1.], recsys=False).is_absorbing()
+  # agent 1 is within tolerance, but has not reached agent 0 yet
+  assert not make_model([(2, 0)], [0., 0.1, 1.]).is_absorbing()
+  # nobody agrees with agent 0
+  assert make_model([(0, 2)], [0., 0.5, 1.]).is_absorbing()
+  # concordant neighbors have to agree
+  assert not make_model([(0, 1)], [0., 0.1, 1.], recsys=False).is_absorbing()
+  assert make_model([(0, 1)], [0.1, 0.1, 1.], recsys=False).is_absorbing()
+
+
+class FixedProvider:
+
+  def generate(self, rng=None):
+    # a consensus group and an agent following it, whom nobody agrees with
+    graph = nx.DiGraph([(1, 2), (2, 3), (3, 4), (4, 1), (0, 1)])
+    return graph, np.array([0., 1., 1., 1., 1.])
+
+
+def test_scenario_halts_on_absorbing_state():
+  def run(halt_on_absorbing: bool):
+    scenario = Scenario(
+        FixedProvider(),
+        HKModelParams(tolerance=0.25, recsys_factory=lambda m: Random(m, 3)),
+        SimulationParams(max_total_step=500, halt_on_absorbing=halt_on_absorbing),
+        rng=2)
+    scenario.init()
+    scenario.iter()
+    return scenario
+
+  absorbing = run(True)
+  assert absorbing.halt_reason == 'absorbing'
+  assert absorbing.steps == 1
+  stable = run(False)
+  assert stable.halt_reason == 'stable'
+  assert stable.steps == 60
+
+
+if __name__ == '__main__':
+  test_window_max_matches_list()
+  test_absorbing_needs_no_concordant_followee()
+  test_scenario_halts_on_absorbing_state()
+  print('ok')
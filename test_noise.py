@@ -0,0 +1,51 @@
+import numpy as np
+import networkx as nx
+
+from base import HKModel, HKModelParams
+from utils.noise import NoisePrefetcher
+from utils.rng import create_rng, spawn_rng
+
+
+def make_model() -> HKModel:
+  graph = nx.gnp_random_graph(20, 0.2, seed=3, directed=True)
+  opinion = np.linspace(-1, 1, 20)
+  return HKModel(graph, opinion, HKModelParams(prefetch_noise=True), rng=4)
+
+
+def test_prefetched_noise_matches_direct_draws():
+  source = NoisePrefetcher(spawn_rng(create_rng(1), 1)[0], 'normal', (0, 1, (3, 5)))
+  direct = spawn_rng(create_rng(1), 1)[0]
+  for _ in range(10):
+    assert np.array_equal(source.next(), direct.normal(0, 1, (3, 5)))
+  source.close()
+
+
+def test_noise_resumes_from_state():
+  first = make_model()
+  source = first.noise_source('uniform', 0, 1, (4, ))
+  for _ in range(5):
+    source.next()
+  # the model comes from the same seed, only the states of its sources are
+  # restored
+  resumed = make_model()
+  resumed.set_noise_state(first.get_noise_state())
+  resumed_source = resumed.noise_source('uniform', 0, 1, (4, ))
+  for _ in range(5):
+    assert np.array_equal(resumed_source.next(), source.next())
+  first.close()
+  resumed.close()
+
+
+def test_close_stops_noise_threads():
+  model = make_model()
+  sources = [model.noise_source('uniform', 0, 1, (4, )) for _ in range(2)]
+  sources[0].next()
+  model.close()
+  assert not any(s._thread.is_alive() for s in sources)
+
+
+if __name__ == '__main__':
+  test_prefetched_noise_matches_direct_draws()
+  test_noise_resumes_from_state()
+  test_close_stops_noise_threads()
+  print('ok')
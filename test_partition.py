@@ -0,0 +1,49 @@
+import numpy as np
+
+from base import HKModel, HKModelParams
+from base.partition import PartitionPool
+from env import RandomNetworkProvider
+from recsys import Random
+
+
+def test_provider_rewiring_keeps_simple_graph():
+  n = 400
+  params = HKModelParams(tolerance=0.4, rewiring_rate=0.3)
+  provider = RandomNetworkProvider(agent_count=n, agent_follow=10)
+  with PartitionPool.from_provider(provider, n, 3, params, rng=3) as pool:
+    count = pool.edges().shape[0]
+    for _ in range(20):
+      pool.step()
+      pool.commit()
+    edges = pool.edges()
+    in_degree = pool.in_degree.copy()
+  keys = edges[:, 0] * n + edges[:, 1]
+  assert edges.shape[0] == count
+  assert np.unique(keys).size == keys.size
+  assert not np.any(edges[:, 0] == edges[:, 1])
+  assert np.array_equal(np.bincount(edges[:, 1], minlength=n), in_degree)
+
+
+def test_partitioned_matches_vectorized():
+  graph, opinion = RandomNetworkProvider(agent_count=200, agent_follow=8).generate(5)
+  models = [
+      HKModel(graph.copy(), opinion, HKModelParams(
+          tolerance=0.4, rewiring_rate=0.3,
+          recsys_factory=lambda m: Random(m, 10),
+          engine=engine, workers=2,
+      ), rng=11)
+      for engine in ('vectorized', 'partitioned')
+  ]
+  for _ in range(15):
+    for m in models:
+      m.step()
+  a, b = models
+  assert np.allclose(a.engine.opinion, b.engine.opinion, rtol=0, atol=1e-12)
+  assert sorted(a.graph.edges) == sorted(b.graph.edges)
+  b.close()
+
+
+if __name__ == '__main__':
+  test_provider_rewiring_keeps_simple_graph()
+  test_partitioned_matches_vectorized()
+  print('ok')
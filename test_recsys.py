@@ -0,0 +1,164 @@
+import numpy as np
+from numpy.typing import NDArray
+
+from base import HKModel, HKModelParams
+from base.graph import FollowGraph
+from base.recsys import HKModelRecommendationSystem, gumbel_top_k
+from env import RandomNetworkProvider
+from recsys import Mixed, Opinion, OpinionRandom, Random, Structure
+from utils.rng import create_rng, get_rng_state, set_rng_state
+
+
+def assert_same_recommendations(factory, count: int = 5):
+  graph, opinion = RandomNetworkProvider(agent_count=150, agent_follow=8).generate(7)
+  model = HKModel(graph, opinion, HKModelParams(
+      recsys_factory=factory, recsys_count=count, engine='mesa'), rng=5)
+  recsys = model.recsys
+  recsys.pre_step()
+  n = graph.number_of_nodes()
+  indptr, indices = FollowGraph.from_networkx(graph, n).csr()
+  opinion = model.get_opinion()
+  mask = np.arange(n) % 3 > 0
+  for m in (None, mask):
+    # both draw from the same state, row by row in the order of the agents
+    state = get_rng_state(model.rng)
+    ret = recsys.recommend_all(opinion, indptr, indices, count, m)
+    set_rng_state(model.rng, state)
+    # the base class calls `recommend` per agent
+    ref = HKModelRecommendationSystem.recommend_all(
+        recsys, opinion, indptr, indices, count, m)
+    assert ret.shape == (n, count)
+    assert np.array_equal(ret, ref)
+
+
+def test_recommend_all_matches_recommend():
+  assert_same_recommendations(lambda m: Random(m, 10))
+  assert_same_recommendations(lambda m: Opinion(m))
+  assert_same_recommendations(lambda m: Opinion(m, noise_std=0))
+  assert_same_recommendations(lambda m: Structure(m, steepness=None))
+  assert_same_recommendations(
+      lambda m: Structure(m, steepness=None, noise_std=0, top_rates=True))
+  assert_same_recommendations(lambda m: Structure(
+      m, steepness=None, noise_std=0, matrix_init=True, top_rates=True))
+
+
+def test_recommend_all_matches_recommend_with_draws():
+  assert_same_recommendations(lambda m: OpinionRandom(m))
+  assert_same_recommendations(lambda m: OpinionRandom(m, steepness=2, random_ratio=0.1))
+  assert_same_recommendations(lambda m: Structure(m, steepness=2))
+  assert_same_recommendations(
+      lambda m: Structure(m, steepness=1, noise_std=0.2, random_ratio=0.1))
+  assert_same_recommendations(lambda m: Structure(m, steepness=None, top_rates=True))
+  # only one part draws, so the draws do not interleave per agent
+  assert_same_recommendations(lambda m: Mixed(m, OpinionRandom(m), Opinion(m)))
+  assert_same_recommendations(
+      lambda m: Mixed(m, Random(m, 10), Structure(m, steepness=2), model1_ratio=0.4))
+
+
+def test_gumbel_top_k_draws_in_turn():
+  rng = create_rng(8)
+  weights = np.array([0, 1, 2, 3, 0.5, 4])
+  samples = 50000
+  ret = gumbel_top_k(rng, np.tile(weights, (samples, 1)), 2)
+  # ordered pairs as drawn by `choice(..., replace=False, p=weights / total)`
+  total = np.sum(weights)
+  p = weights[:, np.newaxis] / total * weights / (total - weights[:, np.newaxis])
+  np.fill_diagonal(p, 0)
+  p = p.ravel()
+  observed = np.bincount(ret[:, 0] * weights.size + ret[:, 1], minlength=p.size)
+  assert np.all(observed[p == 0] == 0)
+  z = (observed - samples * p)[p > 0] / np.sqrt(samples * p * (1 - p))[p > 0]
+  assert np.max(np.abs(z)) < 4
+  # rows run out of positive weights
+  ret = gumbel_top_k(rng, np.array([[0, 1, 0, 2], [0, 0, 0, 0]]), 3)
+  assert sorted(ret[0, :2].tolist()) == [1, 3] and ret[0, 2] == -1
+  assert np.all(ret[1] == -1)
+
+
+def max_count_z(a: NDArray, b: NDArray, n: int) -> float:
+  # largest z-score of the differences of how often each agent was picked
+  # in two equally large samples
+  c_a = np.bincount(a[a >= 0], minlength=n)
+  c_b = np.bincount(b[b >= 0], minlength=n)
+  both = c_a + c_b
+  return float(np.max(np.abs(c_a - c_b)[both > 0] / np.sqrt(both[both > 0])))
+
+
+def make_recsys(factory, seed: int = 3):
+  graph, opinion = RandomNetworkProvider(agent_count=100, agent_follow=5).generate(2)
+  model = HKModel(graph, opinion, HKModelParams(
+      recsys_factory=factory, engine='mesa'), rng=seed)
+  model.recsys.pre_step()
+  return model, model.recsys
+
+
+def test_window_sampler_matches_dense_rates():
+  samples = 20000
+  for random_ratio, count in ((0, 1), (0, 3), (0.2, 3)):
+    kwargs = dict(tolerance=0.4, steepness=2, noise_std=0.1, random_ratio=random_ratio)
+    model, dense = make_recsys(lambda m: OpinionRandom(m, stream=True, **kwargs))
+    _, sparse = make_recsys(lambda m: OpinionRandom(m, sparse=True, **kwargs))
+    opinion = model.get_opinion()
+    for agent in (int(np.argmin(opinion)), int(np.argsort(opinion)[50])):
+      followed = np.array(list(model.graph.successors(agent)))
+      rows = np.full((samples, ), agent)
+      # noisy dense rates drawn anew for each sample
+      rates = dense.rate_rows(rows)
+      rates[:, followed] = 0
+      ref = gumbel_top_k(model.rng, rates, count)
+      ret = sparse.sampler.sample(
+          model.rng, rows, count, random_ratio, lambda _, c: np.isin(c, followed))
+      assert not np.any(np.isin(ret, followed))
+      assert np.all(ret != agent)
+      assert max_count_z(ret, ref, 100) < 4
+
+
+def assert_stream_matches(factory, steps: int = 4000, count: int = 3):
+  # streamed rates against the rate matrix of each step
+  graph, opinion = RandomNetworkProvider(agent_count=60, agent_follow=5).generate(4)
+  indptr, indices = FollowGraph.from_networkx(graph, 60).csr()
+  mask = np.zeros((60, ), dtype=bool)
+  mask[[3, 40]] = True
+  picks = []
+  for stream in (False, True):
+    model = HKModel(graph, opinion, HKModelParams(
+        recsys_factory=lambda m: factory(m, stream), engine='mesa'), rng=6)
+    ret = []
+    for _ in range(steps):
+      model.recsys.pre_step()
+      ret.append(model.recsys.recommend_all(opinion, indptr, indices, count, mask))
+    picks.append(np.stack(ret, axis=1))
+  for agent in np.nonzero(mask)[0]:
+    excluded = np.append(indices[indptr[agent]: indptr[agent + 1]], agent)
+    assert not np.any(np.isin(picks[0][agent], excluded))
+    assert not np.any(np.isin(picks[1][agent], excluded))
+    assert max_count_z(picks[0][agent], picks[1][agent], 60) < 4
+
+
+def test_stream_matches_rate_matrix():
+  assert_stream_matches(lambda m, stream: OpinionRandom(
+      m, steepness=2, random_ratio=0.1, stream=stream))
+  assert_stream_matches(lambda m, stream: Structure(
+      m, steepness=2, random_ratio=0.1, stream=stream))
+  assert_stream_matches(lambda m, stream: Structure(m, top_rates=True, stream=stream))
+
+
+def test_structure_recommends_lowest_ids_by_default():
+  graph, opinion = RandomNetworkProvider(agent_count=50, agent_follow=5).generate(1)
+  model = HKModel(graph, opinion, HKModelParams(
+      recsys_factory=lambda m: Structure(m), recsys_count=4, engine='vectorized'), rng=2)
+  ret = model.engine.get_recommendation(4)
+  for u in range(50):
+    # whatever the rates, as older versions did
+    excluded = set(graph.successors(u)) | {u}
+    assert ret[u].tolist() == [v for v in range(50) if v not in excluded][:4]
+
+
+if __name__ == '__main__':
+  test_recommend_all_matches_recommend()
+  test_recommend_all_matches_recommend_with_draws()
+  test_gumbel_top_k_draws_in_turn()
+  test_window_sampler_matches_dense_rates()
+  test_stream_matches_rate_matrix()
+  test_structure_recommends_lowest_ids_by_default()
+  print('ok')
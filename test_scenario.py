@@ -0,0 +1,136 @@
+import pickle
+
+import numpy as np
+
+from base import HKModelParams
+from base.replica import ScenarioBatch
+from base.scenario import Scenario, SimulationParams
+from env import RandomNetworkProvider
+from recsys import Opinion, Random
+
+
+AGENT_KEYS = ['cur_opinion', 'nr_agents', 'op_sum_agents']
+
+
+def run_scenario(engine: str, fast_forward: bool) -> Scenario:
+  scenario = Scenario(
+      RandomNetworkProvider(agent_count=100, agent_follow=15),
+      HKModelParams(tolerance=0.3, engine=engine),
+      SimulationParams(
+          max_total_step=1000, fast_forward=fast_forward,
+          agent_stat_keys=AGENT_KEYS, opinion_change_error=1e-13,
+          halt_on_absorbing=False),
+      rng=5)
+  scenario.init()
+  scenario.iter()
+  return scenario
+
+
+def test_fast_forward_matches_stepping():
+  for engine in ('mesa', 'vectorized'):
+    stepped, jumped = run_scenario(engine, False), run_scenario(engine, True)
+    assert jumped.skipped_steps, engine
+    assert stepped.steps == jumped.steps
+    s_stats = stepped.generate_agent_stats()
+    j_stats = jumped.generate_agent_stats()
+    rows = np.searchsorted(s_stats['step'], j_stats['step'])
+    assert np.array_equal(s_stats['step'][rows], j_stats['step'])
+    for k in AGENT_KEYS:
+      assert np.allclose(
+          np.array(s_stats[k])[rows], np.array(j_stats[k]),
+          rtol=0, atol=1e-12), (engine, k)
+
+
+def test_batch_matches_single_replicas():
+  def make(tolerance: float, seed: int):
+    return Scenario(
+        RandomNetworkProvider(agent_count=80, agent_follow=6),
+        HKModelParams(
+            tolerance=tolerance, rewiring_rate=0.2,
+            recsys_factory=lambda m: Random(m, 10), engine='vectorized'),
+        SimulationParams(
+            max_total_step=60, agent_stat_keys=AGENT_KEYS,
+            model_stat_interval=10),
+        rng=seed)
+
+  configs = [(0.2, 1), (0.3, 2), (0.45, 3)]
+  batch = ScenarioBatch([make(*c) for c in configs])
+  batch.init()
+  batch.iter()
+  for c, b in zip(configs, batch.scenarios):
+    single = make(*c)
+    single.init()
+    single.iter()
+    assert single.steps == b.steps, c
+    assert np.allclose(single.get_current_opinion(), b.get_current_opinion(),
+                       rtol=0, atol=1e-12), c
+    assert sorted(single.model.graph.edges) == sorted(b.model.graph.edges), c
+    s_stats, b_stats = single.generate_agent_stats(), b.generate_agent_stats()
+    for k in AGENT_KEYS:
+      assert np.allclose(s_stats[k], b_stats[k], rtol=0, atol=1e-12), (c, k)
+
+
+
+def test_batch_rejects_partial_stepping():
+  for kwargs, sim_kwargs in (
+      (dict(active_threshold=1e-9), dict()),
+      (dict(coarse_error=1e-12), dict()),
+      (dict(incremental=True), dict()),
+      (dict(), dict(fast_forward=True)),
+      (dict(engine='parallel', workers=1), dict()),
+  ):
+    scenarios = [
+        Scenario(
+            RandomNetworkProvider(agent_count=50, agent_follow=5),
+            HKModelParams(**{'engine': 'vectorized', **kwargs}),
+            SimulationParams(max_total_step=10, **sim_kwargs), rng=seed)
+        for seed in (1, 2)
+    ]
+    try:
+      ScenarioBatch(scenarios).init()
+    except ValueError:
+      continue
+    assert False, (kwargs, sim_kwargs)
+
+
+
+def test_resume_matches_uninterrupted_run():
+  def make(engine: str, prefetch_noise: bool, recsys):
+    return Scenario(
+        RandomNetworkProvider(agent_count=80, agent_follow=6),
+        HKModelParams(
+            tolerance=0.4, rewiring_rate=0.3, recsys_factory=recsys,
+            engine=engine, prefetch_noise=prefetch_noise),
+        SimulationParams(max_total_step=40, agent_stat_keys=AGENT_KEYS,
+                         model_stat_interval=10),
+        rng=9)
+
+  for engine in ('mesa', 'vectorized'):
+    for prefetch_noise in (False, True):
+      for recsys in (lambda m: Random(m, 10), lambda m: Opinion(m)):
+        full = make(engine, prefetch_noise, recsys)
+        full.init()
+        full.iter(40)
+        first = make(engine, prefetch_noise, recsys)
+        first.init()
+        first.iter(15)
+        resumed = make(engine, prefetch_noise, recsys)
+        resumed.load(*pickle.loads(pickle.dumps(first.dump())))
+        resumed.iter(25)
+
+        key = (engine, prefetch_noise)
+        assert resumed.steps == full.steps, key
+        assert np.array_equal(
+            resumed.get_current_opinion(), full.get_current_opinion()), key
+        assert sorted(resumed.model.graph.edges) == sorted(full.model.graph.edges), key
+        r_stats, f_stats = resumed.generate_agent_stats(), full.generate_agent_stats()
+        for k in ['step'] + AGENT_KEYS:
+          assert np.array_equal(r_stats[k], f_stats[k]), (key, k)
+
+
+if __name__ == '__main__':
+  test_fast_forward_matches_stepping()
+  test_batch_matches_single_replicas()
+  test_batch_rejects_partial_stepping()
+  test_resume_matches_uninterrupted_run()
+  print('ok')
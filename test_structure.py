@@ -0,0 +1,151 @@
+import numpy as np
+
+from base import HKModel, HKModelParams
+from base.recsys import gumbel_top_k, top_k
+from env import RandomNetworkProvider
+from recsys import Structure
+from recsys.structure import common_neighbors_matrix, common_neighbors_delta, \
+    low_rank_factors, low_rank_error, common_neighbors_count
+
+
+def rewire_randomly(rng: np.random.Generator, edges: set, n: int, count: int):
+  # (agent, unfollowed, followed) for `count` distinct agents
+  rewired = []
+  for a in rng.permutation(n)[:count].tolist():
+    out = sorted(v for u, v in edges if u == a)
+    free = [v for v in range(n) if v != a and (a, v) not in edges]
+    if not out or not free:
+      continue
+    u, f = rng.choice(out), rng.choice(free)
+    edges.remove((a, u))
+    edges.add((a, f))
+    rewired.append((a, u, f))
+  return np.array(rewired, dtype=np.int64).reshape((-1, 3))
+
+
+def to_csr(edges: set, n: int):
+  e = np.array(sorted(edges), dtype=np.int64).reshape((-1, 2))
+  indptr = np.zeros((n + 1, ), dtype=np.int64)
+  np.cumsum(np.bincount(e[:, 0], minlength=n), out=indptr[1:])
+  return indptr, e[:, 1]
+
+
+def test_delta_matches_recompute():
+  rng = np.random.default_rng(42)
+  n = 60
+  edges = set()
+  while len(edges) < 300:
+    u, v = rng.integers(0, n, 2).tolist()
+    if u != v:
+      edges.add((u, v))
+
+  conn_mat = common_neighbors_matrix(*to_csr(edges, n), n)
+  for _ in range(50):
+    # many rewirings share endpoints within one step
+    rewired = rewire_randomly(rng, edges, n, 20)
+    conn_mat = conn_mat + common_neighbors_delta(*to_csr(edges, n), n, rewired)
+    full = common_neighbors_matrix(*to_csr(edges, n), n)
+    assert np.array_equal(conn_mat.toarray(), full.toarray())
+
+
+def test_post_step_matches_recompute():
+  graph, opinion = RandomNetworkProvider(agent_count=200, agent_follow=10).generate(7)
+  for engine in ('mesa', 'vectorized'):
+    for sparse in (False, True):
+      model = HKModel(graph.copy(), opinion, HKModelParams(
+          rewiring_rate=0.3,
+          recsys_factory=lambda m: Structure(
+              m, steepness=1, matrix_init=True, sparse=sparse),
+          engine=engine,
+      ), rng=1)
+      for _ in range(10):
+        model.step()
+      recsys: Structure = model.recsys
+      full = common_neighbors_matrix(*recsys.follow_csr(), recsys.num_nodes)
+      conn_mat = recsys.conn_mat.toarray() if sparse \
+          else recsys.conn_mat + recsys.conn_mat.T
+      assert np.array_equal(conn_mat, full.toarray()), (engine, sparse)
+
+
+def test_low_rank_error():
+  graph, opinion = RandomNetworkProvider(agent_count=100, agent_follow=5).generate(3)
+  model = HKModel(graph, opinion, HKModelParams(
+      recsys_factory=lambda m: Structure(m, steepness=None, low_rank=99),
+      engine='vectorized',
+  ), rng=1)
+  recsys: Structure = model.recsys
+  # all eigenpairs but one recover the counts
+  error = recsys.approximation_error()
+  assert error['frobenius'] < 1e-3 and error['recall'] == 1
+  exact = common_neighbors_matrix(*recsys.follow_csr(), recsys.num_nodes)
+  coarse = low_rank_error(exact, low_rank_factors(*recsys.follow_csr(), 100, 4))
+  assert coarse['frobenius'] > error['frobenius']
+
+
+def test_legacy_counts_match_pairwise():
+  graph, opinion = RandomNetworkProvider(agent_count=80, agent_follow=6).generate(2)
+  model = HKModel(graph, opinion, HKModelParams(
+      rewiring_rate=0.3,
+      recsys_factory=lambda m: Structure(m, steepness=1.0, legacy_counts=True),
+  ), rng=4)
+  recsys: Structure = model.recsys
+  n = recsys.num_nodes
+
+  def pairwise(G, nodes):
+    ret = np.zeros((n, n), dtype=int)
+    for i, u in enumerate(nodes):
+      for v in nodes[i + 1:]:
+        ret[u, v] = common_neighbors_count(G, u, v)
+    return ret
+
+  assert np.array_equal(recsys.conn_mat, pairwise(model.graph, list(range(n))))
+  for _ in range(10):
+    before, edges = recsys.conn_mat.copy(), set(model.graph.edges)
+    model.step()
+    # only the pairs of rewired agents are recounted
+    touched = sorted(set(sum(edges ^ set(model.graph.edges), ())))
+    counts = pairwise(model.graph, touched)
+    before[np.ix_(touched, touched)] = np.triu(counts[np.ix_(touched, touched)], k=1) \
+        + np.tril(before[np.ix_(touched, touched)])
+    assert np.array_equal(recsys.conn_mat, before)
+
+
+def test_two_hop_matches_dense_rates():
+  graph, opinion = RandomNetworkProvider(agent_count=150, agent_follow=5).generate(5)
+  samples, count = 20000, 3
+  for steepness, random_ratio in ((2, 0), (1, 0.1), (None, 0)):
+    def make(two_hop: bool) -> Structure:
+      return HKModel(graph, opinion, HKModelParams(recsys_factory=lambda m: Structure(
+          m, steepness=steepness, noise_std=0.5, random_ratio=random_ratio,
+          top_rates=True, stream=True, two_hop=two_hop)), rng=4).recsys
+    dense, sparse = make(False), make(True)
+    rng = dense.model.rng
+    for agent in (0, 7):
+      followed = np.array(list(graph.successors(agent)))
+      rows = np.full((samples, ), agent)
+      # noisy dense rates drawn anew for each sample
+      rates = dense.rate_rows(rows)
+      if steepness is None:
+        rates[:, followed] = -np.inf
+        ref = top_k(rates, count, -np.inf)
+      else:
+        rates[:, followed] = 0
+        ref = gumbel_top_k(rng, rates, count)
+      ret = sparse.sampler.sample(
+          rng, sparse.conn_mat, rows, count,
+          np.arange(samples + 1) * followed.size, np.tile(followed, samples))
+      assert not np.any(np.isin(ret, np.append(followed, agent)))
+      c_ret = np.bincount(ret[ret >= 0], minlength=150)
+      c_ref = np.bincount(ref[ref >= 0], minlength=150)
+      both = c_ret + c_ref
+      z = np.abs(c_ret - c_ref)[both > 0] / np.sqrt(both[both > 0])
+      assert np.max(z) < 3.4, (steepness, agent)
+
+
+if __name__ == '__main__':
+  test_delta_matches_recompute()
+  test_post_step_matches_recompute()
+  test_low_rank_error()
+  test_legacy_counts_match_pairwise()
+  test_two_hop_matches_dense_rates()
+  print('ok')
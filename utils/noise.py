@@ -0,0 +1,70 @@
+from typing import Any, Dict, Optional, Tuple
+from numpy.typing import NDArray
+
+import queue
+import threading
+import weakref
+
+import numpy as np
+
+from utils.rng import get_rng_state, set_rng_state
+
+
+def _produce(
+    fields: queue.Queue,
+    stop: threading.Event,
+    rng: np.random.Generator,
+    method: str,
+    args: Tuple[Any, ...],
+):
+  # numpy releases the GIL while filling large arrays
+  draw = getattr(rng, method)
+  while not stop.is_set():
+    item = (draw(*args), get_rng_state(rng))
+    while not stop.is_set():
+      try:
+        fields.put(item, timeout=0.1)
+        break
+      except queue.Full:
+        pass
+
+
+class NoisePrefetcher:
+  """Draws `rng.<method>(*args)` for the next steps in a background thread.
+
+  At most `depth` fields are kept ready. The fields only depend on `rng`,
+  so the sequence is the same as drawing them in place; `state` is the state
+  of `rng` after the last field handed out and restores the sequence when
+  passed to a new prefetcher.
+  """
+
+  def __init__(
+      self,
+      rng: np.random.Generator,
+      method: str,
+      args: Tuple[Any, ...],
+      depth: int = 2,
+      state: Optional[Dict[str, Any]] = None,
+  ):
+    set_rng_state(rng, state)
+    self.state = get_rng_state(rng)
+    self.method = method
+    self.args = args
+    self._fields: queue.Queue = queue.Queue(maxsize=depth)
+    self._stop = threading.Event()
+    self._thread = threading.Thread(
+        target=_produce,
+        args=(self._fields, self._stop, rng, method, args),
+        daemon=True,
+    )
+    self._thread.start()
+    weakref.finalize(self, self._stop.set)
+
+  def next(self) -> NDArray:
+    field, self.state = self._fields.get()
+    return field
+
+  def close(self):
+    # the producer notices the stop within its put timeout
+    self._stop.set()
+    self._thread.join()
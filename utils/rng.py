@@ -0,0 +1,37 @@
+from typing import Optional, Union, List, Any, Dict
+
+import numpy as np
+
+SeedType = Union[None, int, np.random.SeedSequence, np.random.Generator]
+
+
+def create_rng(seed: SeedType = None) -> np.random.Generator:
+  """Create a counter-based (Philox) generator.
+
+  Without a seed, one is drawn from the legacy global state, so scripts
+  calling `np.random.seed` stay reproducible.
+  """
+  if isinstance(seed, np.random.Generator):
+    return seed
+  if seed is None:
+    seed = int(np.random.randint(0, 2 ** 63 - 1, dtype=np.int64))
+  return np.random.Generator(np.random.Philox(seed))
+
+
+def spawn_rng(rng: np.random.Generator, n: int) -> List[np.random.Generator]:
+  """Independent child streams, e.g. one per replica or worker."""
+  return rng.spawn(n)
+
+
+def derive_seed(rng: np.random.Generator) -> int:
+  # for libraries only accepting integer seeds
+  return int(rng.integers(0, 2 ** 31 - 1))
+
+
+def get_rng_state(rng: np.random.Generator) -> Dict[str, Any]:
+  return rng.bit_generator.state
+
+
+def set_rng_state(rng: np.random.Generator, state: Optional[Dict[str, Any]]):
+  if state is not None:
+    rng.bit_generator.state = state
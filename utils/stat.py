@@ -3,6 +3,7 @@ from numpy.typing import NDArray, DTypeLike
 from scipy.interpolate import interp1d
 
 import logging
+from collections import deque
 
 import numpy as np
 import zlib
@@ -46,6 +47,36 @@ def get_logger(name: str, path: str):
   return logger
 
 
+class SlidingWindowMax:
+  """Maximum of the last `size` pushed values in amortized O(1).
+
+  Before `size` values are pushed, the window is padded with `initial`.
+  """
+
+  def __init__(self, size: int, initial: float = 0):
+    if size < 1:
+      raise ValueError(f'Window size must be positive, got {size}.')
+    self.size = size
+    self.count = 0
+    # (index, value) with decreasing values
+    self.window = deque([(size - 1, initial)])
+
+  def push(self, value: float):
+    # the padding has index size - 1, the t-th value index t + size
+    t = self.count
+    window = self.window
+    while window and window[-1][1] <= value:
+      window.pop()
+    window.append((t + self.size, value))
+    self.count += 1
+    while window[0][0] <= t:
+      window.popleft()
+
+  @property
+  def max(self) -> float:
+    return self.window[0][1]
+
+
 def first_less_than(arr: NDArray, k: float):
   mask = arr < k
   idx = np.argmax(mask)
@@ -2,6 +2,7 @@ from typing import Callable, Mapping, cast, Optional, List, Tuple
 from numpy.typing import NDArray
 
 import os
+import dataclasses
 # import sys
 # parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 # sys.path.append(parent_dir)
@@ -15,7 +16,7 @@ import matplotlib as mpl
 
 import seaborn as sns
 
-from base import HKModelParams, Scenario, SimulationParams, HKModel, HKModelRecommendationSystem
+from base import HKModelParams, Scenario, SimulationParams, HKModel, HKModelRecommendationSystem, ScenarioBatch
 from env import RandomNetworkProvider, ScaleFreeNetworkProvider
 from recsys import Random, Opinion, Structure, Mixed
 import stats
@@ -128,7 +129,45 @@ def gen_params(r: float, d: float, g: float):
   )
 
 
+# > 0: simulate this many scenarios together with the vectorized engine;
+# batches step all agents, so they reject active_threshold, coarse_error,
+# incremental and fast_forward
+batch_size = 0
+
+
+def simulate_batch(batch: List[Tuple[str, float, float, Callable]]):
+  scenarios: List[Scenario] = []
+  for scenario_name, r, d, g in batch:
+    params = dataclasses.replace(gen_params(r, d, g), engine='vectorized')
+    sim_p = dataclasses.replace(
+        sim_p_standard, model_stat_collectors=stat_collectors_f(layout=True))
+    scenarios.append(Scenario(network_provider, params, sim_p))
+
+  names = [x[0] for x in batch]
+  logger.info('Scenarios %s simulation started.', ', '.join(names))
+
+  try:
+    B = ScenarioBatch(scenarios)
+    B.init()
+    B.iter()
+  except Exception as e:
+    logger.error(
+        'Error occurred when simulating scenarios %s.', ', '.join(names))
+    logger.exception(e)
+    return
+
+  for scenario_name, scenario in zip(names, scenarios):
+    save_sim_result(scenario, scenario_name)
+    logger.info('Saved scenario %s. Model at step %d.',
+                scenario_name, scenario.steps)
+
+
 if __name__ == '__main__':
+  if batch_size > 0:
+    pending = [x for x in params_arr if not check_sim_result(x[0])]
+    for i in range(0, len(pending), batch_size):
+      simulate_batch(pending[i: i + batch_size])
+
   for scenario_name, r, d, g in params_arr:
     if check_sim_result(scenario_name):
       continue
@@ -39,6 +39,7 @@ if __name__ == "__main__":
       should_halt, max_edge, max_opinion = scenario.check_halt_cond()
       if should_halt:
         logger.info(f'Simulation already finished for scenario `{scenario_name}`.')
+        scenario.close()
         continue
       logger.info(
           f'Loaded snapshot `{snapshot_name}` for scenario `{scenario_name}`. Model at step {scenario.steps}.')
@@ -86,5 +87,6 @@ if __name__ == "__main__":
       logger.info(
           f'Simulation completed for scenario `{scenario_name}`. {scenario.steps} steps simulated in total.')
       do_save()
-    else:
+    scenario.close()
+    if errored:
       break
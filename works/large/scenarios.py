@@ -64,11 +64,11 @@ recsys_o9 = lambda m: Mixed(
 recsys_s9 = lambda m: Mixed(
         m,
         Random(m, 10),
-        Structure(m, noise_std=0.2, matrix_init=False, log=get_logger()),
+        Structure(m, noise_std=0.2, matrix_init=False, legacy_counts=True, log=get_logger()),
         0.1)
 
 recsys_o10 = lambda m: Opinion(m)
-recsys_s10 = lambda m: Structure(m)
+recsys_s10 = lambda m: Structure(m, legacy_counts=True)
 
 # simulation parameters
 